@@ -1,17 +1,32 @@
 import os
 import json
 import shutil
+import time
 import threading
 import subprocess
-from flask import Flask, render_template, request, redirect, url_for, send_from_directory, flash, send_file
+from flask import Flask, render_template, request, redirect, url_for, send_from_directory, flash, send_file, Response
 import scrawler
 import job_queue
 import uploader
+import normalizer
+import metrics
+import control
+import config
+import manifest
+import quality
+import shard_export
 # import scraper (Removed V2)
 
 app = Flask(__name__)
 app.secret_key = 'supersecretkey'
 
+# Opt-in request profiling: APP_PROFILE=cprofile|sample, APP_PROFILE_PATHS=/api/queue,/dataset
+# Hooks are only registered when enabled, so normal requests are untouched.
+if os.environ.get('APP_PROFILE'):
+    import profiling
+    profiling.install_flask_profiler(app, os.environ['APP_PROFILE'],
+                                     paths=os.environ.get('APP_PROFILE_PATHS', '').split(','))
+
 # Config
 BUFFER_DIR = "buffer"
 OUTPUT_DATASET_DIR = "output_dataset"
@@ -25,17 +40,16 @@ if not os.path.exists(BUFFER_DIR):
 if not os.path.exists(OUTPUT_DATASET_DIR):
     os.makedirs(OUTPUT_DATASET_DIR)
 
-SETTINGS_FILE = "settings.json"
+SETTINGS_FILE = config.SETTINGS_FILE
 
 def load_settings():
-    if os.path.exists(SETTINGS_FILE):
-        with open(SETTINGS_FILE, 'r') as f:
-            return json.load(f)
-    return {}
+    return config.CONFIG.settings()
 
 def save_settings_to_disk(settings):
-    with open(SETTINGS_FILE, 'w') as f:
-        json.dump(settings, f, indent=2)
+    config.write_file_atomic(SETTINGS_FILE, json.dumps(settings, indent=2))
+
+def load_lighting_prompts():
+    return config.CONFIG.lighting_prompts()
 
 @app.route('/')
 def index():
@@ -52,6 +66,100 @@ def view_search():
     images.sort()
     return render_template('search.html', images=images)
 
+def keyword_from_stem(stem):
+    # Smart Naming: Check if filename has keyword
+    # Format: keyword_idx or keyword___uuid (legacy)
+    if "___" in stem:
+        return stem.split("___")[0]
+    if "_" in stem:
+        # Try to split off the index
+        parts = stem.rsplit("_", 1)
+        if len(parts) == 2 and parts[1].isdigit():
+            return parts[0]
+    return stem # Fallback
+
+def build_album_counters():
+    """
+    One listing of output_dataset -> { keyword: next free index }.
+    Albums are named keyword_01, keyword_02, ...; we continue after the highest one.
+    """
+    counters = {}
+    if os.path.exists(OUTPUT_DATASET_DIR):
+        for name in os.listdir(OUTPUT_DATASET_DIR):
+            parts = name.rsplit("_", 1)
+            if len(parts) == 2 and parts[1].isdigit():
+                keyword, idx = parts[0], int(parts[1])
+                counters[keyword] = max(counters.get(keyword, 1), idx + 1)
+    return counters
+
+def is_buffer_name(filename):
+    # A bare file name inside buffer/: no separators, no '.'/'..'
+    return isinstance(filename, str) and filename not in ('', '.', '..') and os.path.basename(filename) == filename
+
+def approve_files(filenames):
+    """
+    Moves buffer images to output_dataset/<keyword>_<NN>/light0.<ext> in one pass
+    and registers all new scenes with the job queue in a single write.
+    Returns a list of (filename, scene_name).
+    """
+    counters = build_album_counters()
+    approved = []
+
+    for filename in filenames:
+        src = os.path.join(BUFFER_DIR, filename)
+        if not is_buffer_name(filename) or not os.path.exists(src):
+            continue
+
+        stem, ext = os.path.splitext(filename)
+        keyword = keyword_from_stem(stem)
+
+        # Expected: keyword_01, keyword_02
+        idx = counters.get(keyword, 1)
+        while True:
+            scene_name = f"{keyword}_{idx:02d}"
+            scene_dir = os.path.join(OUTPUT_DATASET_DIR, scene_name)
+            try:
+                os.makedirs(scene_dir)
+                break
+            except FileExistsError:
+                # Created behind our back (e.g. restore from Drive); skip ahead
+                idx += 1
+        counters[keyword] = idx + 1
+
+        shutil.move(src, os.path.join(scene_dir, "light0" + ext))
+        approved.append((filename, scene_name))
+
+    if approved:
+        scenes = [scene for _, scene in approved]
+        job_queue.register_scenes(scenes, load_lighting_prompts())
+        # Pre-normalize light0 for the workflow resolution off the request thread
+        threading.Thread(target=normalizer.normalize_scenes, args=(scenes,), daemon=True).start()
+        announce_scenes(scenes)
+    return approved
+
+# ==========================================
+# CONTINUOUS PIPELINE
+# ==========================================
+RESIDENT_LOCK = threading.Lock()
+_resident_started = {'at': None}
+
+def start_resident_processor():
+    """Start `processor.py --continuous` unless a processor is already running (or just started)."""
+    with RESIDENT_LOCK:
+        just_started = _resident_started['at'] is not None and time.time() - _resident_started['at'] < 15
+        if just_started or control.live_processors():
+            return False
+        subprocess.Popen(["python3", "processor.py", "--continuous"])
+        _resident_started['at'] = time.time()
+        return True
+
+def announce_scenes(scene_names):
+    """Continuous mode: new scenes go straight to the resident processor instead of waiting for a batch run."""
+    if not scene_names or not load_settings().get('continuous_mode'):
+        return
+    control.emit_scenes(scene_names)
+    start_resident_processor()
+
 @app.route('/search/action', methods=['POST'])
 def search_action():
     # Handle both single and multi-select
@@ -65,56 +173,41 @@ def search_action():
         if single:
             filenames = [single]
 
-    count = 0
-    for filename in filenames:
-        src = os.path.join(BUFFER_DIR, filename)
-        if not os.path.exists(src):
-            continue
-            
-        if action == 'approve':
-            # V2: Approve directly to output_dataset/stem/light0.jpg
-            stem = os.path.splitext(filename)[0]
-            
-            # Smart Naming: Check if filename has keyword
-            # Smart Naming: Check if filename has keyword
-            # Format: keyword_idx or keyword___uuid (legacy)
-            if "___" in stem:
-                keyword = stem.split("___")[0]
-            elif "_" in stem:
-                # Try to split off the index
-                parts = stem.rsplit("_", 1)
-                if len(parts) == 2 and parts[1].isdigit():
-                    keyword = parts[0]
-                else:
-                    keyword = stem
-            else:
-                keyword = stem # Fallback
-                
-            # Find next index for album
-            # Expected: keyword_01, keyword_02
-            idx = 1
-            while True:
-                candidate = f"{keyword}_{idx:02d}"
-                if not os.path.exists(os.path.join(OUTPUT_DATASET_DIR, candidate)):
-                    scene_name = candidate
-                    break
-                idx += 1
-            
-            scene_dir = os.path.join(OUTPUT_DATASET_DIR, scene_name)
-            if not os.path.exists(scene_dir):
-                os.makedirs(scene_dir)
-                
-            dst = os.path.join(scene_dir, "light0" + os.path.splitext(filename)[1])
-            shutil.move(src, dst)
-            
-            count += 1
-        elif action == 'delete':
-            os.remove(src)
-            count += 1
-            
+    if action == 'approve':
+        approved = approve_files(filenames)
+        count = len(approved)
+    else:
+        count = 0
+        for filename in filenames:
+            src = os.path.join(BUFFER_DIR, filename)
+            if not is_buffer_name(filename) or not os.path.exists(src):
+                continue
+
+            if action == 'delete':
+                os.remove(src)
+                count += 1
+
     flash(f"{action.title()}d {count} images")
     return redirect(url_for('view_search'))
 
+@app.route('/api/approve', methods=['POST'])
+def bulk_approve():
+    # JSON: { "filenames": [...] } or { "all": true } for the whole buffer; form fields "filename" also work
+    payload = request.get_json(silent=True) or {}
+    if not isinstance(payload, dict):
+        return {'error': 'expected a JSON object'}, 400
+    filenames = payload.get('filenames') or request.form.getlist('filename')
+    if not isinstance(filenames, list) or not all(is_buffer_name(f) for f in filenames):
+        return {'error': 'filenames must be a list of file names in the buffer'}, 400
+    if payload.get('all') and os.path.exists(BUFFER_DIR):
+        filenames = sorted(f for f in os.listdir(BUFFER_DIR) if f.lower().endswith(('.jpg', '.jpeg', '.png')))
+
+    approved = approve_files(filenames)
+    return {
+        'approved': [{'filename': f, 'scene': scene} for f, scene in approved],
+        'count': len(approved),
+    }
+
 @app.route('/api/search', methods=['POST'])
 def run_search():
     mode = request.form.get('mode')
@@ -154,6 +247,49 @@ def get_queue_status():
 def get_queue_overview():
     return job_queue.get_queue_overview()
 
+# ==========================================
+# RUN CONTROL (pause / resume / drain / cancel)
+# ==========================================
+def control_status():
+    data = control.read_control()
+    return {
+        'state': data['state'],
+        'cancelled': data['cancelled'],
+        'processors': control.live_processors(),
+    }
+
+@app.route('/api/control')
+def get_control():
+    return control_status()
+
+@app.route('/api/control/<action>', methods=['POST'])
+def set_control(action):
+    # pause: stop dispatching, in-flight tasks finish; resume; drain: finish in-flight tasks and exit
+    states = {'pause': 'paused', 'resume': 'running', 'drain': 'draining'}
+    if action == 'cancel':
+        payload = request.get_json(silent=True) or {}
+        if not isinstance(payload, dict):
+            return {'error': 'expected a JSON object'}, 400
+        scene_name = payload.get('scene_name') or request.form.get('scene_name')
+        if not scene_name or not isinstance(scene_name, str):
+            return {'error': 'scene_name is required'}, 400
+        control.cancel_scene(scene_name)
+        job_queue.cancel_scene_tasks(scene_name)
+    elif action in states:
+        control.set_state(states[action])
+    else:
+        return {'error': f'unknown action: {action}'}, 404
+    return control_status()
+
+@app.route('/metrics')
+def get_metrics():
+    # App-process metrics plus the latest snapshot written by a running/finished processor
+    snapshots = {
+        'app': metrics.REGISTRY.snapshot(),
+        'processor': metrics.load_snapshot('processor'),
+    }
+    return Response(metrics.render_prometheus(snapshots), mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/delete_result', methods=['POST'])
 def delete_result():
     scene_name = request.form.get('scene_name')
@@ -213,15 +349,9 @@ def view_settings():
     settings = load_settings()
     
     # Load Prompts
-    prompts_list = []
-    if os.path.exists("lighting_prompts.txt"):
-        with open("lighting_prompts.txt", "r") as f:
-            prompts_list = [line.strip() for line in f if line.strip()]
+    prompts_list = load_lighting_prompts()
             
-    system_prompt_content = ""
-    if os.path.exists("system_prompt.txt"):
-        with open("system_prompt.txt", "r") as f:
-            system_prompt_content = f.read()
+    system_prompt_content = config.CONFIG.system_prompt()
             
     return render_template('settings.html', settings=settings, prompts=prompts_list, system_prompt=system_prompt_content)
 
@@ -240,6 +370,10 @@ def save_settings():
     # Generation Mode
     settings['generation_mode'] = request.form.get('generation_mode', 'local')
     settings['api_max_parallel'] = int(request.form.get('api_max_parallel', 20))
+    settings['comfy_batch_size'] = int(request.form.get('comfy_batch_size', 1))
+    budget = request.form.get('api_budget', '').strip()
+    settings['api_budget'] = float(budget) if budget else None
+    settings['continuous_mode'] = request.form.get('continuous_mode') == 'on'
     
     save_settings_to_disk(settings)
     
@@ -250,13 +384,14 @@ def save_settings():
     prompts = [p.strip() for p in prompts if p.strip()]
     
     if prompts:
-        with open("lighting_prompts.txt", "w") as f:
-            f.write("\n".join(prompts))
+        config.write_file_atomic(config.LIGHTING_PROMPTS_FILE, "\n".join(prompts))
             
     sys_prompt = request.form.get('system_prompt')
     if sys_prompt:
-        with open("system_prompt.txt", "w") as f:
-            f.write(sys_prompt)
+        config.write_file_atomic(config.SYSTEM_PROMPT_FILE, sys_prompt)
+
+    # Running processors pick this up before their next task
+    config.notify_changed()
 
     flash("Settings saved!")
     return redirect(url_for('view_settings'))
@@ -279,6 +414,14 @@ def view_dataset():
 
 @app.route('/api/process', methods=['POST'])
 def run_processor():
+    if load_settings().get('continuous_mode'):
+        # The resident processor walks the backlog first, then keeps taking approved scenes
+        if start_resident_processor():
+            flash("Started continuous processor (drain to stop)...")
+        else:
+            flash("A processor is already running.")
+        return redirect(url_for('view_dataset'))
+
     # Run processor in background for ALL
     subprocess.Popen(["python3", "processor.py"])
     flash("Started ComfyUI Processor for ALL...")
@@ -303,10 +446,17 @@ def run_relight():
     #             except:
     #                 pass
     
-    # Run processor for TARGET ALBUM
-    # Processor V2 accepts album name as target
-    subprocess.Popen(["python3", "processor.py", "--target", scene_name])
-    flash(f"Started Re-lighting for {scene_name}...")
+    # A running processor takes the scene in its interactive lane, ahead of its bulk backlog.
+    # Otherwise run processor for TARGET ALBUM (Processor V2 accepts album name as target).
+    # Announce first, then look: a processor that is just exiting unregisters before it checks
+    # for leftover events, so one of the two always picks the relight up.
+    control.uncancel_scene(scene_name)
+    control.emit_scenes([scene_name], lane="interactive")
+    if any(not str(p.get("target")).startswith("coordinator:") for p in control.live_processors()):
+        flash(f"Queued Re-lighting for {scene_name} ahead of the running batch.")
+    else:
+        subprocess.Popen(["python3", "processor.py", "--target", scene_name])
+        flash(f"Started Re-lighting for {scene_name}...")
     return redirect(url_for('view_dataset'))
 
 # ==========================================
@@ -348,8 +498,53 @@ def view_scene(scene_name):
                 metadata = json.load(f)
         except:
             pass
+    # Prefer the prompt each image was actually generated with
+    for name, entry in manifest.load(scene_path).items():
+        if entry.get('prompt'):
+            metadata[name.rsplit('.', 1)[0]] = entry['prompt']
+
+    scores = quality.load_scores(scene_path)
+    return render_template('scene_detail.html', scene_name=scene_name, images=images, metadata=metadata,
+                           scores=scores, threshold=load_settings().get('quality_threshold', QUALITY_THRESHOLD))
 
-    return render_template('scene_detail.html', scene_name=scene_name, images=images, metadata=metadata)
+# ==========================================
+# QUALITY (structural-consistency scores, see quality.py)
+# ==========================================
+QUALITY_THRESHOLD = 0.35
+
+@app.route('/quality')
+def view_quality():
+    n = request.args.get('n', 60, type=int)
+    threshold = request.args.get('threshold', load_settings().get('quality_threshold', QUALITY_THRESHOLD), type=float)
+    rows = sorted(quality.all_scores(OUTPUT_DATASET_DIR), key=lambda row: row[2]['score'])
+    return render_template('quality.html', rows=rows[:n], total=len(rows), threshold=threshold)
+
+@app.route('/api/quality/score', methods=['POST'])
+def run_quality_score():
+    # Only new or changed outputs are scored; the page shows results once it is reloaded
+    subprocess.Popen(["python3", "quality.py", "--score"])
+    flash("Started scoring outputs...")
+    return redirect(url_for('view_quality'))
+
+@app.route('/api/quality/requeue', methods=['POST'])
+def run_quality_requeue():
+    threshold = request.form.get('threshold', load_settings().get('quality_threshold', QUALITY_THRESHOLD), type=float)
+    requeued = quality.requeue_below(threshold, OUTPUT_DATASET_DIR, quality.REJECTED_DIR)
+    if not requeued:
+        flash(f"Nothing scores below {threshold}.")
+        return redirect(url_for('view_quality'))
+
+    # The moved outputs are missing now, so any run plans them again. A running processor has
+    # already walked these scenes: announce them like relights, which re-plans them there.
+    count = sum(len(v) for v in requeued.values())
+    scenes = sorted(requeued)
+    for scene_name in scenes:
+        control.uncancel_scene(scene_name)
+    control.emit_scenes(scenes, lane="interactive")
+    if not any(not str(p.get("target")).startswith("coordinator:") for p in control.live_processors()):
+        subprocess.Popen(["python3", "processor.py"])
+    flash(f"Requeued {count} outputs from {len(scenes)} scenes (moved to {quality.REJECTED_DIR}/).")
+    return redirect(url_for('view_quality'))
 
 # ==========================================
 # FILE SERVING
@@ -385,7 +580,20 @@ def serve_file(filepath):
 # ==========================================
 @app.route('/export')
 def view_export():
-    return render_template('export.html')
+    index = shard_export.load_index()
+    shards = {'count': len(index['shards']), 'scenes': len(index['scenes']),
+              'bytes': sum(s['bytes'] for s in index['shards']), 'updated': index.get('updated')}
+    return render_template('export.html', shards=shards)
+
+@app.route('/api/export_shards', methods=['POST'])
+def run_shard_export():
+    if shard_export.export_running():
+        flash("A shard export is already running.")
+        return redirect(url_for('view_export'))
+    # Incremental: only complete scenes that are new or changed since the last export are packed
+    subprocess.Popen(["python3", "shard_export.py"])
+    flash(f"Started training shard export into {shard_export.EXPORT_DIR}/...")
+    return redirect(url_for('view_export'))
 
 @app.route('/api/backup', methods=['POST'])
 def run_backup():
@@ -447,7 +655,9 @@ def import_drive():
             return redirect(url_for('view_export'))
             
         # Unzip
+        existing = set(os.listdir(OUTPUT_DATASET_DIR)) if os.path.exists(OUTPUT_DATASET_DIR) else set()
         uploader.unzip_dataset(dest)
+        restored = sorted(set(os.listdir(OUTPUT_DATASET_DIR)) - existing) if os.path.exists(OUTPUT_DATASET_DIR) else []
         
         # Cleanup
         os.remove(dest)
@@ -455,6 +665,7 @@ def import_drive():
         # Clear job queue so we rescan disk
         job_queue.clear_all_jobs()
         job_queue.scan_all_jobs()
+        announce_scenes([s for s in restored if os.path.isdir(os.path.join(OUTPUT_DATASET_DIR, s))])
         
         flash("Dataset restored successfully!")
     except Exception as e:
@@ -463,8 +674,9 @@ def import_drive():
     return redirect(url_for('view_export'))
 
 if __name__ == '__main__':
-    # Clear old task queue on startup as requested
-    job_queue.clear_all_jobs()
-    print("Cleared old task queue on startup.")
+    # Tasks a killed processor left in 'processing' go back to pending (done if the image exists)
+    if not control.live_processors():
+        stale = job_queue.reconcile_stale()
+        print(f"Reconciled {stale} stale task entries on startup.")
     
     app.run(debug=True, port=5000)
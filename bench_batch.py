@@ -0,0 +1,37 @@
+import os
+import shutil
+import argparse
+import tempfile
+import benchmark
+
+# Compares images/minute of one-prompt-per-execution against batched executions
+# (comfy_batch_size > 1) using mock_comfyui.py, which charges a fixed per-execution overhead.
+
+def main():
+    parser = argparse.ArgumentParser(description="Batched vs single-prompt ComfyUI throughput (mock)")
+    parser.add_argument("--scenes", type=int, default=2)
+    parser.add_argument("--prompts", type=int, default=25)
+    parser.add_argument("--batch-sizes", type=str, default="1,5,25")
+    parser.add_argument("--profile", type=str, default="default")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="bench_batch_")
+    benchmark.setup_workspace(work_dir, args.scenes, args.prompts)
+    os.chdir(work_dir)
+
+    results = []
+    try:
+        for batch_size in [int(b) for b in args.batch_sizes.split(",")]:
+            report = benchmark.run_benchmark(work_dir, "local", profile=args.profile, batch_size=batch_size)
+            executions = sum(m["executions"] for m in report["mock"])
+            results.append((batch_size, report["tasks_completed"], executions, report["elapsed_s"]))
+    finally:
+        os.chdir(benchmark.REPO_DIR)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print("\nbatch  images  executions  seconds  images/min")
+    for batch_size, images, executions, elapsed in results:
+        print(f"{batch_size:>5}  {images:>6}  {executions:>10}  {elapsed:>7.2f}  {images / elapsed * 60:>10.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+# Measures /api/queue (the dataset page polls it every 2 seconds) as the number of
+# scenes grows, optionally writing a cProfile/sampling profile per dataset size.
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPO_DIR)
+
+def build_dataset(work_dir, scenes, prompts, done_fraction=0.5):
+    output_dir = os.path.join(work_dir, "output_dataset")
+    jobs = {}
+    done = int(prompts * done_fraction)
+    for i in range(scenes):
+        name = f"scene_{i:05d}"
+        scene_dir = os.path.join(output_dir, name)
+        os.makedirs(scene_dir)
+        for light_idx in range(done + 1):
+            ext = "jpg" if light_idx == 0 else "png"
+            open(os.path.join(scene_dir, f"light{light_idx}.{ext}"), 'wb').close()
+        jobs[name] = {
+            'total': prompts, 'status': 'processing', 'progress': done,
+            'tasks': [{'prompt': f"prompt {k + 1}", 'status': 'done' if k < done else 'pending'} for k in range(prompts)],
+        }
+    with open(os.path.join(work_dir, "jobs.json"), 'w') as f:
+        json.dump(jobs, f, indent=2)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark /api/queue against dataset size")
+    parser.add_argument("--sizes", type=str, default="100,1000,5000")
+    parser.add_argument("--prompts", type=int, default=25)
+    parser.add_argument("--requests", type=int, default=5)
+    parser.add_argument("--profile", choices=["cprofile", "sample"], help="Write a profile per size to profiles/.")
+    args = parser.parse_args()
+
+    results = []
+    for size in [int(s) for s in args.sizes.split(",")]:
+        work_dir = tempfile.mkdtemp(prefix="bench_queue_")
+        build_dataset(work_dir, size, args.prompts)
+        shutil.copytree(os.path.join(REPO_DIR, "templates"), os.path.join(work_dir, "templates"))
+        os.chdir(work_dir)
+        try:
+            import app
+            import profiling
+            client = app.app.test_client()
+            client.get('/api/queue')  # warm up imports / caches
+
+            timings = []
+            run = lambda: timings.extend(_timed_get(client, '/api/queue') for _ in range(args.requests))
+            if args.profile:
+                out_prefix = os.path.join(REPO_DIR, profiling.PROFILE_DIR, f"api_queue_{size}")
+                with profiling.profile_run(args.profile, out_prefix):
+                    run()
+            else:
+                run()
+            results.append((size, min(timings), sum(timings) / len(timings)))
+        finally:
+            os.chdir(REPO_DIR)
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print("\nscenes   min ms   mean ms")
+    for size, best, mean in results:
+        print(f"{size:>6}  {best * 1000:>7.1f}  {mean * 1000:>8.1f}")
+
+def _timed_get(client, path):
+    start = time.perf_counter()
+    response = client.get(path)
+    response.get_data()
+    return time.perf_counter() - start
+
+if __name__ == "__main__":
+    main()
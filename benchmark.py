@@ -0,0 +1,261 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import functools
+from collections import defaultdict
+from PIL import Image, ImageDraw
+
+# End-to-end throughput benchmark: drives processor.process_dataset against
+# mock_comfyui.py / mock_bfl.py in a throwaway workspace and reports tasks/sec,
+# p50/p99 task latency and time per stage. Use --json to keep a regression baseline.
+# --speeds gives mock instances different slowdowns (e.g. 1,1,4); with --dispatch compare
+# the same workload runs under pull and least-loaded dispatch and the makespans are compared.
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPO_DIR)
+
+# =================================================================================
+# WORKSPACE
+# =================================================================================
+
+def setup_workspace(work_dir, scenes, prompts):
+    shutil.copy(os.path.join(REPO_DIR, "workflow_api.json"), work_dir)
+    with open(os.path.join(work_dir, "lighting_prompts.txt"), "w") as f:
+        f.write("\n".join(f"benchmark lighting prompt {i + 1}" for i in range(prompts)))
+    with open(os.path.join(work_dir, "system_prompt.txt"), "w") as f:
+        f.write("benchmark system prompt")
+    for i in range(scenes):
+        scene_dir = os.path.join(work_dir, "output_dataset", f"bench_{i + 1:02d}")
+        os.makedirs(scene_dir)
+        # Some geometry, so structure checks against light0 have something to compare
+        image = Image.new("RGB", (640, 480), (90, 80, 70))
+        draw = ImageDraw.Draw(image)
+        for k in range(4):
+            x, y = 60 + k * 140 + i % 40, 80 + (k * 97 + i * 13) % 200
+            draw.rectangle((x, y, x + 100, y + 150), fill=(200 - k * 30, 180, 150 + k * 20))
+        image.save(os.path.join(scene_dir, "light0.jpg"))
+
+def reset_outputs(work_dir):
+    output_dir = os.path.join(work_dir, "output_dataset")
+    for scene in os.listdir(output_dir):
+        scene_dir = os.path.join(output_dir, scene)
+        if os.path.isdir(scene_dir):
+            for f in os.listdir(scene_dir):
+                if (f.startswith("light") and not f.startswith("light0.")) or f == "manifest.json":
+                    os.remove(os.path.join(scene_dir, f))
+    jobs_file = os.path.join(work_dir, "jobs.json")
+    if os.path.exists(jobs_file):
+        os.remove(jobs_file)
+
+def output_files(output_dir):
+    outputs = []
+    for root, _, files in os.walk(output_dir):
+        outputs += [os.path.join(root, f) for f in files if f.startswith("light") and not f.startswith("light0.")]
+    return outputs
+
+# =================================================================================
+# MEASUREMENT
+# =================================================================================
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+class StageRecorder:
+    """Wraps processor/client callables to time each stage without touching production code."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.task_latencies = []
+        self.restore = []
+
+    def wrap(self, owner, attr, stage, tasks_of=None):
+        original = getattr(owner, attr)
+        recorder = self
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            except Exception:
+                with recorder.lock:
+                    recorder.errors[stage] += 1
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                with recorder.lock:
+                    recorder.samples[stage].append(elapsed)
+                    if tasks_of is not None:
+                        recorder.task_latencies += [elapsed] * tasks_of(args)
+
+        setattr(owner, attr, timed)
+        self.restore.append((owner, attr, original))
+
+    def unwrap(self):
+        for owner, attr, original in reversed(self.restore):
+            setattr(owner, attr, original)
+        self.restore = []
+
+    def stage_report(self):
+        report = {}
+        for stage, values in sorted(self.samples.items()):
+            report[stage] = {
+                "count": len(values),
+                "total_s": round(sum(values), 4),
+                "mean_s": round(sum(values) / len(values), 4),
+                "p50_s": round(percentile(values, 50), 4),
+                "p99_s": round(percentile(values, 99), 4),
+                "errors": self.errors.get(stage, 0),
+            }
+        return report
+
+def instrument(recorder, processor, job_queue, normalizer):
+    recorder.wrap(processor.ComfyUIClient, "queue_prompt", "queue_prompt")
+    recorder.wrap(processor.ComfyUIClient, "wait_for_completion", "wait_for_completion")
+    recorder.wrap(processor.ComfyUIClient, "get_image", "get_image")
+    recorder.wrap(processor.FluxAPIClient, "generate_image", "api_generate", tasks_of=lambda args: 1)
+    recorder.wrap(processor, "run_local_batch", "local_batch", tasks_of=lambda args: len(args[1]))
+    recorder.wrap(normalizer.InputCache, "get", "input_payload")
+    recorder.wrap(job_queue, "save_jobs", "jobs_write")
+
+# =================================================================================
+# RUNNER
+# =================================================================================
+
+def run_benchmark(work_dir, mode="local", instances=1, profile="default", api_workers=8,
+                  batch_size=1, steps=4, api_profile=None, api_budget=None, speeds=None, dispatch="least_loaded",
+                  early_abort=False):
+    # Imported lazily so module-level paths resolve inside the workspace (cwd)
+    import config
+    import processor
+    import job_queue
+    import normalizer
+    import mock_comfyui
+    import mock_bfl
+
+    reset_outputs(work_dir)
+    mocks = []
+    settings = {"generation_mode": mode, "steps": steps, "early_abort": early_abort}
+    if mode in ("api", "hybrid"):
+        mock = mock_bfl.MockBFL.from_profile(api_profile or profile)
+        mock.start()
+        mocks.append(mock)
+        settings.update({"api_url": mock.api_url, "api_max_parallel": api_workers, "api_poll_interval": 0.05,
+                         "api_budget": api_budget})
+        os.environ.setdefault("BFL_API_KEY", "benchmark")
+    if mode in ("local", "hybrid"):
+        speeds = speeds or [1.0] * instances
+        instances = len(speeds)
+        base = mock_comfyui.PROFILES[profile]
+        local_mocks = []
+        for factor in speeds:
+            mock = mock_comfyui.MockComfyUI.from_profile(profile, prompt_overhead=base["prompt_overhead"] * factor,
+                                                         image_time=base["image_time"] * factor)
+            mock.start()
+            local_mocks.append(mock)
+        mocks += local_mocks
+        settings.update({"comfyui_urls": [m.url for m in local_mocks], "comfy_batch_size": batch_size,
+                         "comfy_dispatch": dispatch})
+
+    config.write_file_atomic(os.path.join(work_dir, "settings.json"), json.dumps(settings))
+    config.CONFIG.invalidate()
+
+    recorder = StageRecorder()
+    instrument(recorder, processor, job_queue, normalizer)
+    start = time.time()
+    try:
+        processor.process_dataset()
+    finally:
+        recorder.unwrap()
+        for mock in mocks:
+            mock.stop()
+
+    outputs = output_files(processor.OUTPUT_DIR)
+    # Workers linger ~2s on an empty queue before exiting; time to the last output instead
+    elapsed = (max(os.path.getmtime(p) for p in outputs) if outputs else time.time()) - start
+    latencies = recorder.task_latencies
+
+    return {
+        "config": {"mode": mode, "instances": instances if mode != "api" else 0, "profile": profile,
+                   "api_workers": api_workers if mode != "local" else 0, "batch_size": batch_size, "steps": steps,
+                   "api_profile": api_profile, "api_budget": api_budget, "speeds": speeds, "dispatch": dispatch,
+                   "early_abort": early_abort},
+        "tasks_completed": len(outputs),
+        "elapsed_s": round(elapsed, 3),
+        "tasks_per_sec": round(len(outputs) / elapsed, 3) if elapsed > 0 else 0.0,
+        "task_latency_p50_s": round(percentile(latencies, 50), 4),
+        "task_latency_p99_s": round(percentile(latencies, 99), 4),
+        "stages": recorder.stage_report(),
+        "mock": [{k: getattr(m, k) for k in ("executions", "submitted", "failures", "rejected", "interrupted", "spent") if hasattr(m, k)}
+                 for m in mocks],
+    }
+
+def print_report(report):
+    config = report["config"]
+    print("\n=== Benchmark ===")
+    print("config: " + ", ".join(f"{k}={v}" for k, v in config.items()))
+    print(f"tasks: {report['tasks_completed']} in {report['elapsed_s']:.2f}s -> {report['tasks_per_sec']:.2f} tasks/sec")
+    print(f"task latency: p50 {report['task_latency_p50_s']:.3f}s  p99 {report['task_latency_p99_s']:.3f}s")
+    print(f"\n{'stage':<22}{'count':>7}{'total s':>10}{'mean s':>9}{'p50 s':>9}{'p99 s':>9}{'errors':>8}")
+    for stage, s in report["stages"].items():
+        print(f"{stage:<22}{s['count']:>7}{s['total_s']:>10.3f}{s['mean_s']:>9.4f}{s['p50_s']:>9.4f}{s['p99_s']:>9.4f}{s['errors']:>8}")
+    for i, m in enumerate(report["mock"]):
+        print(f"mock[{i}]: " + ", ".join(f"{k}={v}" for k, v in m.items()))
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end processor throughput benchmark (mock backends)")
+    parser.add_argument("--mode", choices=["local", "api", "hybrid"], default="local")
+    parser.add_argument("--scenes", type=int, default=4)
+    parser.add_argument("--prompts", type=int, default=25)
+    parser.add_argument("--instances", type=int, default=1, help="Mock ComfyUI instances (local mode).")
+    parser.add_argument("--profile", type=str, default="default", help="Mock profile: fast, default, realistic, flaky, rate-limited.")
+    parser.add_argument("--api-workers", type=int, default=8)
+    parser.add_argument("--api-profile", type=str, default=None, help="Mock BFL profile in hybrid mode (default: --profile).")
+    parser.add_argument("--api-budget", type=float, default=None, help="API credit budget per run.")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--steps", type=int, default=4)
+    parser.add_argument("--speeds", type=str, default=None,
+                        help="Comma-separated slowdown per mock instance, e.g. 1,1,4 (overrides --instances).")
+    parser.add_argument("--dispatch", choices=["least_loaded", "pull", "compare"], default="least_loaded",
+                        help="Multi-instance dispatch; 'compare' runs pull and least_loaded on the same workload.")
+    parser.add_argument("--early-abort", action="store_true", help="Abort failing generations from previews (use --profile bad-samples).")
+    parser.add_argument("--json", type=str, help="Write the report to this file.")
+    args = parser.parse_args()
+    speeds = [float(x) for x in args.speeds.split(",")] if args.speeds else None
+    dispatches = ["pull", "least_loaded"] if args.dispatch == "compare" else [args.dispatch]
+
+    work_dir = tempfile.mkdtemp(prefix="benchmark_")
+    setup_workspace(work_dir, args.scenes, args.prompts)
+    os.chdir(work_dir)
+    reports = []
+    try:
+        for dispatch in dispatches:
+            reports.append(run_benchmark(work_dir, args.mode, args.instances, args.profile, args.api_workers,
+                                         args.batch_size, args.steps, args.api_profile, args.api_budget,
+                                         speeds, dispatch, args.early_abort))
+    finally:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    for report in reports:
+        print_report(report)
+    if len(reports) > 1:
+        pull, least = reports[0]["elapsed_s"], reports[1]["elapsed_s"]
+        print(f"\nmakespan: pull {pull:.2f}s, least_loaded {least:.2f}s ({(pull - least) / pull * 100:+.1f}% shorter)")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(reports if len(reports) > 1 else reports[0], f, indent=2)
+        print(f"\nReport written to {args.json}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import threading
+import control
+
+# Cached view of settings.json, lighting_prompts.txt and system_prompt.txt shared by app.py,
+# processor.py and the coordinator. A file is re-parsed only when its (mtime, size) changes;
+# stats are throttled to one round per `check_interval`. app.py also pushes a config version
+# through control.json after saving, so a running processor reloads even when a rewrite
+# lands within the filesystem's mtime granularity.
+
+SETTINGS_FILE = "settings.json"
+LIGHTING_PROMPTS_FILE = "lighting_prompts.txt"
+SYSTEM_PROMPT_FILE = "system_prompt.txt"
+
+def load_text_file(filepath):
+    if os.path.exists(filepath):
+        with open(filepath, 'r') as f:
+            return [line.strip() for line in f if line.strip()]
+    return []
+
+def load_single_text_file(filepath):
+    if os.path.exists(filepath):
+        with open(filepath, 'r') as f:
+            return f.read().strip()
+    return ""
+
+def load_json_file(filepath):
+    if os.path.exists(filepath):
+        with open(filepath, 'r') as f:
+            return json.load(f)
+    return {}
+
+def write_file_atomic(filepath, text):
+    """Readers never see a half-written file (they may stat it at any moment)."""
+    tmp_path = f"{filepath}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, filepath)
+
+class ConfigService:
+    def __init__(self, settings_file=SETTINGS_FILE, prompts_file=LIGHTING_PROMPTS_FILE,
+                 system_prompt_file=SYSTEM_PROMPT_FILE, check_interval=1.0):
+        self.sources = {
+            'settings': (settings_file, load_json_file),
+            'lighting_prompts': (prompts_file, load_text_file),
+            'system_prompt': (system_prompt_file, load_single_text_file),
+        }
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.values = {'settings': {}, 'lighting_prompts': [], 'system_prompt': ""}
+        self.stamps = {}
+        self.pinned = {}
+        self.version = 0
+        self.pushed_version = None
+        self.last_check = None
+
+    def _stamp(self, path):
+        try:
+            st = os.stat(path)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    def refresh(self, force=False):
+        """Re-read changed files (at most once per check_interval). Returns the config version."""
+        with self.lock:
+            # control.json is itself mtime-cached, so a pushed version is seen without the throttle
+            pushed = control.read_control().get('config_version')
+            if pushed != self.pushed_version:
+                self.pushed_version = pushed
+                force = True
+
+            now = time.monotonic()
+            if not force and self.last_check is not None and now - self.last_check < self.check_interval:
+                return self.version
+            self.last_check = now
+
+            changed = False
+            for name, (path, parse) in self.sources.items():
+                stamp = self._stamp(path)
+                if not force and stamp == self.stamps.get(name, False):
+                    continue
+                try:
+                    value = parse(path)
+                except (OSError, ValueError) as e:
+                    # Keep the previous value and retry on the next check
+                    print(f"Config: could not read {path}: {e}")
+                    continue
+                self.stamps[name] = stamp
+                if value != self.values[name]:
+                    self.values[name] = value
+                    changed = True
+            if changed:
+                self.version += 1
+            return self.version
+
+    def invalidate(self):
+        """Force a re-read on the next access (after this process wrote the files itself)."""
+        with self.lock:
+            self.last_check = None
+            self.stamps.clear()
+
+    def pin(self, **values):
+        """Fix values regardless of local files (remote workers use the coordinator's config)."""
+        with self.lock:
+            self.pinned.update(values)
+            self.version += 1
+
+    def get(self, name):
+        self.refresh()
+        with self.lock:
+            return self.pinned[name] if name in self.pinned else self.values[name]
+
+    def settings(self):
+        # Copy: callers are free to modify what they get
+        return dict(self.get('settings'))
+
+    def lighting_prompts(self):
+        return list(self.get('lighting_prompts'))
+
+    def system_prompt(self):
+        return self.get('system_prompt')
+
+CONFIG = ConfigService()
+
+def notify_changed():
+    """Tell running processors to reload now (called by app.py after saving)."""
+    CONFIG.invalidate()
+    control.bump_config_version()
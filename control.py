@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import threading
+
+# Run control shared by app.py (writer) and processor.py (reader) through a small JSON file:
+#   {"state": "running"|"paused"|"draining", "cancelled": [scene, ...], "config_version": N, "updated": ts}
+# Workers look at it between tasks only, so in-flight generations always finish.
+#   paused   - stop dispatching new tasks until resumed
+#   draining - finish in-flight tasks, then exit (queued tasks stay pending in jobs.json)
+# config_version is bumped by app.py after saving settings/prompts (see config.py).
+# Every running processor also leaves a pid file so the app can tell whether anything is live.
+
+CONTROL_DIR = "control"
+CONTROL_FILE = os.path.join(CONTROL_DIR, "control.json")
+STATES = ("running", "paused", "draining")
+
+CONTROL_LOCK = threading.Lock()
+_cache = {"mtime": None, "data": None}
+
+def _default():
+    return {"state": "running", "cancelled": [], "config_version": 0, "updated": None}
+
+def read_control():
+    """Current control state; re-reads the file only when its mtime changed."""
+    try:
+        mtime = os.stat(CONTROL_FILE).st_mtime_ns
+    except OSError:
+        return _default()
+    if _cache["mtime"] == mtime and _cache["data"] is not None:
+        return _cache["data"]
+    try:
+        with open(CONTROL_FILE, 'r') as f:
+            data = dict(_default(), **json.load(f))
+    except (OSError, ValueError):
+        return _cache["data"] or _default()
+    _cache.update(mtime=mtime, data=data)
+    return data
+
+def _write(data):
+    os.makedirs(CONTROL_DIR, exist_ok=True)
+    data["updated"] = time.time()
+    tmp_path = f"{CONTROL_FILE}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, CONTROL_FILE)
+    return data
+
+def set_state(state):
+    if state not in STATES:
+        raise ValueError(f"Unknown control state: {state}")
+    with CONTROL_LOCK:
+        data = dict(read_control())
+        data["state"] = state
+        return _write(data)
+
+def cancel_scene(scene_name):
+    with CONTROL_LOCK:
+        data = dict(read_control())
+        data["cancelled"] = sorted(set(data["cancelled"]) | {scene_name})
+        return _write(data)
+
+def uncancel_scene(scene_name):
+    with CONTROL_LOCK:
+        data = dict(read_control())
+        data["cancelled"] = [s for s in data["cancelled"] if s != scene_name]
+        return _write(data)
+
+def bump_config_version():
+    with CONTROL_LOCK:
+        data = dict(read_control())
+        data["config_version"] = data.get("config_version", 0) + 1
+        return _write(data)
+
+def reset():
+    """Back to running with no cancelled scenes (used when a fresh processor starts)."""
+    with CONTROL_LOCK:
+        data = _default()
+        data["config_version"] = read_control().get("config_version", 0)
+        return _write(data)
+
+def is_cancelled(scene_name):
+    return scene_name in read_control()["cancelled"]
+
+def wait_while_paused(poll=1.0):
+    """Blocks while paused. Returns False if the processor should drain and exit."""
+    while True:
+        state = read_control()["state"]
+        if state != "paused":
+            return state != "draining"
+        time.sleep(poll)
+
+# =================================================================================
+# PROCESSOR REGISTRY
+# =================================================================================
+
+def _pid_path(pid):
+    return os.path.join(CONTROL_DIR, f"processor-{pid}.json")
+
+def register_processor(target="all"):
+    os.makedirs(CONTROL_DIR, exist_ok=True)
+    with open(_pid_path(os.getpid()), 'w') as f:
+        json.dump({"pid": os.getpid(), "target": target, "started": time.time()}, f)
+
+def unregister_processor():
+    try:
+        os.remove(_pid_path(os.getpid()))
+    except OSError:
+        pass
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def live_processors():
+    """Processors that are still running; pid files of dead ones are removed."""
+    if not os.path.isdir(CONTROL_DIR):
+        return []
+    live = []
+    for name in os.listdir(CONTROL_DIR):
+        if not (name.startswith("processor-") and name.endswith(".json")):
+            continue
+        path = os.path.join(CONTROL_DIR, name)
+        try:
+            with open(path, 'r') as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if _alive(info.get("pid", -1)):
+            live.append(info)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    return live
+
+# =================================================================================
+# SCENE EVENTS
+# =================================================================================
+# app.py announces scenes to the running processor by dropping a small JSON file into
+# control/events/; the processor consumes them oldest first and starts generating right away.
+#   bulk        - scenes just created (approve, Drive restore) in continuous mode
+#   interactive - a relight requested from the dataset page (served ahead of the bulk backlog)
+
+EVENTS_DIR = os.path.join(CONTROL_DIR, "events")
+
+def emit_scenes(scene_names, lane="bulk"):
+    if not scene_names:
+        return
+    os.makedirs(EVENTS_DIR, exist_ok=True)
+    name = f"{time.time_ns()}-{os.getpid()}-{threading.get_ident()}.json"
+    tmp_path = os.path.join(EVENTS_DIR, name + ".tmp")
+    event_type = "relight" if lane == "interactive" else "scene_created"
+    with open(tmp_path, 'w') as f:
+        json.dump({"type": event_type, "lane": lane, "scenes": list(scene_names), "time": time.time()}, f)
+    os.replace(tmp_path, os.path.join(EVENTS_DIR, name))
+
+def _event_files():
+    try:
+        return sorted(n for n in os.listdir(EVENTS_DIR) if n.endswith(".json"))
+    except OSError:
+        return []
+
+def pending_scene_events():
+    return bool(_event_files())
+
+def take_scene_events(lanes=None):
+    """
+    (scene, lane) announced since the last call, oldest first, optionally only for some lanes.
+    Consumed event files are removed.
+    """
+    scenes = []
+    for name in _event_files():
+        path = os.path.join(EVENTS_DIR, name)
+        try:
+            with open(path, 'r') as f:
+                event = json.load(f)
+        except (OSError, ValueError):
+            continue
+        lane = event.get("lane", "bulk")
+        if lanes is not None and lane not in lanes:
+            continue
+        scenes.extend((scene, lane) for scene in event.get("scenes", []))
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    return scenes
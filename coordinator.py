@@ -0,0 +1,470 @@
+import os
+import time
+import logging
+import uuid
+import threading
+from collections import OrderedDict, deque
+from flask import Flask, request, send_file
+from werkzeug.serving import make_server
+from werkzeug.exceptions import ClientDisconnected
+import processor
+import job_queue
+import manifest
+import integrity
+import control
+import metrics
+
+# Multi-node mode. The coordinator owns the task table (jobs.json, output_dataset) and hands
+# out leased tasks over HTTP; remote_worker.py runs next to each ComfyUI box, pulls leases,
+# generates locally and pushes the PNGs back.
+#
+#   python coordinator.py --port 5100 [--target scene]
+#   python remote_worker.py --coordinator http://<head>:5100 --comfyui http://127.0.0.1:8188
+#
+# A lease holds up to `max_tasks` prompts of one scene. Workers renew it with heartbeats while
+# generating; a lease that is not renewed within its TTL goes back to pending, so a lost worker
+# only costs the time until the lease expires.
+
+DEFAULT_PORT = 5100
+CHUNK_SIZE = 256 * 1024
+LATE_GRACE = 10  # an expired lease's results are still taken for this many TTLs
+
+# =================================================================================
+# TASK TABLE
+# =================================================================================
+
+class TaskTable:
+    def __init__(self, tasks, lease_ttl=60.0, max_attempts=3):
+        self.lease_ttl = lease_ttl
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.pending = OrderedDict()  # scene -> deque of (scene, light_idx, prompt)
+        self.leases = {}              # lease_id -> {"worker", "tasks": {light_idx: task}, "expires"}
+        self.expired = OrderedDict()  # lease_id -> {"tasks", "until"}: late results are still taken
+        self.attempts = {}
+        self.done = 0
+        self.failed = 0
+        for task in tasks:
+            self.pending.setdefault(task[0], deque()).append(task)
+        self.scenes = frozenset(self.pending)
+
+    def pending_count(self):
+        return sum(len(q) for q in self.pending.values())
+
+    def _requeue(self, task):
+        # Back to the front: a retried task should not wait behind the whole backlog
+        self.pending.setdefault(task[0], deque()).appendleft(task)
+        self.pending.move_to_end(task[0], last=False)
+
+    def lease(self, worker, max_tasks=1):
+        """Up to max_tasks pending prompts of one scene, or None if nothing is pending."""
+        with self.lock:
+            if not self.pending:
+                return None
+            scene, scene_queue = next(iter(self.pending.items()))
+            tasks = [scene_queue.popleft() for _ in range(min(max_tasks, len(scene_queue)))]
+            if not scene_queue:
+                del self.pending[scene]
+            lease_id = uuid.uuid4().hex
+            self.leases[lease_id] = {"worker": worker, "tasks": {t[1]: t for t in tasks},
+                                     "expires": time.monotonic() + self.lease_ttl}
+            return lease_id, tasks
+
+    def drop_scene(self, scene):
+        with self.lock:
+            return len(self.pending.pop(scene, ()))
+
+    def heartbeat(self, lease_id):
+        with self.lock:
+            lease = self.leases.get(lease_id)
+            if lease is None:
+                return False
+            lease["expires"] = time.monotonic() + self.lease_ttl
+            return True
+
+    def task(self, lease_id, light_idx):
+        with self.lock:
+            lease = self.leases.get(lease_id)
+            return lease["tasks"].get(light_idx) if lease else None
+
+    def _prune_expired(self, now):
+        while self.expired and next(iter(self.expired.values()))["until"] < now:
+            self.expired.popitem(last=False)
+
+    def late_task(self, lease_id, light_idx):
+        """The task of a recently expired lease, if that lease held it and nobody took it back."""
+        with self.lock:
+            self._prune_expired(time.monotonic())
+            lease = self.expired.get(lease_id)
+            return lease["tasks"].get(light_idx) if lease else None
+
+    def complete_late(self, lease_id, light_idx):
+        """A late result was stored: the task no longer needs to run (if it is still pending)."""
+        with self.lock:
+            lease = self.expired.get(lease_id)
+            task = lease["tasks"].pop(light_idx, None) if lease else None
+            if task is None:
+                return False
+            scene_queue = self.pending.get(task[0])
+            if scene_queue is None or task not in scene_queue:
+                return False  # leased again: that lease completes it
+            scene_queue.remove(task)
+            if not scene_queue:
+                del self.pending[task[0]]
+            self.done += 1
+            return True
+
+    def complete(self, lease_id, light_idx):
+        with self.lock:
+            lease = self.leases.get(lease_id)
+            if lease is None or lease["tasks"].pop(light_idx, None) is None:
+                return False
+            if not lease["tasks"]:
+                del self.leases[lease_id]
+            self.done += 1
+            return True
+
+    def fail(self, lease_id, light_indices, retryable=False):
+        """
+        Returns (released, given_up): the tasks the live lease actually held, and those of them
+        that were given up on (out of attempts). An expired lease releases nothing.
+        """
+        released, given_up = [], []
+        with self.lock:
+            lease = self.leases.get(lease_id)
+            if lease is None:
+                return released, given_up
+            for light_idx in light_indices:
+                task = lease["tasks"].pop(light_idx, None)
+                if task is None:
+                    continue
+                released.append(task)
+                key = (task[0], task[1])
+                if not retryable:
+                    self.attempts[key] = self.attempts.get(key, 0) + 1
+                if self.attempts.get(key, 0) >= self.max_attempts:
+                    self.failed += 1
+                    given_up.append(task)
+                else:
+                    self._requeue(task)
+            if not lease["tasks"]:
+                del self.leases[lease_id]
+        return released, given_up
+
+    def reap(self):
+        """Expired leases (worker lost or stuck) go back to pending. Returns (worker, tasks) pairs."""
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            self._prune_expired(now)
+            for lease_id, lease in list(self.leases.items()):
+                if lease["expires"] < now:
+                    del self.leases[lease_id]
+                    for task in lease["tasks"].values():
+                        self._requeue(task)
+                    expired.append((lease["worker"], list(lease["tasks"].values())))
+                    self.expired[lease_id] = {"tasks": dict(lease["tasks"]),
+                                              "until": now + LATE_GRACE * self.lease_ttl}
+        return expired
+
+    def release_all(self):
+        """Drop all leases (coordinator shutdown); their tasks simply remain pending."""
+        with self.lock:
+            tasks = [t for lease in self.leases.values() for t in lease["tasks"].values()]
+            self.leases.clear()
+        return tasks
+
+    def finished(self):
+        with self.lock:
+            return not self.pending and not self.leases
+
+    def status(self):
+        with self.lock:
+            workers = {}
+            for lease in self.leases.values():
+                workers[lease["worker"]] = workers.get(lease["worker"], 0) + len(lease["tasks"])
+            return {"pending": sum(len(q) for q in self.pending.values()),
+                    "leased": sum(workers.values()), "done": self.done, "failed": self.failed,
+                    "workers": workers}
+
+# =================================================================================
+# COORDINATOR SERVER
+# =================================================================================
+
+class Coordinator:
+    def __init__(self, workflow_template, input_cache, tasks, lease_ttl=60.0, max_attempts=3):
+        self.workflow_template = workflow_template
+        self.input_cache = input_cache
+        self.table = TaskTable(tasks, lease_ttl, max_attempts)
+        self.stop_event = threading.Event()
+        self.app = self._build_app()
+        self.server = None
+        self.url = None
+        self.threads = []
+
+    # -------------------------------------------------------------------------
+    # Lifecycle
+    # -------------------------------------------------------------------------
+
+    def start(self, host="0.0.0.0", port=DEFAULT_PORT):
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)  # no access log line per lease/upload
+        self.server = make_server(host, port, self.app, threaded=True)
+        shown_host = "127.0.0.1" if host in ("0.0.0.0", "") else host
+        self.url = f"http://{shown_host}:{self.server.server_port}"
+        for target in (self.server.serve_forever, self._reaper):
+            t = threading.Thread(target=target, daemon=True)
+            t.start()
+            self.threads.append(t)
+        print(f"Coordinator serving {self.table.pending_count()} tasks at {self.url}")
+        return self.url
+
+    def wait(self, poll=1.0):
+        """Blocks until every task is done/failed or a drain was requested and leases are back."""
+        while not self.stop_event.wait(poll):
+            if self.table.finished():
+                break
+            if control.read_control()["state"] == "draining" and not self.table.status()["leased"]:
+                break
+
+    def stop(self, linger=0.0):
+        """Stop handing out work; keep answering 410 for `linger` seconds so idle workers see the end."""
+        self.stop_event.set()
+        job_queue.mark_many((task[0], task[1] - 1, 'pending') for task in self.table.release_all())
+        time.sleep(linger)
+        if self.server is not None:
+            self.server.shutdown()
+
+    def _reaper(self):
+        while not self.stop_event.wait(min(5.0, self.table.lease_ttl / 4)):
+            for worker, tasks in self.table.reap():
+                print(f"  [Coordinator] Lease of {worker} expired, re-queued {len(tasks)} task(s)")
+                # A late result for these is no longer in flight either (see put_result)
+                metrics.INFLIGHT.dec(len(tasks), backend='remote', instance=worker)
+                metrics.RETRIES.inc(len(tasks), backend='remote', reason='lease_expired')
+                job_queue.mark_many((task[0], task[1] - 1, 'pending') for task in tasks)
+
+    # -------------------------------------------------------------------------
+    # HTTP
+    # -------------------------------------------------------------------------
+
+    def _build_app(self):
+        app = Flask(__name__)
+        coord = self
+
+        @app.route('/api/config')
+        def get_config():
+            # Workers render prompts with the coordinator's workflow/settings so every node agrees
+            processor.apply_config()
+            return {
+                'workflow': coord.workflow_template,
+                'settings': processor.load_settings(),
+                'system_prompt': processor.SYSTEM_PROMPT,
+                'lease_ttl': coord.table.lease_ttl,
+                'version': processor.CONFIG.version,
+            }
+
+        @app.route('/api/status')
+        def get_status():
+            return coord.table.status()
+
+        @app.route('/api/lease', methods=['POST'])
+        def lease():
+            payload = request.get_json(silent=True) or {}
+            worker = payload.get('worker') or request.remote_addr
+            state = control.read_control()["state"]
+            if state == "draining" or coord.stop_event.is_set():
+                return {'done': True}, 410
+            if state == "paused":
+                return '', 204
+
+            # Cancelled scenes are dropped from this run; their tasks stay pending in jobs.json
+            for scene in control.read_control()["cancelled"]:
+                dropped = coord.table.drop_scene(scene)
+                if dropped:
+                    metrics.TASKS.inc(dropped, backend='control', outcome='cancelled')
+
+            leased = coord.table.lease(worker, max(1, int(payload.get('max_tasks', 1))))
+            if leased is None:
+                return ({'done': True}, 410) if coord.table.finished() else ('', 204)
+            lease_id, tasks = leased
+            scene = tasks[0][0]
+
+            processor.apply_config()
+            tasks = [processor.current_task(t) for t in tasks]
+            payload = coord.input_cache.get(scene)
+            job_queue.mark_many((scene, task[1] - 1, 'processing') for task in tasks)
+            metrics.INFLIGHT.inc(len(tasks), backend='remote', instance=worker)
+            print(f"  [Coordinator] {worker} leased {scene} - " + ", ".join(f"light{t[1]}" for t in tasks))
+            return {
+                'lease_id': lease_id,
+                'ttl': coord.table.lease_ttl,
+                'tasks': [{'scene': t[0], 'light_idx': t[1], 'prompt': t[2]} for t in tasks],
+                'config_version': processor.CONFIG.version,
+                # Workers cache inputs by this digest: a replaced or re-normalized light0 is fetched again
+                'input_digest': payload.digest if payload else None,
+            }
+
+        @app.route('/api/heartbeat/<lease_id>', methods=['POST'])
+        def heartbeat(lease_id):
+            if coord.table.heartbeat(lease_id):
+                return {'ok': True}
+            return {'error': 'unknown or expired lease'}, 404
+
+        @app.route('/api/input/<scene>')
+        def get_input(scene):
+            if scene not in coord.table.scenes:
+                return {'error': 'unknown scene'}, 404
+            payload = coord.input_cache.get(scene)
+            if payload is None:
+                return {'error': 'no light0 for scene'}, 404
+            response = send_file(os.path.abspath(payload.path), mimetype='image/jpeg')
+            response.headers['X-Input-Digest'] = payload.digest
+            return response
+
+        @app.route('/api/result/<lease_id>/<scene>/<int:light_idx>', methods=['PUT', 'POST'])
+        def put_result(lease_id, scene, light_idx):
+            worker = request.headers.get('X-Worker', request.remote_addr)
+            output_hash = request.headers.get('X-Output-Hash')
+            if scene not in coord.table.scenes:
+                request.stream.read()
+                return {'error': 'unknown scene'}, 404
+            scene_dir = os.path.join(processor.OUTPUT_DIR, scene)
+            task = coord.table.task(lease_id, light_idx)
+            late = task is None
+            if late:
+                # Recently expired lease: take the result only if nobody finished the image meanwhile
+                task = coord.table.late_task(lease_id, light_idx)
+                if task is None or task[0] != scene or manifest.is_current(scene_dir, light_idx, output_hash):
+                    request.stream.read()
+                    return {'error': 'unknown lease or task'}, 409
+            elif task[0] != scene:
+                request.stream.read()
+                return {'error': 'unknown lease or task'}, 409
+
+            keys = [(scene, light_idx)]
+            with processor.stage('disk_write', keys, 'remote', worker) as info:
+                info['prompt_id'] = request.headers.get('X-Prompt-Id')
+                try:
+                    nbytes = coord._store(scene, light_idx, request.stream, request.content_length)
+                except ValueError as e:
+                    return {'error': str(e)}, 400
+                info['bytes'] = nbytes
+            if output_hash:
+                # The worker hashes what it actually rendered (its prompt text and our pinned settings)
+                manifest.record(scene_dir, {light_idx: (output_hash, processor.current_task(task)[2])})
+
+            if late:
+                coord.table.complete_late(lease_id, light_idx)
+            elif coord.table.complete(lease_id, light_idx):
+                metrics.INFLIGHT.dec(backend='remote', instance=worker)
+            metrics.TASKS.inc(backend='remote', outcome='done')
+            with job_queue.transaction():
+                job_queue.update_task_status(scene, light_idx - 1, 'done')
+                job_queue.update_job(scene, 'processing', light_idx)
+            print(f"  [Coordinator] {worker} finished {scene} - light{light_idx} ({nbytes} bytes)")
+            return {'ok': True, 'bytes': nbytes}
+
+        @app.route('/api/fail/<lease_id>', methods=['POST'])
+        def fail(lease_id):
+            payload = request.get_json(silent=True) or {}
+            worker = payload.get('worker') or request.remote_addr
+            indices = [int(i) for i in payload.get('light_indices', [])]
+            retryable = bool(payload.get('retryable'))
+            metrics.ERRORS.inc(backend='remote', stage='instance' if retryable else 'task', instance=worker)
+            print(f"  [Coordinator] {worker} failed {payload.get('scene')} {indices}: {payload.get('error')}")
+
+            # Only tasks still held by the live lease count: an expired lease was already requeued
+            released, given_up = coord.table.fail(lease_id, indices, retryable)
+            metrics.INFLIGHT.dec(len(released), backend='remote', instance=worker)
+            given_up_keys = {(t[0], t[1]) for t in given_up}
+            job_queue.mark_many((t[0], t[1] - 1, 'error' if (t[0], t[1]) in given_up_keys else 'pending')
+                                for t in released)
+            metrics.TASKS.inc(len(given_up), backend='remote', outcome='error')
+            metrics.RETRIES.inc(len(released) - len(given_up), backend='remote', reason='instance' if retryable else 'error')
+            return {'ok': True, 'given_up': len(given_up)}
+
+        return app
+
+    def _store(self, scene, light_idx, stream, expected=None):
+        """
+        Stream the upload to a temp file and rename it into place only once it is complete and
+        its PNG chunks check out: a cut-off upload never replaces a good image. ValueError for
+        a bad upload.
+        """
+        scene_dir = os.path.join(processor.OUTPUT_DIR, scene)
+        os.makedirs(scene_dir, exist_ok=True)
+        path = os.path.join(scene_dir, f"light{light_idx}.png")
+        tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.part"
+        nbytes = 0
+        try:
+            with open(tmp_path, 'wb') as f:
+                while True:
+                    try:
+                        chunk = stream.read(CHUNK_SIZE)
+                    except ClientDisconnected:
+                        chunk = b""  # worker went away mid-upload: caught by the length check below
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    nbytes += len(chunk)
+            # Both checks run on the temp file, before the rename
+            if expected is not None and nbytes != expected:
+                raise ValueError(f"truncated upload ({nbytes} of {expected} bytes)")
+            problem = integrity.check_png(tmp_path)
+            if problem:
+                raise ValueError(f"unusable upload ({problem})")
+            os.replace(tmp_path, path)
+            integrity.mark_verified(path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return nbytes
+
+# =================================================================================
+# ENTRY POINT
+# =================================================================================
+
+def run_coordinator(target_file="all", host="0.0.0.0", port=DEFAULT_PORT, lease_ttl=None, max_attempts=None):
+    if not os.path.exists(processor.OUTPUT_DIR):
+        os.makedirs(processor.OUTPUT_DIR)
+    if not control.live_processors():
+        control.reset()
+        job_queue.reconcile_stale()
+    control.register_processor(f"coordinator:{target_file}")
+    try:
+        prepared = processor.prepare_run(target_file)
+        if prepared is None:
+            return
+        workflow_template, input_cache, scenes, _ = prepared
+        tasks = processor.collect_tasks(scenes)
+        if not tasks:
+            return
+        settings = processor.load_settings()
+        coord = Coordinator(workflow_template, input_cache, tasks,
+                            lease_ttl=float(lease_ttl or settings.get('lease_ttl', 60)),
+                            max_attempts=int(max_attempts or settings.get('max_task_attempts', 3)))
+        stop_exporter = metrics.start_exporter("processor")
+        coord.start(host, port)
+        try:
+            coord.wait()
+        except KeyboardInterrupt:
+            print("Interrupted, releasing leases...")
+        finally:
+            coord.stop(linger=float(settings.get('coordinator_linger', 5)))
+            stop_exporter()
+            integrity.save_cache()
+        print(f"\nCoordinator finished: {coord.table.status()}")
+        processor.report_run_metrics()
+    finally:
+        control.unregister_processor()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Hand out relighting tasks to remote workers")
+    parser.add_argument("--target", type=str, default="all", help="Album name or 'all'")
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--lease-ttl", type=float, help="Seconds a lease survives without a heartbeat (default: settings lease_ttl or 60).")
+    parser.add_argument("--max-attempts", type=int, help="Failed executions per task before it is marked as error.")
+    args = parser.parse_args()
+    run_coordinator(args.target, args.host, args.port, args.lease_ttl, args.max_attempts)
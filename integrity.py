@@ -0,0 +1,275 @@
+import os
+import re
+import json
+import zlib
+import time
+import struct
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import metrics
+
+# Integrity of generated outputs. A killed worker or an interrupted download used to leave
+# truncated lightN.png files that every existence check counted as done.
+#   write_atomic  - outputs are written to a temp file and renamed into place
+#   check_png     - walks the PNG chunks and checks every CRC up to IEND (reads the file once)
+#   decode mode   - additionally decodes the pixels with PIL, on a process pool
+# Files that passed are remembered by (size, mtime) in cache/verified.json, so a verification
+# pass over a dataset that did not change only stats the files. Corrupt outputs are removed;
+# the planner then sees them missing and queues them again.
+#
+#   python integrity.py [--decode] [--workers N] [--force]   (all scenes, without generating)
+
+CACHE_FILE = os.path.join("cache", "verified.json")
+MODES = ("crc", "decode", "off")
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+IEND_CHUNK = b"\x00\x00\x00\x00IEND\xaeB`\x82"
+OUTPUT_RE = re.compile(r"^light([1-9]\d*)\.png$")
+SAVE_EVERY = 500  # new cache entries between saves during a long pass
+
+CACHE_LOCK = threading.Lock()
+_cache = {"data": None, "dirty": 0, "mtime": None}
+
+def png_problem(data):
+    """Why PNG bytes are unusable ('truncated', 'bad CRC in IDAT', ...), or None if they are fine."""
+    if not data.startswith(PNG_SIGNATURE):
+        return "not a PNG"
+    pos = len(PNG_SIGNATURE)
+    view = memoryview(data)
+    while pos + 12 <= len(data):
+        length, = struct.unpack_from(">I", data, pos)
+        end = pos + 12 + length
+        if end > len(data):
+            return "truncated"
+        chunk_type = bytes(view[pos + 4:pos + 8])
+        if zlib.crc32(view[pos + 4:end - 4]) != struct.unpack_from(">I", data, end - 4)[0]:
+            return f"bad CRC in {chunk_type.decode('latin-1')}"
+        if chunk_type == b"IEND":
+            return None
+        pos = end
+    return "truncated"
+
+def check_png(path):
+    try:
+        with open(path, 'rb') as f:
+            return png_problem(f.read())
+    except OSError as e:
+        return str(e)
+
+def decode_problem(path):
+    """CRCs first, then a full decode (run in a worker process)."""
+    problem = check_png(path)
+    if problem:
+        return problem
+    from PIL import Image
+    try:
+        with Image.open(path) as image:
+            image.load()
+    except Exception as e:
+        return f"decode failed: {e}"
+    return None
+
+def looks_complete(path):
+    """Cheap check for status counters: a PNG that ends with its IEND chunk."""
+    try:
+        with open(path, 'rb') as f:
+            f.seek(-len(IEND_CHUNK), os.SEEK_END)
+            return f.read() == IEND_CHUNK
+    except OSError:
+        return False
+
+def write_atomic(path, data):
+    """Write to a temp file and rename it into place: readers never see half a PNG."""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# =================================================================================
+# VERIFIED CACHE
+# =================================================================================
+
+def _cache_key(path):
+    return os.path.relpath(path)
+
+def _load_cache():
+    """The cache (caller holds CACHE_LOCK); re-read when another process saved it and we have nothing unsaved."""
+    try:
+        mtime = os.stat(CACHE_FILE).st_mtime_ns
+    except OSError:
+        mtime = None
+    if _cache["data"] is None or (not _cache["dirty"] and mtime != _cache["mtime"]):
+        try:
+            with open(CACHE_FILE, 'r') as f:
+                _cache["data"] = json.load(f)
+        except (OSError, ValueError):
+            _cache["data"] = {}
+        _cache["mtime"] = mtime
+    return _cache["data"]
+
+def save_cache():
+    with CACHE_LOCK:
+        if not _cache["dirty"]:
+            return
+        os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+        tmp_path = f"{CACHE_FILE}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(_cache["data"], f)
+        os.replace(tmp_path, CACHE_FILE)
+        _cache["dirty"] = 0
+        _cache["mtime"] = os.stat(CACHE_FILE).st_mtime_ns
+
+def _stamp(st):
+    return [st.st_size, st.st_mtime_ns]
+
+def is_verified(path, st=None):
+    try:
+        st = st or os.stat(path)
+    except OSError:
+        return False
+    with CACHE_LOCK:
+        return _load_cache().get(_cache_key(path)) == _stamp(st)
+
+def mark_verified(path, st=None):
+    """Record a file that was checked (or written from checked bytes)."""
+    try:
+        stamp = _stamp(st or os.stat(path))
+    except OSError:
+        return
+    with CACHE_LOCK:
+        _load_cache()[_cache_key(path)] = stamp
+        _cache["dirty"] += 1
+        save_now = _cache["dirty"] >= SAVE_EVERY
+    if save_now:
+        save_cache()
+
+def output_complete(path):
+    """Verified and unchanged since, or at least not cut short."""
+    return is_verified(path) or looks_complete(path)
+
+def forget(path):
+    with CACHE_LOCK:
+        if _load_cache().pop(_cache_key(path), None) is not None:
+            _cache["dirty"] += 1
+
+# =================================================================================
+# VERIFICATION PASS
+# =================================================================================
+
+class OutputVerifier:
+    """
+    Checks the outputs of whole scenes in parallel: scenes on a thread pool (reads and CRCs,
+    zlib releases the GIL), decodes on a process pool in 'decode' mode. Unchanged files that
+    passed before are skipped.
+    """
+    def __init__(self, mode="crc", workers=None, force=False):
+        if mode not in MODES:
+            raise ValueError(f"Unknown verify mode: {mode}")
+        self.mode = mode
+        self.force = force
+        self.workers = workers or min(8, os.cpu_count() or 1)
+        self.threads = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="verify")
+        self.processes = ProcessPoolExecutor(max_workers=self.workers) if mode == "decode" else None
+        self.lock = threading.Lock()
+        self.checked = 0
+        self.skipped = 0
+        self.corrupt = []
+
+    def _check(self, path):
+        if self.processes:
+            return self.processes.submit(decode_problem, path).result()
+        return check_png(path)
+
+    def verify_scene(self, scene_dir):
+        """Check one scene; corrupt outputs are removed. Returns the names removed."""
+        removed = []
+        try:
+            with os.scandir(scene_dir) as it:
+                entries = [e for e in it if OUTPUT_RE.match(e.name)]
+        except OSError:
+            return removed
+        for entry in entries:
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            if not self.force and is_verified(entry.path, st):
+                with self.lock:
+                    self.skipped += 1
+                continue
+            problem = self._check(entry.path)
+            with self.lock:
+                self.checked += 1
+            if problem is None:
+                mark_verified(entry.path, st)
+                continue
+            print(f"Corrupt output {os.path.basename(scene_dir)}/{entry.name} ({problem}): removed, will be regenerated")
+            try:
+                os.remove(entry.path)
+            except OSError:
+                continue
+            forget(entry.path)
+            metrics.ERRORS.inc(backend='disk', stage='corrupt_output')
+            removed.append(entry.name)
+            with self.lock:
+                self.corrupt.append(entry.path)
+        return removed
+
+    def verify_albums(self, albums, output_dir, depth=None):
+        """
+        Passes scene names through, each one only after its outputs were verified. Up to
+        `depth` scenes are checked ahead in parallel, so a lazy walk stays lazy. None (an
+        idle producer) flushes what is in flight and is passed on.
+        """
+        depth = depth or 2 * self.workers
+        pending = deque()
+
+        def ready():
+            scene_done, future = pending.popleft()
+            future.result()
+            return scene_done
+
+        for scene in albums:
+            if scene is None:
+                while pending:
+                    yield ready()
+                save_cache()
+                yield None
+                continue
+            pending.append((scene, self.threads.submit(self.verify_scene, os.path.join(output_dir, scene))))
+            while pending and (len(pending) > depth or pending[0][1].done()):
+                yield ready()
+        while pending:
+            yield ready()
+        save_cache()
+
+    def summary(self):
+        return f"{self.checked} checked, {self.skipped} unchanged, {len(self.corrupt)} corrupt"
+
+    def close(self):
+        self.threads.shutdown(wait=True)
+        if self.processes:
+            self.processes.shutdown(wait=True)
+        save_cache()
+
+if __name__ == "__main__":
+    import argparse
+    import normalizer
+    parser = argparse.ArgumentParser(description="Verify generated outputs; corrupt ones are removed for regeneration")
+    parser.add_argument("--decode", action="store_true", help="Decode every image as well (slower, process pool).")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--force", action="store_true", help="Re-check files that passed before.")
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    verifier = OutputVerifier("decode" if args.decode else "crc", args.workers, args.force)
+    with os.scandir(normalizer.OUTPUT_DIR) as entries:
+        scenes = [e.name for e in entries if e.is_dir()]
+    for _ in verifier.verify_albums(scenes, normalizer.OUTPUT_DIR):
+        pass
+    verifier.close()
+    print(f"Verified {len(scenes)} scenes in {time.monotonic() - started:.1f}s: {verifier.summary()}")
@@ -2,11 +2,15 @@ import os
 import json
 import threading
 import time
+import metrics
+import integrity
+from contextlib import contextmanager
 
 # Simple in-memory queue for V2
 # Structure: { scene_name: { status: 'queued'|'processing'|'done', progress: 0, total: 25 } }
 OUTPUT_DATASET_DIR = "output_dataset"
-QUEUE_LOCK = threading.Lock()
+QUEUE_LOCK = threading.RLock()
+_txn = threading.local()
 
 # Persistence file
 JOBS_FILE = "jobs.json"
@@ -14,12 +18,45 @@ JOBS_FILE = "jobs.json"
 def load_jobs():
     if os.path.exists(JOBS_FILE):
         try:
-            with open(JOBS_FILE, 'r') as f:
-                return json.load(f)
+            with metrics.timed('jobs_load'):
+                with open(JOBS_FILE, 'r') as f:
+                    return json.load(f)
         except:
             return {}
     return {}
 
+@contextmanager
+def transaction():
+    """
+    Load jobs.json once, yield the dict, write it back once on exit. Nested transactions (and
+    the update helpers below, which all run inside one) share the outermost load/save, so
+    `with transaction(): ...` around many updates costs a single rewrite of the file.
+    The file is only rewritten if something changed: code that edits the yielded dict directly
+    calls mark_dirty() (the helpers below do, and only for real changes).
+    """
+    with QUEUE_LOCK:
+        if getattr(_txn, 'jobs', None) is not None:
+            yield _txn.jobs
+            return
+        _txn.jobs = load_jobs()
+        _txn.dirty = False
+        try:
+            yield _txn.jobs
+            if _txn.dirty:
+                save_jobs(_txn.jobs)
+        finally:
+            _txn.jobs = None
+            _txn.dirty = False
+
+def mark_dirty():
+    """Inside a transaction: the jobs dict was changed and has to be written back."""
+    _txn.dirty = True
+
+def _set(entry, key, value):
+    if entry.get(key) != value:
+        entry[key] = value
+        mark_dirty()
+
 def clear_all_jobs():
     with QUEUE_LOCK:
         if os.path.exists(JOBS_FILE):
@@ -31,10 +68,11 @@ def clear_all_jobs():
 
 def save_jobs(jobs):
     try:
-        with open(JOBS_FILE, 'w') as f:
-            json.dump(jobs, f, indent=2)
+        with metrics.timed('jobs_write'):
+            with open(JOBS_FILE, 'w') as f:
+                json.dump(jobs, f, indent=2)
     except:
-        pass
+        metrics.ERRORS.inc(backend='job_queue', stage='jobs_write')
 
 # Structure: { 
 #   scene_name: { 
@@ -46,36 +84,87 @@ def save_jobs(jobs):
 # }
 
 def update_job(scene_name, status, progress=None):
-    with QUEUE_LOCK:
-        jobs = load_jobs()
+    with transaction() as jobs:
         if scene_name not in jobs:
             jobs[scene_name] = {'total': 25, 'tasks': []}
+            mark_dirty()
         
-        jobs[scene_name]['status'] = status
+        _set(jobs[scene_name], 'status', status)
         if progress is not None:
-             jobs[scene_name]['progress'] = progress
-        
-        save_jobs(jobs)
+             _set(jobs[scene_name], 'progress', progress)
 
 def set_job_tasks(scene_name, task_list):
-    with QUEUE_LOCK:
-        jobs = load_jobs()
-        if scene_name not in jobs:
-            jobs[scene_name] = {'total': len(task_list), 'status': 'queued', 'progress': 0}
-        
-        # task_list is list of strings (prompts)
-        jobs[scene_name]['tasks'] = [{'prompt': p, 'status': 'pending'} for p in task_list]
-        jobs[scene_name]['total'] = len(task_list)
-        save_jobs(jobs)
+    set_many({scene_name: task_list})
+
+def set_many(scene_tasks, statuses=None):
+    """
+    scene_tasks: {scene_name: [prompt, ...]} -> fresh task lists, all 'pending' unless
+    statuses ({scene_name: {task_index: status}}) says otherwise. One write for all scenes.
+    """
+    statuses = statuses or {}
+    with transaction() as jobs:
+        for scene_name, task_list in scene_tasks.items():
+            if scene_name not in jobs:
+                jobs[scene_name] = {'total': len(task_list), 'status': 'queued', 'progress': 0}
+                mark_dirty()
+            
+            # task_list is list of strings (prompts)
+            scene_statuses = statuses.get(scene_name, {})
+            _set(jobs[scene_name], 'tasks', [{'prompt': p, 'status': scene_statuses.get(i, 'pending')}
+                                             for i, p in enumerate(task_list)])
+            _set(jobs[scene_name], 'total', len(task_list))
+
+def register_scenes(scene_names, task_list):
+    """Adds freshly approved scenes with pending tasks in a single load/save."""
+    with transaction() as jobs:
+        for scene_name in scene_names:
+            jobs[scene_name] = {
+                'total': len(task_list),
+                'status': 'queued',
+                'progress': 0,
+                'tasks': [{'prompt': p, 'status': 'pending'} for p in task_list],
+            }
+            mark_dirty()
 
 def update_task_status(scene_name, task_index, status):
-    with QUEUE_LOCK:
-        jobs = load_jobs()
-        if scene_name in jobs and 'tasks' in jobs[scene_name]:
-            tasks = jobs[scene_name]['tasks']
-            if 0 <= task_index < len(tasks):
-                tasks[task_index]['status'] = status
-                save_jobs(jobs)
+    mark_many([(scene_name, task_index, status)])
+
+def mark_many(updates):
+    """updates: iterable of (scene_name, task_index, status), applied with one write."""
+    with transaction() as jobs:
+        for scene_name, task_index, status in updates:
+            if scene_name in jobs and 'tasks' in jobs[scene_name]:
+                tasks = jobs[scene_name]['tasks']
+                if 0 <= task_index < len(tasks):
+                    _set(tasks[task_index], 'status', status)
+
+def reconcile_stale():
+    """
+    Tasks left in 'processing' by a processor that died or was killed: mark them done if
+    their output exists, otherwise back to pending. Only call when no processor is running.
+    """
+    with transaction() as jobs:
+        changed = 0
+        for scene_name, job in jobs.items():
+            tasks = job.get('tasks', [])
+            for i, task in enumerate(tasks):
+                if task.get('status') != 'processing':
+                    continue
+                done = os.path.exists(os.path.join(OUTPUT_DATASET_DIR, scene_name, f"light{i + 1}.png"))
+                task['status'] = 'done' if done else 'pending'
+                changed += 1
+            if job.get('status') == 'processing':
+                job['status'] = 'done' if tasks and all(t['status'] == 'done' for t in tasks) else 'queued'
+                changed += 1
+        if changed:
+            mark_dirty()
+        return changed
+
+def cancel_scene_tasks(scene_name):
+    """Marks a scene cancelled in the UI; its unfinished tasks stay pending for a later run."""
+    with transaction() as jobs:
+        if scene_name in jobs:
+            _set(jobs[scene_name], 'status', 'cancelled')
 
 def get_job_status(scene_name):
     jobs = load_jobs()
@@ -92,6 +181,25 @@ def get_job_status(scene_name):
         
     return {'status': 'unknown', 'progress': 0, 'total': 25, 'tasks': []}
 
+# scene dir -> (dir mtime, finished outputs). Outputs are renamed into place, so the directory
+# mtime changes whenever one appears or goes; unchanged scenes cost a single stat per poll.
+_progress_cache = {}
+
+def finished_outputs(scene_dir):
+    """Number of lightN outputs that are really finished (a truncated lightN.png is not)."""
+    try:
+        mtime = os.stat(scene_dir).st_mtime_ns
+    except OSError:
+        return 0
+    hit = _progress_cache.get(scene_dir)
+    if hit and hit[0] == mtime:
+        return hit[1]
+    files = [f for f in os.listdir(scene_dir) if f.startswith('light') and f.lower().endswith(('.jpg', '.png', '.jpeg'))
+             and (f.startswith('light0') or integrity.output_complete(os.path.join(scene_dir, f)))]
+    count = max(0, len(files) - 1) # Subtract light0
+    _progress_cache[scene_dir] = (mtime, count)
+    return count
+
 def scan_all_jobs():
     """Refreshes status for all folders in output_dataset"""
     # Return all jobs in memory (for granular queue view) plus any on disk not in memory
@@ -101,15 +209,12 @@ def scan_all_jobs():
         return jobs
         
     # Merge disk info if needed (optional, mostly relevant for fresh start)
-    for scene_name in os.listdir(OUTPUT_DATASET_DIR):
-        path = os.path.join(OUTPUT_DATASET_DIR, scene_name)
-        if os.path.isdir(path):
+    with os.scandir(OUTPUT_DATASET_DIR) as entries:
+        scene_dirs = [(e.name, e.path) for e in entries if e.is_dir()]
+    for scene_name, path in scene_dirs:
              # Force sync with disk
              job = jobs.get(scene_name, {'status': 'idle', 'progress': 0, 'total': 25, 'tasks': []})
-             
-             # Count actually finished files
-             files = [f for f in os.listdir(path) if f.startswith('light') and f.lower().endswith(('.jpg', '.png', '.jpeg'))]
-             real_progress = max(0, len(files) - 1) # Subtract light0
+             real_progress = finished_outputs(path)
              
              # If disk shows more progress, update memory
              if real_progress > job.get('progress', 0):
@@ -0,0 +1,119 @@
+import os
+import json
+import hashlib
+import threading
+
+# Per-scene record of what produced each output, kept next to the images:
+#   output_dataset/<scene>/manifest.json = {"light7.png": {"hash": "...", "prompt": "..."}, ...}
+# The hash covers everything that decides an image except the random seed: the full prompt
+# (system prompt + lighting prompt), plus the sampler settings and the workflow template for
+# ComfyUI outputs, or the model for Flux API outputs (which never see either).
+# An output whose recorded hash matches none of the current ones is stale; positions that
+# still match are left alone, so editing one prompt regenerates one image per scene.
+
+MANIFEST_NAME = "manifest.json"
+LEGACY_NAME = "legacy_prompts.json"
+MANIFEST_LOCK = threading.Lock()
+
+def workflow_digest(workflow_template):
+    return hashlib.sha256(json.dumps(workflow_template, sort_keys=True).encode()).hexdigest()
+
+def output_hash(full_prompt, params, workflow_digest):
+    blob = json.dumps({'prompt': full_prompt, 'params': params, 'workflow': workflow_digest}, sort_keys=True)
+    return hashlib.sha256(blob.encode()).hexdigest()[:16]
+
+def output_name(light_idx):
+    return f"light{light_idx}.png"
+
+def _current(recorded, digest):
+    # digest: one hash, or a tuple of hashes that all count as current (one per backend)
+    return recorded == digest if isinstance(digest, str) else recorded in digest
+
+def load(scene_dir):
+    try:
+        with open(os.path.join(scene_dir, MANIFEST_NAME), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save(scene_dir, data):
+    path = os.path.join(scene_dir, MANIFEST_NAME)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def record(scene_dir, entries):
+    """entries: {light_idx: (hash, prompt)} for outputs that were just written."""
+    if not entries:
+        return
+    with MANIFEST_LOCK:
+        data = load(scene_dir)
+        for light_idx, (digest, prompt) in entries.items():
+            data[output_name(light_idx)] = {'hash': digest, 'prompt': prompt}
+        _save(scene_dir, data)
+
+def is_current(scene_dir, light_idx, digest):
+    """True if the output exists and was produced by exactly this hash (or one of these hashes)."""
+    name = output_name(light_idx)
+    if not os.path.exists(os.path.join(scene_dir, name)):
+        return False
+    return _current(load(scene_dir).get(name, {}).get('hash'), digest)
+
+def legacy_prompts(output_dir):
+    """
+    {light_idx: prompt} of outputs that predate manifests. Every run rewrites metadata.json, so
+    it is read once, by the first manifest-aware run, and kept in legacy_prompts.json. If scenes
+    already have manifests when that happens, metadata.json may already hold newer prompts:
+    nothing is adopted then and unrecorded outputs count as outdated.
+    """
+    path = os.path.join(output_dir, LEGACY_NAME)
+    try:
+        with open(path, 'r') as f:
+            return {int(k): v for k, v in json.load(f).items()}
+    except (OSError, ValueError):
+        pass
+    prompts = {}
+    if not os.path.isdir(output_dir):
+        return prompts
+    with os.scandir(output_dir) as entries:
+        manifest_era = any(e.is_dir() and os.path.exists(os.path.join(e.path, MANIFEST_NAME)) for e in entries)
+    if not manifest_era:
+        try:
+            with open(os.path.join(output_dir, "metadata.json"), 'r') as f:
+                for key, prompt in json.load(f).items():
+                    if key.startswith("light") and key[5:].isdigit() and key != "light0":
+                        prompts[int(key[5:])] = prompt
+        except (OSError, ValueError):
+            pass
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(prompts, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+    return prompts
+
+def stale_outputs(scene_dir, expected, legacy_prompts=None):
+    """
+    expected: {light_idx: (hash or tuple of hashes, prompt)} for the current configuration.
+    Returns (missing, outdated) light indices. Outputs that predate manifests (no entry) are
+    adopted when legacy_prompts (see legacy_prompts()) shows they used the same prompt.
+    """
+    legacy_prompts = legacy_prompts or {}
+    with MANIFEST_LOCK:
+        data = load(scene_dir)
+        missing, outdated, adopted = [], [], {}
+        for light_idx, (digest, prompt) in expected.items():
+            name = output_name(light_idx)
+            if not os.path.exists(os.path.join(scene_dir, name)):
+                missing.append(light_idx)
+            elif name in data:
+                if not _current(data[name].get('hash'), digest):
+                    outdated.append(light_idx)
+            elif legacy_prompts.get(light_idx) == prompt:
+                adopted[name] = {'hash': digest if isinstance(digest, str) else digest[0], 'prompt': prompt}
+            else:
+                outdated.append(light_idx)
+        if adopted:
+            data.update(adopted)
+            _save(scene_dir, data)
+    return missing, outdated
@@ -0,0 +1,253 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# Lightweight in-process metrics: counters, gauges and histograms with labels.
+# processor.py writes periodic snapshots to METRICS_DIR/processor.json; app.py merges them
+# with its own registry and serves everything in Prometheus text format at /metrics.
+
+METRICS_DIR = "metrics"
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+def _key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def snapshot(self):
+        with self.lock:
+            samples = [{"labels": dict(k), "value": v} for k, v in self.values.items()]
+        return {"type": self.kind, "help": self.help, "samples": samples}
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = _key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[_key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = _key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = _key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = {"buckets": [0] * len(self.buckets), "count": 0, "sum": 0.0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry["buckets"][i] += 1
+            entry["count"] += 1
+            entry["sum"] += value
+
+    def snapshot(self):
+        with self.lock:
+            samples = [{"labels": dict(k), "value": {"buckets": list(v["buckets"]), "count": v["count"], "sum": v["sum"]}}
+                       for k, v in self.values.items()]
+        return {"type": self.kind, "help": self.help, "buckets": list(self.buckets), "samples": samples}
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def _get(self, cls, name, help_text, **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, help_text, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, help_text):
+        return self._get(Counter, name, help_text)
+
+    def gauge(self, name, help_text):
+        return self._get(Gauge, name, help_text)
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help_text, buckets=buckets)
+
+    def snapshot(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {"timestamp": time.time(), "metrics": {m.name: m.snapshot() for m in metrics}}
+
+REGISTRY = Registry()
+
+# =================================================================================
+# STANDARD METRICS
+# =================================================================================
+
+STAGE_SECONDS = REGISTRY.histogram("relight_stage_seconds", "Time spent per pipeline stage")
+TASKS = REGISTRY.counter("relight_tasks_total", "Generation tasks by backend and outcome")
+ERRORS = REGISTRY.counter("relight_errors_total", "Errors by backend and stage")
+RETRIES = REGISTRY.counter("relight_retries_total", "Retried operations by backend")
+INFLIGHT = REGISTRY.gauge("relight_inflight_tasks", "Tasks currently being generated per ComfyUI instance / API slot")
+API_CREDITS = REGISTRY.counter("relight_api_credits_total", "Credits charged by the BFL API (submit `cost` field)")
+ROUTER_LATENCY = REGISTRY.gauge("relight_router_latency_seconds", "Smoothed per-task latency the hybrid router uses per backend")
+INSTANCE_UP = REGISTRY.gauge("relight_instance_up", "1 if the ComfyUI instance is connected, 0 while its circuit is open")
+INSTANCE_QUEUE = REGISTRY.gauge("relight_instance_queue_depth", "Prompts running or pending on a ComfyUI instance (its /queue)")
+INSTANCE_STEP_SECONDS = REGISTRY.gauge("relight_instance_step_seconds", "Smoothed seconds per sampler step the dispatcher uses per instance")
+INSTANCE_WARMUP_SECONDS = REGISTRY.gauge("relight_instance_warmup_seconds", "Warm-up prompt latency per ComfyUI instance (phase cold = with model load, warm = resident)")
+INSTANCE_VRAM_FREE = REGISTRY.gauge("relight_instance_vram_free_bytes", "Free VRAM reported by a ComfyUI instance's /system_stats")
+
+@contextmanager
+def timed(stage, **labels):
+    """Observe the duration of the block in relight_stage_seconds{stage=...}."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage, **labels)
+
+# =================================================================================
+# EXPORT
+# =================================================================================
+
+def write_snapshot(name, registry=REGISTRY):
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"{name}.json")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(registry.snapshot(), f)
+    os.replace(tmp_path, path)
+    return path
+
+def load_snapshot(name):
+    path = os.path.join(METRICS_DIR, f"{name}.json")
+    if os.path.exists(path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except:
+            return None
+    return None
+
+def start_exporter(name, interval=5.0, registry=REGISTRY):
+    """Write `name` snapshots every `interval` seconds until the returned stop() is called."""
+    stop_event = threading.Event()
+
+    def loop():
+        while not stop_event.wait(interval):
+            try:
+                write_snapshot(name, registry)
+            except OSError as e:
+                print(f"Metrics export failed: {e}")
+
+    t = threading.Thread(target=loop, daemon=True)
+    t.start()
+
+    def stop():
+        stop_event.set()
+        t.join()
+        write_snapshot(name, registry)
+
+    return stop
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    inner = ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in sorted(labels.items()))
+    return "{" + inner + "}"
+
+def render_prometheus(snapshots):
+    """
+    snapshots: { process_name: snapshot }. Samples of the same metric from different
+    processes are merged under one HELP/TYPE header with an extra `process` label.
+    """
+    merged = {}
+    for process, snap in snapshots.items():
+        if not snap:
+            continue
+        for name, metric in snap["metrics"].items():
+            entry = merged.setdefault(name, {"type": metric["type"], "help": metric["help"],
+                                             "buckets": metric.get("buckets"), "samples": []})
+            for sample in metric["samples"]:
+                entry["samples"].append((dict(sample["labels"], process=process), sample["value"]))
+
+    lines = []
+    for name in sorted(merged):
+        metric = merged[name]
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for labels, value in metric["samples"]:
+            if metric["type"] == "histogram":
+                for bound, count in zip(metric["buckets"], value["buckets"]):
+                    lines.append(f"{name}_bucket{_format_labels(dict(labels, le=bound))} {count}")
+                lines.append(f"{name}_bucket{_format_labels(dict(labels, le='+Inf'))} {value['count']}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {value['sum']}")
+                lines.append(f"{name}_count{_format_labels(labels)} {value['count']}")
+            else:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+def _bucket_quantile(buckets, counts, total, q):
+    """Linear interpolation inside the histogram bucket containing quantile q."""
+    if total == 0:
+        return 0.0
+    target = q * total
+    lower = 0.0
+    prev = 0
+    for bound, count in zip(buckets, counts):
+        if count >= target:
+            span = count - prev
+            return lower + (bound - lower) * ((target - prev) / span if span else 0)
+        lower, prev = bound, count
+    return buckets[-1]
+
+def summary(registry=REGISTRY):
+    """Compact JSON-able run summary: per-stage latency plus counter/gauge totals."""
+    snap = registry.snapshot()["metrics"]
+    result = {"stages": {}, "counters": {}, "gauges": {}}
+
+    stage_metric = snap.get(STAGE_SECONDS.name)
+    if stage_metric:
+        for sample in stage_metric["samples"]:
+            labels = sample["labels"]
+            stage = labels.pop("stage", "unknown")
+            key = stage + _format_labels(labels)
+            v = sample["value"]
+            result["stages"][key] = {
+                "count": v["count"],
+                "total_s": round(v["sum"], 4),
+                "mean_s": round(v["sum"] / v["count"], 4) if v["count"] else 0.0,
+                "p50_s": round(_bucket_quantile(stage_metric["buckets"], v["buckets"], v["count"], 0.5), 4),
+                "p99_s": round(_bucket_quantile(stage_metric["buckets"], v["buckets"], v["count"], 0.99), 4),
+            }
+
+    for name, metric in snap.items():
+        if metric["type"] in ("counter", "gauge"):
+            target = result["counters"] if metric["type"] == "counter" else result["gauges"]
+            for sample in metric["samples"]:
+                target[name + _format_labels(sample["labels"])] = sample["value"]
+    return result
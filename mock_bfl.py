@@ -0,0 +1,173 @@
+import io
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image
+
+# Offline stand-in for the BFL API: POST /v1/<model> submits, GET /v1/get_result polls,
+# GET /samples/<id>.png downloads. Generation time, HTTP latency, failures, the
+# active-task limit (429) and per-request cost are configurable through profiles.
+
+PROFILES = {
+    "fast":         {"generation_time": 0.05},
+    "default":      {"generation_time": 0.5},
+    "realistic":    {"generation_time": 15.0, "jitter": 0.3, "latency": 0.05},
+    "flaky":        {"generation_time": 0.5, "jitter": 0.3, "failure_rate": 0.1},
+    "rate-limited": {"generation_time": 0.5, "max_active": 4},
+}
+
+def make_png(size=(64, 64), color=(200, 170, 120)):
+    buffered = io.BytesIO()
+    Image.new("RGB", size, color).save(buffered, format="PNG")
+    return buffered.getvalue()
+
+class MockBFL:
+    def __init__(self, host="127.0.0.1", port=0, generation_time=0.5, latency=0.0, jitter=0.0,
+                 failure_rate=0.0, max_active=None, cost=1.0, seed=None):
+        self.generation_time = generation_time
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.max_active = max_active   # like BFL's cap on concurrently active tasks
+        self.cost = cost
+        self.rng = random.Random(seed)
+        self.png_bytes = make_png()
+
+        self.lock = threading.Lock()
+        self.tasks = {}  # id -> {"ready_at": t, "failed": bool}
+        self.submitted = 0
+        self.failures = 0
+        self.rejected = 0
+        self.spent = 0.0
+
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+
+    @classmethod
+    def from_profile(cls, name="default", **overrides):
+        params = dict(PROFILES[name])
+        params.update(overrides)
+        return cls(**params)
+
+    @property
+    def api_url(self):
+        return f"{self.url}/v1/flux-2-pro"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _active(self, now):
+        return sum(1 for t in self.tasks.values() if t["ready_at"] > now)
+
+    def _submit(self):
+        now = time.time()
+        with self.lock:
+            if self.max_active is not None and self._active(now) >= self.max_active:
+                self.rejected += 1
+                return None
+            scale = 1.0 + self.rng.uniform(-self.jitter, self.jitter) if self.jitter else 1.0
+            task_id = str(uuid.uuid4())
+            failed = self.rng.random() < self.failure_rate
+            self.tasks[task_id] = {"ready_at": now + self.generation_time * scale, "failed": failed}
+            self.submitted += 1
+            self.spent += self.cost
+            if failed:
+                self.failures += 1
+        return task_id
+
+    def _result(self, task_id):
+        with self.lock:
+            task = self.tasks.get(task_id)
+        if task is None:
+            return {"id": task_id, "status": "Task not found"}
+        if time.time() < task["ready_at"]:
+            return {"id": task_id, "status": "Pending"}
+        if task["failed"]:
+            return {"id": task_id, "status": "Error", "details": "mock failure"}
+        return {"id": task_id, "status": "Ready", "result": {"sample": f"{self.url}/samples/{task_id}.png"}}
+
+    def _handler_class(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _json(self, obj, code=200):
+                body = json.dumps(obj).encode('utf-8')
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if mock.latency:
+                    time.sleep(mock.latency)
+                parsed = urllib.parse.urlparse(self.path)
+                params = urllib.parse.parse_qs(parsed.query)
+
+                if parsed.path == "/v1/get_result":
+                    return self._json(mock._result(params.get("id", [""])[0]))
+                if parsed.path.startswith("/samples/"):
+                    body = mock.png_bytes
+                    self.send_response(200)
+                    self.send_header("Content-Type", "image/png")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+                self._json({"detail": "Not Found"}, 404)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                if length:
+                    self.rfile.read(length)
+                if mock.latency:
+                    time.sleep(mock.latency)
+
+                if not self.headers.get("x-key"):
+                    return self._json({"detail": "Missing x-key"}, 403)
+                if self.path.startswith("/v1/"):
+                    task_id = mock._submit()
+                    if task_id is None:
+                        return self._json({"detail": "Too many active tasks"}, 429)
+                    return self._json({
+                        "id": task_id,
+                        "polling_url": f"{mock.url}/v1/get_result?id={task_id}",
+                        "cost": mock.cost,
+                    })
+                self._json({"detail": "Not Found"}, 404)
+
+        return Handler
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock BFL API server for offline testing")
+    parser.add_argument("--port", type=int, default=8200)
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="default")
+    parser.add_argument("--generation-time", type=float, help="Seconds until a submitted task is Ready.")
+    parser.add_argument("--failure-rate", type=float, help="Probability a task ends in Error.")
+    args = parser.parse_args()
+
+    overrides = {k: v for k, v in (("generation_time", args.generation_time), ("failure_rate", args.failure_rate)) if v is not None}
+    mock = MockBFL.from_profile(args.profile, port=args.port, **overrides)
+    mock.start()
+    print(f"Mock BFL API listening on {mock.api_url} (set api_url in settings.json)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        mock.stop()
@@ -0,0 +1,393 @@
+import io
+import json
+import time
+import uuid
+import base64
+import socket
+import struct
+import hashlib
+import argparse
+import threading
+import queue
+import random
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image
+
+# Offline stand-in for a ComfyUI instance: /prompt, /ws, /history, /view, /queue and /system_stats.
+# Executions run one at a time (like a single GPU) and cost
+#   prompt_overhead + image_time * <number of SaveImage nodes>
+# seconds, so batched workflows can be compared against one-prompt-per-execution.
+# Profiles add HTTP latency, timing jitter, random execution errors and queue-full (429) rejections.
+# The first execution after start also pays `load_time` (models loading into VRAM), like a cold instance.
+# With `previews`, every step sends a binary preview frame (ComfyUI --preview-method) derived from
+# the LoadImage input; a `bad_rate` share of generations goes black or loses the scene structure.
+# /interrupt stops the running prompt.
+
+WS_MAGIC = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+PROFILES = {
+    "fast":         {"prompt_overhead": 0.02, "image_time": 0.01},
+    "default":      {"prompt_overhead": 0.2, "image_time": 0.05},
+    "realistic":    {"prompt_overhead": 2.0, "image_time": 8.0, "latency": 0.005, "jitter": 0.2, "load_time": 20.0},
+    "flaky":        {"prompt_overhead": 0.2, "image_time": 0.05, "jitter": 0.3, "failure_rate": 0.1},
+    "rate-limited": {"prompt_overhead": 0.2, "image_time": 0.05, "max_queue": 2},
+    "bad-samples":  {"prompt_overhead": 0.05, "image_time": 0.4, "previews": True, "bad_rate": 0.3},
+}
+
+def ws_frame(payload, opcode=0x1):
+    header = bytes([0x80 | opcode])
+    n = len(payload)
+    if n < 126:
+        header += bytes([n])
+    elif n < 65536:
+        header += bytes([126]) + struct.pack('>H', n)
+    else:
+        header += bytes([127]) + struct.pack('>Q', n)
+    return header + payload
+
+def make_png(size=(64, 64), color=(128, 96, 64)):
+    buffered = io.BytesIO()
+    Image.new("RGB", size, color).save(buffered, format="PNG")
+    return buffered.getvalue()
+
+def make_preview(source, step, steps, failure, rng, size=(64, 64)):
+    """JPEG preview at this step: the input relit and denoising as steps go by, or a failing sample."""
+    if failure == "black":
+        image = Image.new("L", size, 2)
+    elif failure == "noise" or source is None:
+        image = Image.frombytes("L", size, bytes(rng.getrandbits(8) for _ in range(size[0] * size[1])))
+    else:
+        noise = Image.frombytes("L", size, bytes(rng.getrandbits(8) for _ in range(size[0] * size[1])))
+        relit = source.point(lambda v: min(255, int(v * 0.7 + 40)))
+        image = Image.blend(noise, relit, step / steps)
+    buffered = io.BytesIO()
+    image.save(buffered, format="JPEG", quality=80)
+    return buffered.getvalue()
+
+class WebSocketConnection:
+    def __init__(self, handler):
+        self.handler = handler
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def send_json(self, message):
+        self.send(json.dumps(message).encode('utf-8'), 0x1)
+
+    def send(self, payload, opcode=0x2):
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                self.handler.wfile.write(ws_frame(payload, opcode))
+                self.handler.wfile.flush()
+            except OSError:
+                self.closed = True
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        try:
+            self.handler.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def read_until_closed(self):
+        rfile = self.handler.rfile
+        while not self.closed:
+            try:
+                head = rfile.read(2)
+                if len(head) < 2:
+                    break
+                opcode = head[0] & 0x0F
+                length = head[1] & 0x7F
+                if length == 126:
+                    length = struct.unpack('>H', rfile.read(2))[0]
+                elif length == 127:
+                    length = struct.unpack('>Q', rfile.read(8))[0]
+                mask = rfile.read(4) if head[1] & 0x80 else b'\x00' * 4
+                data = bytes(b ^ mask[i % 4] for i, b in enumerate(rfile.read(length)))
+                if opcode == 0x8:
+                    self.send(b'', 0x8)
+                    break
+                if opcode == 0x9:
+                    self.send(data, 0xA)
+            except OSError:
+                break
+        self.closed = True
+
+class MockComfyUI:
+    def __init__(self, host="127.0.0.1", port=0, prompt_overhead=0.2, image_time=0.05, png_size=(64, 64),
+                 latency=0.0, jitter=0.0, failure_rate=0.0, max_queue=None, seed=None, load_time=0.0,
+                 previews=False, bad_rate=0.0):
+        self.prompt_overhead = prompt_overhead
+        self.image_time = image_time
+        self.latency = latency            # added to every HTTP response
+        self.jitter = jitter              # +/- fraction applied to execution time
+        self.failure_rate = failure_rate  # probability an execution ends in execution_error
+        self.max_queue = max_queue        # /prompt answers 429 beyond this many waiting prompts
+        self.load_time = load_time        # one-off model load before the first execution
+        self.loaded = False
+        self.previews = previews          # binary preview frame every step
+        self.bad_rate = bad_rate          # probability a generation goes black / loses structure
+        self.interrupt_id = None
+        self.interrupted = 0
+        self.rng = random.Random(seed)
+        self.png_bytes = make_png(png_size)
+
+        self.lock = threading.Lock()
+        self.clients = {}      # client_id -> WebSocketConnection
+        self.history = {}      # prompt_id -> {"outputs": {...}}
+        self.pending = queue.Queue()
+        self.running = None    # prompt_id currently executing
+        self.counter = 0
+        self.executions = 0
+        self.images = 0
+
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+        self.threads = []
+        self.failures = 0
+        self.rejected = 0
+
+    @classmethod
+    def from_profile(cls, name="default", **overrides):
+        params = dict(PROFILES[name])
+        params.update(overrides)
+        return cls(**params)
+
+    # -------------------------------------------------------------------------
+    # Lifecycle
+    # -------------------------------------------------------------------------
+
+    def start(self):
+        for target in (self.server.serve_forever, self._executor):
+            t = threading.Thread(target=target, daemon=True)
+            t.start()
+            self.threads.append(t)
+        return self.url
+
+    def stop(self):
+        self.pending.put(None)
+        self.server.shutdown()
+        self.server.server_close()
+        # Drop open websockets too, like a crashed/restarted instance
+        for conn in list(self.clients.values()):
+            conn.close()
+
+    # -------------------------------------------------------------------------
+    # Execution
+    # -------------------------------------------------------------------------
+
+    def _send(self, client_id, message):
+        conn = self.clients.get(client_id)
+        if conn is not None:
+            conn.send_json(message)
+
+    def _executor(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            prompt_id, client_id, workflow = item
+            self.interrupt_id = None
+            self.running = prompt_id
+            try:
+                self._execute(prompt_id, client_id, workflow)
+            finally:
+                self.running = None
+
+    def _execute(self, prompt_id, client_id, workflow):
+        save_nodes = [nid for nid, node in workflow.items() if node.get("class_type") == "SaveImage"]
+        steps = max([int(n["inputs"].get("steps", 1)) for n in workflow.values()
+                     if n.get("class_type") == "Flux2Scheduler" and isinstance(n["inputs"].get("steps"), int)] or [1])
+
+        scale = 1.0 + self.rng.uniform(-self.jitter, self.jitter) if self.jitter else 1.0
+        failing = self.rng.random() < self.failure_rate
+        bad = self.rng.choice(["black", "noise"]) if self.rng.random() < self.bad_rate else None
+        source = self._preview_source(workflow) if self.previews else None
+
+        self._send(client_id, {"type": "execution_start", "data": {"prompt_id": prompt_id}})
+        if not self.loaded:
+            time.sleep(self.load_time)
+            self.loaded = True
+        time.sleep(self.prompt_overhead * scale)
+
+        step_time = self.image_time * scale * len(save_nodes) / steps
+        for step in range(1, steps + 1):
+            if failing and step > steps // 2:
+                return self._fail(prompt_id, client_id, workflow)
+            if self.interrupt_id == prompt_id:
+                return self._interrupted(prompt_id, client_id, workflow)
+            time.sleep(step_time)
+            self._send(client_id, {"type": "progress", "data": {"value": step, "max": steps, "prompt_id": prompt_id}})
+            if self.previews:
+                conn = self.clients.get(client_id)
+                if conn is not None:
+                    conn.send(struct.pack(">II", 1, 1) + make_preview(source, step, steps, bad, self.rng))
+
+        outputs = {}
+        for node_id in save_nodes:
+            with self.lock:
+                self.counter += 1
+                prefix = workflow[node_id]["inputs"].get("filename_prefix", "ComfyUI")
+                filename = f"{prefix}_{self.counter:05d}_.png"
+            outputs[node_id] = {"images": [{"filename": filename, "subfolder": "", "type": "output"}]}
+            self._send(client_id, {"type": "executing", "data": {"node": node_id, "prompt_id": prompt_id}})
+            self._send(client_id, {"type": "executed", "data": {"node": node_id, "output": outputs[node_id], "prompt_id": prompt_id}})
+
+        with self.lock:
+            self.history[prompt_id] = {"prompt": workflow, "outputs": outputs, "status": {"status_str": "success", "completed": True}}
+            self.executions += 1
+            self.images += len(save_nodes)
+        self._send(client_id, {"type": "executing", "data": {"node": None, "prompt_id": prompt_id}})
+
+    def _preview_source(self, workflow):
+        for node in workflow.values():
+            if node.get("class_type") == "LoadImage":
+                try:
+                    return Image.open(node["inputs"]["image"]).convert("L").resize((64, 64))
+                except (OSError, KeyError, TypeError):
+                    return None
+        return None
+
+    def _interrupted(self, prompt_id, client_id, workflow):
+        with self.lock:
+            self.history[prompt_id] = {"prompt": workflow, "outputs": {}, "status": {"status_str": "error", "completed": False}}
+            self.executions += 1
+            self.interrupted += 1
+        self._send(client_id, {"type": "execution_interrupted", "data": {"prompt_id": prompt_id, "node_id": "13"}})
+        self._send(client_id, {"type": "executing", "data": {"node": None, "prompt_id": prompt_id}})
+
+    def _fail(self, prompt_id, client_id, workflow):
+        # Same message order as ComfyUI: execution_error, then the final executing/None
+        with self.lock:
+            self.history[prompt_id] = {"prompt": workflow, "outputs": {}, "status": {"status_str": "error", "completed": False}}
+            self.executions += 1
+            self.failures += 1
+        self._send(client_id, {"type": "execution_error", "data": {
+            "prompt_id": prompt_id, "node_id": "13", "node_type": "SamplerCustomAdvanced",
+            "exception_message": "mock failure", "exception_type": "RuntimeError"}})
+        self._send(client_id, {"type": "executing", "data": {"node": None, "prompt_id": prompt_id}})
+
+    # -------------------------------------------------------------------------
+    # HTTP
+    # -------------------------------------------------------------------------
+
+    def _handler_class(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _json(self, obj, code=200):
+                body = json.dumps(obj).encode('utf-8')
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if mock.latency:
+                    time.sleep(mock.latency)
+                parsed = urllib.parse.urlparse(self.path)
+                params = urllib.parse.parse_qs(parsed.query)
+
+                if parsed.path == "/ws":
+                    return self._websocket(params.get("clientId", [str(uuid.uuid4())])[0])
+                if parsed.path.startswith("/history/"):
+                    prompt_id = parsed.path[len("/history/"):]
+                    with mock.lock:
+                        entry = mock.history.get(prompt_id)
+                    return self._json({prompt_id: entry} if entry else {})
+                if parsed.path == "/system_stats":
+                    return self._json({"system": {"os": "mock", "python_version": "mock"},
+                                       "devices": [{"name": "mock", "type": "cuda", "index": 0,
+                                                    "vram_total": 24 * 2**30, "vram_free": 16 * 2**30}]})
+                if parsed.path == "/queue":
+                    with mock.pending.mutex:
+                        waiting = [item[0] for item in mock.pending.queue if item is not None]
+                    running = mock.running
+                    return self._json({"queue_running": [[0, running, {}, {}, []]] if running else [],
+                                       "queue_pending": [[i + 1, pid, {}, {}, []] for i, pid in enumerate(waiting)]})
+                if parsed.path == "/view":
+                    body = mock.png_bytes
+                    self.send_response(200)
+                    self.send_header("Content-Type", "image/png")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+                self._json({"error": "not found"}, 404)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length) if length else b''
+                if mock.latency:
+                    time.sleep(mock.latency)
+
+                if self.path == "/interrupt":
+                    data = json.loads(body or b'{}')
+                    running = mock.running
+                    if running and data.get("prompt_id") in (None, running):
+                        mock.interrupt_id = running
+                    return self._json({})
+                if self.path == "/prompt":
+                    if mock.max_queue is not None and mock.pending.qsize() >= mock.max_queue:
+                        with mock.lock:
+                            mock.rejected += 1
+                        return self._json({"error": {"type": "queue_full", "message": "Too many queued prompts"}}, 429)
+                    data = json.loads(body or b'{}')
+                    prompt_id = str(uuid.uuid4())
+                    mock.pending.put((prompt_id, data.get("client_id"), data.get("prompt", {})))
+                    return self._json({"prompt_id": prompt_id, "number": mock.pending.qsize(), "node_errors": {}})
+                self._json({"error": "not found"}, 404)
+
+            def _websocket(self, client_id):
+                key = self.headers.get("Sec-WebSocket-Key", "")
+                accept = base64.b64encode(hashlib.sha1((key + WS_MAGIC).encode()).digest()).decode()
+                self.send_response(101)
+                self.send_header("Upgrade", "websocket")
+                self.send_header("Connection", "Upgrade")
+                self.send_header("Sec-WebSocket-Accept", accept)
+                self.end_headers()
+                self.wfile.flush()
+
+                conn = WebSocketConnection(self)
+                mock.clients[client_id] = conn
+                conn.send_json({"type": "status", "data": {"status": {"exec_info": {"queue_remaining": mock.pending.qsize()}}, "sid": client_id}})
+                conn.read_until_closed()
+                if mock.clients.get(client_id) is conn:
+                    del mock.clients[client_id]
+                self.close_connection = True
+
+        return Handler
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock ComfyUI server for offline testing")
+    parser.add_argument("--port", type=int, default=8188)
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="default")
+    parser.add_argument("--prompt-overhead", type=float, help="Seconds of fixed cost per execution.")
+    parser.add_argument("--image-time", type=float, help="Seconds per generated image.")
+    parser.add_argument("--failure-rate", type=float, help="Probability of an execution_error.")
+    parser.add_argument("--load-time", type=float, help="Seconds of model load before the first execution.")
+    parser.add_argument("--bad-rate", type=float, help="Probability a generation fails visibly (implies previews).")
+    args = parser.parse_args()
+
+    overrides = {k: v for k, v in (("prompt_overhead", args.prompt_overhead), ("image_time", args.image_time),
+                                   ("failure_rate", args.failure_rate), ("load_time", args.load_time),
+                                   ("bad_rate", args.bad_rate)) if v is not None}
+    if args.bad_rate is not None:
+        overrides["previews"] = True
+    mock = MockComfyUI.from_profile(args.profile, port=args.port, **overrides)
+    print(f"Mock ComfyUI listening on {mock.start()}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        mock.stop()
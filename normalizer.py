@@ -0,0 +1,161 @@
+import os
+import math
+import json
+import base64
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+from PIL import Image, ImageOps
+
+# Ingest-time normalization of light0 inputs.
+# Every scene's light0 is resized once to the workflow's pixel count (aspect ratio kept, never
+# cropped, so outputs stay aligned with the original light0), stripped of metadata and stored
+# as a JPEG under cache/light0/<W>x<H>-fit/<scene>.jpg. Workers then reuse
+# the encoded bytes (and their base64 form for the Flux API) instead of re-encoding per prompt.
+
+OUTPUT_DIR = os.path.abspath("output_dataset")
+CACHE_DIR = os.path.abspath(os.path.join("cache", "light0"))
+WORKFLOW_FILE = "workflow_api.json"
+
+NODE_ID_FLUX_SCHEDULER = "48"  # Flux2Scheduler carries the target width/height
+DEFAULT_TARGET_SIZE = (1248, 832)
+JPEG_QUALITY = 92
+
+NormalizedInput = namedtuple("NormalizedInput", ["path", "jpeg_bytes", "b64", "digest"])
+
+def target_size_from_workflow(workflow=None):
+    """(width, height) the scheduler node renders at, falling back to 1248x832."""
+    if workflow is None:
+        try:
+            with open(WORKFLOW_FILE, 'r') as f:
+                workflow = json.load(f)
+        except:
+            return DEFAULT_TARGET_SIZE
+    try:
+        inputs = workflow[NODE_ID_FLUX_SCHEDULER]["inputs"]
+        return int(inputs["width"]), int(inputs["height"])
+    except (KeyError, TypeError, ValueError):
+        return DEFAULT_TARGET_SIZE
+
+def find_light0(scene_dir):
+    if not os.path.isdir(scene_dir):
+        return None
+    for f in os.listdir(scene_dir):
+        if f.startswith("light0."):
+            return os.path.join(scene_dir, f)
+    return None
+
+def _size_dir(target_size):
+    # "-fit": inputs cached before aspect-preserving resizing were center-crops; never reuse them
+    width, height = target_size
+    return os.path.join(CACHE_DIR, f"{width}x{height}-fit")
+
+def normalized_path(scene_name, target_size):
+    return os.path.join(_size_dir(target_size), f"{scene_name}.jpg")
+
+def fit_size(size, target_size):
+    """size scaled to about target_size's pixel count, aspect ratio kept (like ImageScaleToTotalPixels)."""
+    scale = math.sqrt(target_size[0] * target_size[1] / (size[0] * size[1]))
+    return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+def normalize_image(src, dst, target_size):
+    """
+    Resize src to about target_size's pixel count and write a metadata-free JPEG to dst.
+    Nothing is cropped: the output has to line up pixel for pixel with the original light0.
+    """
+    with Image.open(src) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        size = fit_size(img.size, target_size)
+        if size != img.size:
+            img = img.resize(size, Image.LANCZOS)
+
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        # Unique per writer: the app (at approve) and a resident processor may normalize the same scene
+        tmp_path = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+        # No exif/icc_profile kwargs -> metadata is dropped
+        img.save(tmp_path, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+    os.replace(tmp_path, dst)
+    return dst
+
+def ensure_normalized(scene_name, target_size=None, output_dir=None):
+    """
+    Returns the normalized light0 path for scene_name, (re)building it if the cache is
+    missing or older than the source. None if the scene has no light0.
+    """
+    target_size = target_size or target_size_from_workflow()
+    src = find_light0(os.path.join(output_dir or OUTPUT_DIR, scene_name))
+    if src is None:
+        return None
+
+    dst = normalized_path(scene_name, target_size)
+    try:
+        if os.path.getmtime(dst) >= os.path.getmtime(src):
+            return dst
+    except OSError:
+        pass
+    return normalize_image(src, dst, target_size)
+
+def warmup_image(target_size=None):
+    """Flat gray input at the workflow resolution for instance warm-up prompts (written once)."""
+    width, height = target_size or target_size_from_workflow()
+    dst = os.path.join(_size_dir((width, height)), "_warmup.jpg")
+    if not os.path.exists(dst):
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp_path = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+        Image.new("RGB", (width, height), (128, 128, 128)).save(tmp_path, format="JPEG", quality=JPEG_QUALITY)
+        os.replace(tmp_path, dst)
+    return dst
+
+def normalize_scenes(scene_names, target_size=None, output_dir=None):
+    """Ingest hook: normalize a batch of scenes, logging (not raising) per-scene failures."""
+    target_size = target_size or target_size_from_workflow()
+    for scene_name in scene_names:
+        try:
+            ensure_normalized(scene_name, target_size, output_dir)
+        except Exception as e:
+            print(f"Normalization failed for {scene_name}: {e}")
+
+class InputCache:
+    """
+    Bounded in-memory cache of per-scene encoded inputs (path, JPEG bytes, base64, content digest).
+    Tasks for a scene arrive back to back, so a small LRU holds the whole working set.
+    """
+    def __init__(self, target_size=None, output_dir=None, max_entries=64):
+        self.target_size = target_size or target_size_from_workflow()
+        self.output_dir = output_dir
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # scene -> (mtime, NormalizedInput)
+
+    def get(self, scene_name):
+        path = ensure_normalized(scene_name, self.target_size, self.output_dir)
+        if path is None:
+            return None
+        mtime = os.path.getmtime(path)
+
+        with self.lock:
+            hit = self.entries.get(scene_name)
+            if hit and hit[0] == mtime:
+                self.entries.move_to_end(scene_name)
+                return hit[1]
+
+        with open(path, 'rb') as f:
+            jpeg_bytes = f.read()
+        payload = NormalizedInput(path, jpeg_bytes, base64.b64encode(jpeg_bytes).decode(),
+                                  hashlib.sha1(jpeg_bytes).hexdigest()[:16])
+
+        with self.lock:
+            self.entries[scene_name] = (mtime, payload)
+            self.entries.move_to_end(scene_name)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return payload
+
+    def invalidate(self, scene_name=None):
+        with self.lock:
+            if scene_name is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(scene_name, None)
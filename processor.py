@@ -6,17 +6,29 @@ import os
 import shutil
 import time
 import job_queue
+import control
+import config
+from config import CONFIG
+import normalizer
+import manifest
+import metrics
+import trace_log
+import quality
+import integrity
 import websocket # pip install websocket-client
 import uuid
 import sys
 import threading
 import queue
 import socket
+import struct
 import requests
 import base64
 from io import BytesIO
 from PIL import Image
 from websocket import create_connection
+from contextlib import contextmanager
+from collections import namedtuple, deque
 
 # =================================================================================
 # CONFIGURATION
@@ -39,23 +51,44 @@ NODE_ID_FLUX_SCHEDULER = "48"  # Flux2Scheduler (Steps)
 NODE_ID_FLUX_GUIDANCE = "26"   # FluxGuidance (CFG)
 NODE_ID_SAMPLER_SELECT = "16"  # KSamplerSelect (Sampler)
 
-SETTINGS_FILE = "settings.json"
+SETTINGS_FILE = config.SETTINGS_FILE
+
+@contextmanager
+def stage(name, tasks, backend, instance=None):
+    """
+    Time one pipeline stage into both the metrics histogram and the JSONL trace
+    (one trace record per (album, light_idx) in tasks). Yields the trace info dict.
+    """
+    labels = {'backend': backend}
+    if instance:
+        labels['instance'] = instance
+    with metrics.timed(name, **labels):
+        with trace_log.span(name, tasks, backend, instance) as info:
+            yield info
 
 def load_settings():
-    if os.path.exists(SETTINGS_FILE):
-        try:
-            with open(SETTINGS_FILE, 'r') as f:
-                return json.load(f)
-        except:
-             return {}
-    return {}
+    # Served from the in-memory cache; re-read only when settings.json changes
+    return CONFIG.settings()
 
 # =================================================================================
 # COMFYUI API CLIENT
 # =================================================================================
 
+class InstanceError(Exception):
+    """The ComfyUI instance is unreachable or stopped responding (retry elsewhere / later)."""
+
+class ExecutionError(Exception):
+    """ComfyUI accepted the prompt but reported a failure while running it."""
+
+class EarlyAbort(Exception):
+    """A sampler preview showed the generation failing; it was interrupted (retry with a new seed)."""
+
+# Binary websocket events (first 4 bytes, big endian)
+WS_PREVIEW_IMAGE = 1
+WS_PREVIEW_IMAGE_WITH_METADATA = 4
+
 class ComfyUIClient:
-    def __init__(self, url):
+    def __init__(self, url, ws_timeout=30, task_timeout=900, http_timeout=30):
         self.url = url
         self.server_address = url.replace('http://', '')
         self.ws = websocket.WebSocket()
@@ -63,97 +96,555 @@ class ComfyUIClient:
         # Fix: Ensure ws_url is correctly formed regardless of trailing slash
         base_ws = url.replace('http', 'ws').rstrip('/')
         self.ws_url = f"{base_ws}/ws?clientId={self.client_id}"
+        self.ws_timeout = ws_timeout      # max silence on the websocket before we poll /history
+        self.task_timeout = task_timeout  # max total wait for one prompt
+        self.http_timeout = http_timeout
 
     def connect(self):
         try:
-            self.ws.connect(self.ws_url)
+            self.ws.connect(self.ws_url, timeout=self.http_timeout)
+            self.ws.settimeout(self.ws_timeout)
             print(f"Connected to ComfyUI WebSocket at {self.url}")
         except Exception as e:
             print(f"Failed to connect to ComfyUI at {self.url}: {e}")
             # We don't exit here, just raise so the worker can handle it
-            raise e
+            raise InstanceError(f"connect failed: {e}") from e
+
+    def close(self):
+        try:
+            self.ws.close()
+        except Exception:
+            pass
+
+    def reconnect(self):
+        self.close()
+        self.ws = websocket.WebSocket()
+        self.connect()
+
+    def health_check(self):
+        """Cheap liveness probe used before closing the circuit breaker again."""
+        try:
+            with urllib.request.urlopen(f"{self.url}/system_stats", timeout=5) as response:
+                return response.status == 200
+        except urllib.error.HTTPError as e:
+            # Older builds / mocks without /system_stats still answer HTTP
+            return e.code == 404
+        except Exception:
+            return False
+
+    def get_queue_depth(self):
+        """Prompts running or waiting on the instance, from any client (/queue)."""
+        with urllib.request.urlopen(f"{self.url}/queue", timeout=5) as response:
+            data = json.loads(response.read())
+        return len(data.get('queue_running', [])) + len(data.get('queue_pending', []))
+
+    def get_system_stats(self):
+        with urllib.request.urlopen(f"{self.url}/system_stats", timeout=5) as response:
+            return json.loads(response.read())
 
     def queue_prompt(self, prompt_workflow):
         p = {"prompt": prompt_workflow, "client_id": self.client_id}
         data = json.dumps(p).encode('utf-8')
         req = urllib.request.Request(f"{self.url}/prompt", data=data)
         try:
-            return json.loads(urllib.request.urlopen(req).read())
+            return json.loads(urllib.request.urlopen(req, timeout=self.http_timeout).read())
         except urllib.error.HTTPError as e:
             print(f"HTTP Error: {e.code} - {e.reason}")
             print(e.read().decode('utf-8'))
-            raise
+            if e.code == 429 or e.code >= 500:
+                raise InstanceError(f"/prompt returned {e.code}") from e
+            raise ExecutionError(f"/prompt rejected the workflow ({e.code})") from e
+        except (urllib.error.URLError, OSError) as e:
+            raise InstanceError(f"/prompt failed: {e}") from e
+
+    def interrupt(self, prompt_id):
+        """Stop prompt_id if it is the one running (older builds interrupt whatever runs)."""
+        data = json.dumps({"prompt_id": prompt_id}).encode('utf-8')
+        req = urllib.request.Request(f"{self.url}/interrupt", data=data, headers={'Content-Type': 'application/json'})
+        try:
+            urllib.request.urlopen(req, timeout=self.http_timeout).read()
+        except (urllib.error.URLError, OSError) as e:
+            raise InstanceError(f"/interrupt failed: {e}") from e
+
+    def _preview_image(self, frame, prompt_id):
+        """Image bytes of a binary preview frame for prompt_id, else None."""
+        if len(frame) < 8:
+            return None
+        event = struct.unpack(">I", frame[:4])[0]
+        if event == WS_PREVIEW_IMAGE:
+            return frame[8:]  # (image type, image); previews go to the client of the running prompt
+        if event == WS_PREVIEW_IMAGE_WITH_METADATA:
+            size = struct.unpack(">I", frame[4:8])[0]
+            try:
+                meta = json.loads(frame[8:8 + size])
+            except ValueError:
+                return None
+            return frame[8 + size:] if meta.get('prompt_id') in (None, prompt_id) else None
+        return None
 
     def get_history(self, prompt_id):
-        with urllib.request.urlopen("http://{}/history/{}".format(self.server_address, prompt_id)) as response:
+        with urllib.request.urlopen("http://{}/history/{}".format(self.server_address, prompt_id), timeout=self.http_timeout) as response:
             return json.loads(response.read())
 
     def get_image(self, filename, subfolder, folder_type):
         data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
         url_values = urllib.parse.urlencode(data)
-        with urllib.request.urlopen("http://{}/view?{}".format(self.server_address, url_values)) as response:
-            return response.read()
+        try:
+            with urllib.request.urlopen("http://{}/view?{}".format(self.server_address, url_values), timeout=self.http_timeout) as response:
+                return response.read()
+        except (urllib.error.URLError, OSError) as e:
+            raise InstanceError(f"/view failed: {e}") from e
+
+    def _history_outputs(self, prompt_id):
+        """Outputs from /history if the prompt already finished (e.g. we missed the ws message)."""
+        try:
+            entry = self.get_history(prompt_id).get(prompt_id)
+        except Exception as e:
+            raise InstanceError(f"/history failed: {e}") from e
+        if not entry:
+            return None
+        status = entry.get('status', {})
+        if status.get('status_str') == 'error':
+            raise ExecutionError(f"ComfyUI reported an error for {prompt_id}")
+        return entry.get('outputs', {})
 
-    def wait_for_completion(self, prompt_id):
+    def wait_for_completion(self, prompt_id, on_preview=None):
+        """
+        Outputs of prompt_id once it finished. on_preview(image_bytes, step, total) sees each
+        sampler preview (ComfyUI started with --preview-method); if it returns a reason, the
+        prompt is interrupted and EarlyAbort raised.
+        """
         outputs = {}
+        step = total = 0
+        deadline = time.monotonic() + self.task_timeout
         while True:
             try:
                 out = self.ws.recv()
-                if isinstance(out, str):
-                    message = json.loads(out)
-                    if message['type'] == 'executing':
-                        data = message['data']
-                        if data['node'] is None and data['prompt_id'] == prompt_id:
-                            break # Done!
-                    elif message['type'] == 'executed':
-                        data = message['data']
-                        if data['prompt_id'] == prompt_id:
-                            node = data['node']
-                            output = data['output']
-                            outputs[node] = output
-                else:
-                    continue
+            except websocket.WebSocketTimeoutException:
+                # Silence: either still sampling, or the finish message was lost
+                finished = self._history_outputs(prompt_id)
+                if finished is not None:
+                    return finished
+                if time.monotonic() > deadline:
+                    raise InstanceError(f"prompt {prompt_id} timed out after {self.task_timeout}s")
+                continue
             except Exception as e:
                 print(f"WebSocket error on {self.url}: {e}")
-                raise e
+                raise InstanceError(f"websocket error: {e}") from e
+
+            if isinstance(out, str):
+                message = json.loads(out)
+                if message['type'] == 'executing':
+                    data = message['data']
+                    if data['node'] is None and data['prompt_id'] == prompt_id:
+                        break # Done!
+                elif message['type'] == 'executed':
+                    data = message['data']
+                    if data['prompt_id'] == prompt_id:
+                        node = data['node']
+                        output = data['output']
+                        outputs[node] = output
+                elif message['type'] == 'progress':
+                    data = message['data']
+                    if data.get('prompt_id') == prompt_id:
+                        step, total = data.get('value', 0), data.get('max', 0)
+                elif message['type'] == 'execution_error':
+                    data = message['data']
+                    if data.get('prompt_id') == prompt_id:
+                        raise ExecutionError(f"{data.get('node_type')}: {data.get('exception_message')}")
+                elif message['type'] == 'execution_interrupted':
+                    if message['data'].get('prompt_id') == prompt_id:
+                        raise ExecutionError("interrupted")
+            elif on_preview is not None and step:
+                image = self._preview_image(out, prompt_id)
+                reason = on_preview(image, step, total) if image else None
+                if reason:
+                    self.interrupt(prompt_id)
+                    raise EarlyAbort(reason)
+            if time.monotonic() > deadline:
+                raise InstanceError(f"prompt {prompt_id} timed out after {self.task_timeout}s")
         return outputs
 
+# =================================================================================
+# INSTANCE HEALTH
+# =================================================================================
+
+class CircuitBreaker:
+    """
+    Per-instance breaker. After `threshold` consecutive failures the instance is taken
+    out of rotation; it is probed again after an exponentially growing cooldown.
+    """
+    def __init__(self, threshold=3, base_delay=2.0, max_delay=120.0):
+        self.threshold = threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0.0
+
+    @property
+    def is_open(self):
+        return self.failures >= self.threshold
+
+    def cooldown(self):
+        return max(0.0, self.open_until - time.monotonic())
+
+    def record_success(self):
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0.0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            delay = min(self.max_delay, self.base_delay * (2 ** self.trips))
+            self.trips += 1
+            self.open_until = time.monotonic() + delay
+            return delay
+        return 0.0
+
+# =================================================================================
+# INSTANCE WARM-UP
+# =================================================================================
+
+WARMUP_PREFIX = "relight_warmup"
+
+def build_warmup_workflow(workflow_template):
+    """The production workflow at one sampler step on a flat gray input: loads every model once."""
+    settings = dict(load_settings(), steps=1)
+    image_path = normalizer.warmup_image(normalizer.target_size_from_workflow(workflow_template))
+    workflow = build_workflow(workflow_template, image_path, "warm-up", settings, seed=0)
+    for node in workflow.values():
+        if node.get('class_type') == 'SaveImage':
+            node['inputs']['filename_prefix'] = WARMUP_PREFIX
+    return workflow
+
+class InstanceWarmup:
+    """
+    Warm state per ComfyUI instance, shared by its worker slots. Before the first task on a
+    (re)connected instance, one worker runs the warm-up workflow twice while the others wait:
+    the first run pays the UNET/CLIP/VAE load (cold latency), the second is the resident cost
+    (warm latency). Model load never lands inside a production task or its timeout, and
+    mark_cold() after an instance failure makes the next connect warm up again.
+    """
+    def __init__(self, workflow_template, timeout=1800.0):
+        self.workflow = build_warmup_workflow(workflow_template)
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.instance_locks = {}
+        self.warmed_at = {}   # url -> monotonic time of the last warm-up, absent while cold
+        self.latency = {}     # url -> {'cold': s, 'warm': s}
+
+    def _run(self, client):
+        started = time.monotonic()
+        with stage('warmup', [], 'comfyui', client.url):
+            response = client.queue_prompt(self.workflow)
+            client.wait_for_completion(response['prompt_id'])
+        return time.monotonic() - started
+
+    def ensure_warm(self, client):
+        """Blocks until client's instance is warm. Raises InstanceError if it dies meanwhile."""
+        url = client.url
+        with self.lock:
+            instance_lock = self.instance_locks.setdefault(url, threading.Lock())
+        with instance_lock:
+            if url in self.warmed_at:
+                return
+            task_timeout = client.task_timeout
+            client.task_timeout = max(task_timeout, self.timeout)
+            try:
+                cold = self._run(client)
+                warm = self._run(client)
+            except ExecutionError as e:
+                # The workflow itself fails here; production tasks will report it per task
+                print(f"Warm-up on {url} failed ({e}); continuing without it.")
+                self.warmed_at[url] = time.monotonic()
+                return
+            finally:
+                client.task_timeout = task_timeout
+            self.warmed_at[url] = time.monotonic()
+            self.latency[url] = {'cold': round(cold, 3), 'warm': round(warm, 3)}
+            metrics.INSTANCE_WARMUP_SECONDS.set(cold, instance=url, phase='cold')
+            metrics.INSTANCE_WARMUP_SECONDS.set(warm, instance=url, phase='warm')
+            print(f"Warm-up {url}: cold {cold:.1f}s, warm {warm:.1f}s (model load ~{max(0.0, cold - warm):.1f}s)")
+
+    def mark_cold(self, url, since):
+        """The instance failed under a task started at `since`: re-warm unless that already happened."""
+        with self.lock:
+            if self.warmed_at.get(url, since) <= since:
+                self.warmed_at.pop(url, None)
+
+    def summary(self):
+        with self.lock:
+            return dict(self.latency)
+
+TASK_ATTEMPTS = {}
+TASK_ATTEMPTS_LOCK = threading.Lock()
+EARLY_ABORTS = {}  # (album, light_idx) -> generations aborted from previews
+
+def record_attempt(task):
+    key = (task[0], task[1])
+    with TASK_ATTEMPTS_LOCK:
+        TASK_ATTEMPTS[key] = TASK_ATTEMPTS.get(key, 0) + 1
+        return TASK_ATTEMPTS[key]
+
+def record_early_abort(task):
+    key = (task[0], task[1])
+    with TASK_ATTEMPTS_LOCK:
+        EARLY_ABORTS[key] = EARLY_ABORTS.get(key, 0) + 1
+        return EARLY_ABORTS[key]
+
+def preview_monitor(task, light0, settings):
+    """
+    quality.PreviewMonitor for a single-prompt execution when early_abort is on, else None.
+    A task aborted `early_abort_retries` times runs to the end unwatched.
+    """
+    if not settings.get('early_abort'):
+        return None
+    with TASK_ATTEMPTS_LOCK:
+        if EARLY_ABORTS.get((task[0], task[1]), 0) >= int(settings.get('early_abort_retries', 2)):
+            return None
+    reference = quality.to_gray(light0)
+    return quality.PreviewMonitor(reference, min_structure=float(settings.get('early_abort_min_structure', 0.2)),
+                                  after=float(settings.get('early_abort_after', 0.4)))
+
+def reclaim_tasks(task_queue, tasks, label, reason):
+    """Put unfinished tasks back so another (or the recovered) instance picks them up."""
+    remaining = [t for t in tasks if not os.path.exists(os.path.join(OUTPUT_DIR, t[0], f"light{t[1]}.png"))]
+    job_queue.mark_many((t[0], t[1] - 1, 'pending') for t in remaining)
+    for task in remaining:
+        task_queue.push(task)
+    if remaining:
+        metrics.RETRIES.inc(len(remaining), backend='comfyui', reason=reason)
+        print(f"  [Worker {label}] Re-queued {len(remaining)} task(s) ({reason})")
+
+# =================================================================================
+# INSTANCE DISPATCH
+# =================================================================================
+
+class InstanceDispatcher:
+    """
+    Least-loaded dispatch across ComfyUI instances of different speeds (comfy_dispatch
+    "least_loaded", the default with several instances). Every instance runs `comfy_slots`
+    workers, so its next prompt is already queued when the current one finishes. A worker only
+    takes a task when its instance would finish it before the other instances could work
+    through the whole backlog without it; near the end of a run that leaves the last tasks to
+    the instance with the lowest expected completion time instead of a slow one.
+
+    Expected completion on an instance = (depth + 1) x steps x EWMA seconds per step, where
+    depth is the larger of our tasks in flight there and its /queue (other clients included).
+    Seconds per step are measured per instance from completion spacing, so prompts with
+    different step counts are compared fairly.
+    """
+    def __init__(self, urls, alpha=0.3, poll=2.0):
+        self.lock = threading.Lock()
+        self.alpha = alpha
+        self.poll = poll
+        self.step_time = {url: None for url in urls}
+        self.inflight = {url: 0 for url in urls}
+        self.queue_depth = {url: 0 for url in urls}
+        self.last_done = {url: 0.0 for url in urls}
+        self.up = {url: False for url in urls}
+        self.stop_event = threading.Event()
+        self.monitor = threading.Thread(target=self._poll_instances, daemon=True)
+
+    def start(self):
+        self.monitor.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _poll_instances(self):
+        clients = {url: ComfyUIClient(url) for url in self.step_time}
+        while not self.stop_event.is_set():
+            for url, client in clients.items():
+                try:
+                    depth = client.get_queue_depth()
+                    devices = client.get_system_stats().get('devices') or [{}]
+                except Exception:
+                    continue  # workers notice a dead instance themselves
+                with self.lock:
+                    self.queue_depth[url] = depth
+                metrics.INSTANCE_QUEUE.set(depth, instance=url)
+                if 'vram_free' in devices[0]:
+                    metrics.INSTANCE_VRAM_FREE.set(devices[0]['vram_free'], instance=url)
+            self.stop_event.wait(self.poll)
+
+    def set_up(self, url, up):
+        with self.lock:
+            self.up[url] = up
+
+    def _completion(self, url, steps):
+        depth = max(self.inflight[url], self.queue_depth[url])
+        return (depth + 1) * steps * self.step_time[url]
+
+    def admit(self, url, backlog, steps):
+        """True if the worker for `url` should take the next task now."""
+        with self.lock:
+            if self.step_time[url] is None or backlog <= 0:
+                return True  # pace unknown: take one to measure it
+            others = [u for u in self.step_time if u != url and self.up[u] and self.step_time[u] is not None]
+            if not others:
+                return True
+            # Tasks per second the others manage, and how long they would need for their
+            # current load plus the whole backlog
+            rate = sum(1.0 / (steps * self.step_time[u]) for u in others)
+            drain = (sum(max(self.inflight[u], self.queue_depth[u]) for u in others) + backlog) / rate
+            return self._completion(url, steps) <= drain
+
+    def task_started(self, url):
+        with self.lock:
+            self.inflight[url] += 1
+            return time.monotonic()
+
+    def task_finished(self, url, started, steps=None):
+        """steps: sampler steps the execution ran (all images), None if it did not complete."""
+        with self.lock:
+            self.inflight[url] -= 1
+            now = time.monotonic()
+            # Service time: from submit, or from the previous completion if we queued behind it
+            service = now - max(started, self.last_done[url])
+            self.last_done[url] = now
+            if steps:
+                prev = self.step_time[url]
+                value = service / steps
+                self.step_time[url] = value if prev is None else prev + self.alpha * (value - prev)
+                metrics.INSTANCE_STEP_SECONDS.set(self.step_time[url], instance=url)
+
+    def summary(self):
+        with self.lock:
+            return {url: round(t, 4) if t is not None else None for url, t in self.step_time.items()}
+
+# =================================================================================
+# HYBRID ROUTING
+# =================================================================================
+
+class HybridRouter:
+    """
+    Decides when an API slot may take a task (generation_mode "hybrid", or "api" with a budget).
+    Local ComfyUI workers always pull from the head of the queue. API slots take from the tail,
+    and only when the local instances would not reach that task before an API call finishes it,
+    and the per-run credit budget (api_budget) still covers it. Latencies are EWMAs of measured
+    per-task times; the API cost estimate follows the `cost` reported by submits.
+    """
+    def __init__(self, budget=None, api_latency=30.0, cost_estimate=None, alpha=0.3):
+        self.lock = threading.Lock()
+        self.budget = budget
+        self.alpha = alpha
+        self.latency = {'local': None, 'api': api_latency}
+        self.measured = set()  # backends whose latency is measured rather than the configured prior
+        self.cost_estimate = cost_estimate
+        self.local_workers = 0
+        self.api_inflight = 0
+        self.spent = 0.0
+        self.reserved = 0.0
+
+    def _ewma(self, prev, value):
+        return value if prev is None else prev + self.alpha * (value - prev)
+
+    def _observe(self, backend, seconds):
+        prev = self.latency[backend] if backend in self.measured else None
+        self.latency[backend] = self._ewma(prev, seconds)
+        self.measured.add(backend)
+
+    def local_up(self, delta):
+        with self.lock:
+            self.local_workers += delta
+
+    def record_local(self, seconds_per_task):
+        with self.lock:
+            self._observe('local', seconds_per_task)
+            metrics.ROUTER_LATENCY.set(self.latency['local'], backend='comfyui')
+
+    def admit_api(self, backlog):
+        """Returns ('take', reservation), ('wait', 0) or ('stop', 0) once the budget is spent."""
+        with self.lock:
+            estimate = self.cost_estimate or 0.0
+            if self.budget is not None:
+                if self.cost_estimate is None and self.api_inflight:
+                    return 'wait', 0.0  # price unknown until the first submit reports it: probe with one
+                if self.spent + self.reserved + estimate > self.budget:
+                    return ('wait' if self.api_inflight else 'stop'), 0.0
+            if backlog <= 0:
+                return 'wait', 0.0
+            if self.local_workers > 0:
+                if self.latency['local'] is None:
+                    return 'wait', 0.0  # let the local GPUs establish their pace first
+                local_drain = backlog * self.latency['local'] / self.local_workers
+                if local_drain <= self.latency['api']:
+                    return 'wait', 0.0
+            self.api_inflight += 1
+            self.reserved += estimate
+            return 'take', estimate
+
+    def finish_api(self, reservation, cost=0.0, seconds=None):
+        with self.lock:
+            self.api_inflight -= 1
+            self.reserved -= reservation
+            self.spent += cost
+            if cost:
+                self.cost_estimate = self._ewma(self.cost_estimate, cost)
+            if seconds is not None:
+                self._observe('api', seconds)
+                metrics.ROUTER_LATENCY.set(self.latency['api'], backend='api')
+
+    def summary(self):
+        with self.lock:
+            return {'spent': round(self.spent, 4), 'budget': self.budget, 'latency': dict(self.latency),
+                    'cost_estimate': self.cost_estimate}
+
 # =================================================================================
 # FLUX API CLIENT
 # =================================================================================
 
+FLUX_API_URL = "https://api.bfl.ai/v1/flux-2-pro"
+
 class FluxAPIClient:
-    def __init__(self, api_key):
+    def __init__(self, api_key, api_url=None, poll_interval=1.0):
         self.api_key = api_key
-        self.api_url = "https://api.bfl.ai/v1/flux-2-pro"
+        # Overridable (settings.json "api_url") so mock_bfl.py can stand in for the real endpoint
+        self.api_url = api_url or FLUX_API_URL
+        self.poll_interval = poll_interval
+        self.last_cost = 0.0  # credits charged by the most recent submit (also kept when generation fails)
         
-    def generate_image(self, image_path, prompt, output_path):
-        # 1. Encode Image
-        try:
-            with Image.open(image_path) as img:
-                # Convert to RGB to avoid issues with PNG alpha if needed, 
-                # but API might handle it. Let's stick to simple first.
-                buffered = BytesIO()
-                img.save(buffered, format="JPEG")
-                img_str = base64.b64encode(buffered.getvalue()).decode()
-        except Exception as e:
-            print(f"Error preparing image {image_path}: {e}")
-            raise e
+    def generate_image(self, image_path, prompt, output_path, img_str=None, task=None):
+        # task: optional (album, light_idx) used to label trace records
+        tasks = [task] if task else []
+        self.last_cost = 0.0
+        # 1. Encode Image (skipped when the caller passes a pre-encoded base64 payload)
+        if img_str is None:
+            try:
+                with Image.open(image_path) as img:
+                    # Convert to RGB to avoid issues with PNG alpha if needed, 
+                    # but API might handle it. Let's stick to simple first.
+                    buffered = BytesIO()
+                    img.save(buffered, format="JPEG")
+                    img_str = base64.b64encode(buffered.getvalue()).decode()
+            except Exception as e:
+                print(f"Error preparing image {image_path}: {e}")
+                raise e
 
         # 2. Submit Request
         try:
-            response = requests.post(
-                self.api_url,
-                headers={
-                    'accept': 'application/json',
-                    'x-key': self.api_key,
-                    'Content-Type': 'application/json',
-                },
-                json={
-                    'prompt': prompt,
-                    'input_image': img_str,
-                },
-            ).json()
+            with stage('api_submit', tasks, 'api') as info:
+                response = requests.post(
+                    self.api_url,
+                    headers={
+                        'accept': 'application/json',
+                        'x-key': self.api_key,
+                        'Content-Type': 'application/json',
+                    },
+                    json={
+                        'prompt': prompt,
+                        'input_image': img_str,
+                    },
+                ).json()
+                info['prompt_id'] = response.get('id')
+                info['bytes'] = len(img_str)
+            if response.get('cost') is not None:
+                self.last_cost = float(response['cost'])
+                metrics.API_CREDITS.inc(self.last_cost)
         except Exception as e:
              print(f"API Request Failed: {e}")
              raise e
@@ -166,8 +657,9 @@ class FluxAPIClient:
         polling_url = response["polling_url"]
         
         # 3. Poll for Completion
+        poll_start = time.monotonic()
         while True:
-            time.sleep(1) # Polling interval
+            time.sleep(self.poll_interval) # Polling interval
             try:
                 result = requests.get(
                     polling_url,
@@ -180,11 +672,22 @@ class FluxAPIClient:
                 
                 status = result.get('status')
                 if status == 'Ready':
+                    poll_end = time.monotonic()
+                    metrics.STAGE_SECONDS.observe(poll_end - poll_start, stage='gpu_wait', backend='api')
+                    trace_log.record('gpu_wait', tasks, 'api', poll_start, poll_end, prompt_id=request_id)
                     # Download result
                     sample_url = result['result']['sample']
-                    img_data = requests.get(sample_url).content
-                    with open(output_path, 'wb') as f:
-                        f.write(img_data)
+                    with stage('download', tasks, 'api') as info:
+                        img_data = requests.get(sample_url).content
+                        info['prompt_id'] = request_id
+                        info['bytes'] = len(img_data)
+                    problem = integrity.png_problem(img_data)
+                    if problem:
+                        raise Exception(f"Downloaded image is unusable: {problem}")
+                    with stage('disk_write', tasks, 'api') as info:
+                        integrity.write_atomic(output_path, img_data)
+                        info['bytes'] = len(img_data)
+                    integrity.mark_verified(output_path)
                     return True
                 elif status in ['Error', 'Failed', 'Request Too Large']:
                     raise Exception(f"Generation failed: {result}")
@@ -199,206 +702,597 @@ class FluxAPIClient:
 
 
 # =================================================================================
-# MAIN LOGIC
+# WORKFLOW BUILDING
 # =================================================================================
 
-LIGHTING_PROMPTS_FILE = "lighting_prompts.txt"
-SYSTEM_PROMPT_FILE = "system_prompt.txt"
-
-def load_text_file(filepath):
-    if os.path.exists(filepath):
-        with open(filepath, 'r') as f:
-            return [line.strip() for line in f if line.strip()]
-    return []
-
-def load_single_text_file(filepath):
-    if os.path.exists(filepath):
-        with open(filepath, 'r') as f:
-            return f.read().strip()
-    return ""
-
-# Load Prompts
-LIGHTING_PROMPTS = load_text_file(LIGHTING_PROMPTS_FILE)
-# If empty, fallback (optional, or just leave empty)
-if not LIGHTING_PROMPTS:
-    # Minimal fallback or empty
-    LIGHTING_PROMPTS = ["soft lighting"]
-    
-SYSTEM_PROMPT = load_single_text_file(SYSTEM_PROMPT_FILE)
-# Fallback for system prompt
-if not SYSTEM_PROMPT:
-    SYSTEM_PROMPT = "High quality architectural photography, photorealistic, 8k."
+def new_seed():
+    return int(time.time() * 1000) % 10000000000000
+
+def full_prompt(prompt_text):
+    return f"{SYSTEM_PROMPT} \n Relight the scene with: {prompt_text}"
+
+def generation_params(settings):
+    """The settings that change the generated image (and therefore its output hash)."""
+    return {
+        'steps': int(settings.get('steps', 18)),
+        'cfg': float(settings.get('cfg', 4)),
+        'sampler_name': settings.get('sampler_name', 'euler'),
+    }
 
-def worker_thread(client_url, task_queue, workflow_template):
+def api_params(settings):
+    """What decides a Flux API image besides prompt and input: only the model (endpoint) it runs."""
+    return {'backend': 'api', 'model': (settings.get('api_url') or FLUX_API_URL).rstrip('/').rsplit('/', 1)[-1]}
+
+def output_hash(prompt_text, settings, workflow_digest, backend='comfyui'):
     """
-    Worker function to process tasks from the queue using a specific ComfyUI client.
+    Hash recorded in the scene manifest for an output generated with this prompt. ComfyUI outputs
+    also depend on the sampler settings and workflow; API outputs never see either.
     """
-    try:
-        client = ComfyUIClient(client_url)
-        client.connect()
-    except Exception as e:
-        print(f"Worker for {client_url} failed to connect: {e}")
-        return
+    if backend == 'api':
+        return manifest.output_hash(full_prompt(prompt_text), api_params(settings), None)
+    return manifest.output_hash(full_prompt(prompt_text), generation_params(settings), workflow_digest)
 
-    print(f"Worker started for {client_url}")
+def current_hashes(prompt_text, settings, workflow_digest):
+    """Every hash an output of this prompt can carry and still be current, whichever backend made it."""
+    return (output_hash(prompt_text, settings, workflow_digest),
+            output_hash(prompt_text, settings, workflow_digest, 'api'))
 
-    while True:
-        try:
-            # Get task from queue (non-blocking if possible, but we wait effectively)
-            # We use a timeout to check for exit signals if needed, or just block
-            task = task_queue.get(timeout=2) 
-        except queue.Empty:
-            # If queue is empty, we are done
-            break
+def build_workflow(workflow_template, image_path, prompt_text, settings, seed=None):
+    """Clone the template and fill in input image, prompt, seed and sampler settings."""
+    workflow = json.loads(json.dumps(workflow_template))
 
-        album_name, light_idx, prompt_text = task
-        
-        # Construct expected file path
-        scene_output_dir = os.path.join(OUTPUT_DIR, album_name)
-        save_path = os.path.join(scene_output_dir, f"light{light_idx}.png")
-        
-        try:
-            # 1. Double check existence (race condition redundant check but safe)
-            if os.path.exists(save_path):
-                 job_queue.update_task_status(album_name, light_idx - 1, 'done')
-                 job_queue.update_job(album_name, 'processing', light_idx)
-                 task_queue.task_done()
-                 continue
+    # Set Input Image
+    for node_id in NODE_IDS_LOAD_IMAGE:
+        if node_id in workflow:
+            workflow[node_id]["inputs"]["image"] = image_path
+            workflow[node_id]["inputs"]["upload"] = "image"
 
-            # 2. Get Input Image
-            light0_file = None
-            for f in os.listdir(scene_output_dir):
-                 if f.startswith("light0."):
-                     light0_file = f
-                     break
-            
-            if not light0_file:
-                print(f"  [Worker {client_url}] Skipping {album_name}: No light0 found.")
+    # Set Prompt
+    if NODE_ID_PROMPT_TEXT in workflow:
+        workflow[NODE_ID_PROMPT_TEXT]["inputs"]["text"] = full_prompt(prompt_text)
+
+    # Set Random Seed
+    if NODE_ID_RANDOM_NOISE in workflow:
+        workflow[NODE_ID_RANDOM_NOISE]["inputs"]["noise_seed"] = seed if seed is not None else new_seed()
+
+    # Settings
+    params = generation_params(settings)
+    if NODE_ID_FLUX_SCHEDULER in workflow:
+        workflow[NODE_ID_FLUX_SCHEDULER]["inputs"]["steps"] = params['steps']
+    if NODE_ID_FLUX_GUIDANCE in workflow:
+        workflow[NODE_ID_FLUX_GUIDANCE]["inputs"]["guidance"] = params['cfg']
+    if NODE_ID_SAMPLER_SELECT in workflow:
+        workflow[NODE_ID_SAMPLER_SELECT]["inputs"]["sampler_name"] = params['sampler_name']
+
+    return workflow
+
+def variant_node_ids(workflow):
+    """
+    Nodes that differ between lighting variants: the prompt and noise nodes plus
+    everything downstream of them. Loaders, LoadImage and the reference VAEEncode are shared.
+    """
+    consumers = {}
+    for node_id, node in workflow.items():
+        for value in node.get("inputs", {}).values():
+            if isinstance(value, list) and len(value) == 2 and isinstance(value[0], str):
+                consumers.setdefault(value[0], set()).add(node_id)
+
+    pending = [n for n in (NODE_ID_PROMPT_TEXT, NODE_ID_RANDOM_NOISE) if n in workflow]
+    variant = set(pending)
+    while pending:
+        for consumer in consumers.get(pending.pop(), ()):
+            if consumer not in variant:
+                variant.add(consumer)
+                pending.append(consumer)
+    return variant
+
+def build_batched_workflow(workflow_template, image_path, prompt_texts, settings, seeds=None):
+    """
+    One ComfyUI execution for several prompts on the same light0.
+    The per-variant subgraph is cloned as "<node>_<k>" while shared nodes run once,
+    so model loads, image load and the reference VAE encode are not repeated.
+    Returns (workflow, output_nodes) with output_nodes[k] = the clone ids of variant k.
+    """
+    seeds = seeds or [new_seed() + k for k in range(len(prompt_texts))]
+    base = build_workflow(workflow_template, image_path, prompt_texts[0], settings)
+    variant = variant_node_ids(base)
+
+    workflow = {node_id: node for node_id, node in base.items() if node_id not in variant}
+    output_nodes = []
+    for k, (prompt_text, seed) in enumerate(zip(prompt_texts, seeds)):
+        single = build_workflow(workflow_template, image_path, prompt_text, settings, seed)
+        clones = {}
+        for node_id in variant:
+            node = json.loads(json.dumps(single[node_id]))
+            for name, value in node.get("inputs", {}).items():
+                if isinstance(value, list) and len(value) == 2 and value[0] in variant:
+                    node["inputs"][name] = [f"{value[0]}_{k}", value[1]]
+            if node.get("class_type") == "SaveImage":
+                node["inputs"]["filename_prefix"] = f"{node['inputs'].get('filename_prefix', 'relight')}_b{k}"
+            clones[f"{node_id}_{k}"] = node
+        workflow.update(clones)
+        output_nodes.append(set(clones))
+    return workflow, output_nodes
+
+def first_output_image(outputs, node_ids=None):
+    """First image entry among outputs (optionally restricted to node_ids)."""
+    for node_id, node_output in outputs.items():
+        if node_ids is not None and node_id not in node_ids:
+            continue
+        if node_output.get('images'):
+            return node_output['images'][0]
+    return None
+
+# =================================================================================
+# MAIN LOGIC
+# =================================================================================
+
+DEFAULT_LIGHTING_PROMPTS = ["soft lighting"]
+DEFAULT_SYSTEM_PROMPT = "High quality architectural photography, photorealistic, 8k."
+
+# Current prompts; apply_config() swaps them when the files change (between tasks, never mid-task)
+LIGHTING_PROMPTS = DEFAULT_LIGHTING_PROMPTS
+SYSTEM_PROMPT = DEFAULT_SYSTEM_PROMPT
+_config_version = None
+
+def apply_config():
+    """Pick up settings/prompt changes saved while we run. Returns True if anything changed."""
+    global LIGHTING_PROMPTS, SYSTEM_PROMPT, _config_version
+    version = CONFIG.refresh()
+    if version == _config_version:
+        return False
+    LIGHTING_PROMPTS = CONFIG.lighting_prompts() or DEFAULT_LIGHTING_PROMPTS
+    SYSTEM_PROMPT = CONFIG.system_prompt() or DEFAULT_SYSTEM_PROMPT
+    if _config_version is not None:
+        print(f"Configuration reloaded (version {version}): {len(LIGHTING_PROMPTS)} lighting prompts")
+    _config_version = version
+    return True
+
+apply_config()
+
+def current_task(task):
+    """The task with its prompt text as currently configured (prompts may be edited mid-run)."""
+    album_name, light_idx, prompt_text = task
+    if light_idx <= len(LIGHTING_PROMPTS):
+        prompt_text = LIGHTING_PROMPTS[light_idx - 1]
+    return (album_name, light_idx, prompt_text)
+
+def next_batch(task_queue, batch_size, carry):
+    """
+    Pull up to batch_size tasks for the same album. A task for a different album is
+    parked in `carry` and starts the next batch. Returns [] once the queue is drained
+    or a drain was requested. Blocks while paused; drops tasks of cancelled scenes.
+    """
+    while True:
+        if not control.wait_while_paused():
+            # Draining: parked tasks were never started, they stay pending in jobs.json
+            for _ in carry:
                 task_queue.task_done()
+            carry.clear()
+            return []
+
+        if carry:
+            batch = [carry.pop(0)]
+        else:
+            try:
+                # We use a timeout to check for exit signals if needed, or just block
+                batch = [task_queue.get(timeout=0.5)]
+            except queue.Empty:
+                # Empty and the producer is done: we are done
+                if task_queue.exhausted():
+                    return []
                 continue
-                
-            image_path_abs = os.path.abspath(os.path.join(scene_output_dir, light0_file))
 
-            print(f"  [Worker {client_url}] Processing {album_name} - light{light_idx}")
-            job_queue.update_task_status(album_name, light_idx - 1, 'processing')
+        while len(batch) < batch_size:
+            try:
+                task = task_queue.get_nowait()
+            except queue.Empty:
+                break
+            if task[0] != batch[0][0]:
+                carry.append(task)
+                break
+            batch.append(task)
 
-            # 3. Clone & Modify Workflow
-            workflow = json.loads(json.dumps(workflow_template))
-            
-            # Set Input Image
-            for node_id in NODE_IDS_LOAD_IMAGE:
-                if node_id in workflow:
-                    workflow[node_id]["inputs"]["image"] = image_path_abs
-                    workflow[node_id]["inputs"]["upload"] = "image"
-            
-            # Set Prompt
-            if NODE_ID_PROMPT_TEXT in workflow:
-                current_text = SYSTEM_PROMPT
-                workflow[NODE_ID_PROMPT_TEXT]["inputs"]["text"] = f"{current_text} \n Relight the scene with: {prompt_text}"
-            
-            # Set Random Seed
-            if NODE_ID_RANDOM_NOISE in workflow:
-                 workflow[NODE_ID_RANDOM_NOISE]["inputs"]["noise_seed"] = int(time.time() * 1000) % 10000000000000
-            
-            # Settings
-            settings = load_settings()
-            if NODE_ID_FLUX_SCHEDULER in workflow:
-                workflow[NODE_ID_FLUX_SCHEDULER]["inputs"]["steps"] = int(settings.get('steps', 18))
-            if NODE_ID_FLUX_GUIDANCE in workflow:
-                workflow[NODE_ID_FLUX_GUIDANCE]["inputs"]["guidance"] = float(settings.get('cfg', 4))
-            if NODE_ID_SAMPLER_SELECT in workflow:
-                workflow[NODE_ID_SAMPLER_SELECT]["inputs"]["sampler_name"] = settings.get('sampler_name', 'euler')
-
-            # 4. Execute
-            response = client.queue_prompt(workflow)
-            prompt_id = response['prompt_id']
-            outputs = client.wait_for_completion(prompt_id)
-            
-            # Save Output
-            for node_id in outputs:
-                node_output = outputs[node_id]
-                if 'images' in node_output:
-                    img_info = node_output['images'][0]
-                    # Fetch and save
-                    image_data = client.get_image(img_info['filename'], img_info['subfolder'], img_info['type'])
-                    with open(save_path, 'wb') as f:
-                        f.write(image_data)
-                    print(f"  [Worker {client_url}] Finished {album_name} - light{light_idx}")
+        if not control.is_cancelled(batch[0][0]):
+            apply_config()
+            return [current_task(t) for t in batch]
+        metrics.TASKS.inc(len(batch), backend='control', outcome='cancelled')
+        for _ in batch:
+            task_queue.task_done()
+
+def generate_batch(client, workflow_template, image_path, prompt_texts, settings, keys, label, monitor=None):
+    """
+    Run prompt_texts (same input image) as one ComfyUI execution and download the results.
+    Returns (prompt_id, images) with images[k] = PNG bytes for prompt k, or None if it produced nothing.
+    monitor: optional quality.PreviewMonitor for early abort (raises EarlyAbort).
+    """
+    with stage('workflow_build', keys, 'comfyui'):
+        if len(prompt_texts) == 1:
+            workflow = build_workflow(workflow_template, image_path, prompt_texts[0], settings)
+            output_nodes = [None]
+        else:
+            workflow, output_nodes = build_batched_workflow(workflow_template, image_path, prompt_texts, settings)
+
+    with stage('queue_prompt', keys, 'comfyui', label) as info:
+        response = client.queue_prompt(workflow)
+        info['prompt_id'] = response['prompt_id']
+    prompt_id = response['prompt_id']
+    with stage('gpu_wait', keys, 'comfyui', label) as info:
+        info['prompt_id'] = prompt_id
+        outputs = client.wait_for_completion(prompt_id, on_preview=monitor)
+
+    images = []
+    for key, node_ids in zip(keys, output_nodes):
+        img_info = first_output_image(outputs, node_ids)
+        if img_info is None:
+            images.append(None)
+            continue
+        with stage('download', [key], 'comfyui', label) as info:
+            image_data = client.get_image(img_info['filename'], img_info['subfolder'], img_info['type'])
+            info.update(prompt_id=prompt_id, bytes=len(image_data))
+        images.append(image_data)
+    return prompt_id, images
+
+def run_local_batch(client, batch, workflow_template, input_cache, label):
+    """
+    Generate every (album, light_idx, prompt) in batch (same album) with one ComfyUI execution.
+    Returns the number of tasks that produced no image.
+    """
+    album_name = batch[0][0]
+    scene_output_dir = os.path.join(OUTPUT_DIR, album_name)
+    settings = load_settings()
+    workflow_digest = manifest.workflow_digest(workflow_template)
+    hashes = {t[1]: output_hash(t[2], settings, workflow_digest) for t in batch}
+
+    # 1. Double check the output is not already current (race condition redundant check but safe)
+    todo = []
+    with job_queue.transaction():
+        for task in batch:
+            light_idx = task[1]
+            if manifest.is_current(scene_output_dir, light_idx, current_hashes(task[2], settings, workflow_digest)):
+                job_queue.update_task_status(album_name, light_idx - 1, 'done')
+                job_queue.update_job(album_name, 'processing', light_idx)
+            else:
+                todo.append(task)
+    metrics.TASKS.inc(len(batch) - len(todo), backend='comfyui', outcome='skipped')
+    if not todo:
+        return 0
+
+    keys = [(album_name, t[1]) for t in todo]
+
+    # 2. Get Input Image (normalized to the workflow resolution at ingest)
+    with stage('input_payload', keys, 'comfyui'):
+        payload = input_cache.get(album_name)
+    if payload is None:
+        print(f"  [Worker {label}] Skipping {album_name}: No light0 found.")
+        metrics.TASKS.inc(len(todo), backend='comfyui', outcome='skipped')
+        return 0
+
+    indices = ", ".join(f"light{t[1]}" for t in todo)
+    print(f"  [Worker {label}] Processing {album_name} - {indices}")
+    job_queue.mark_many((album_name, t[1] - 1, 'processing') for t in todo)
+
+    # 3. Execute (one ComfyUI execution for the whole batch; previews are watched for single prompts)
+    monitor = preview_monitor(todo[0], payload.jpeg_bytes, settings) if len(todo) == 1 else None
+    prompt_id, images = generate_batch(client, workflow_template, payload.path, [t[2] for t in todo], settings, keys,
+                                       label, monitor)
+
+    # Save Output (variant k -> the k-th task's lightN.png)
+    missing = 0
+    written = {}
+    for (_, light_idx, prompt_text), image_data in zip(todo, images):
+        # A truncated download is never written; the next run plans it again as missing
+        problem = "no image returned" if image_data is None else integrity.png_problem(image_data)
+        if problem:
+            print(f"  [Worker {label}] No usable image for {album_name} - light{light_idx} ({problem})")
+            metrics.ERRORS.inc(backend='comfyui', stage='no_output' if image_data is None else 'corrupt_output')
+            metrics.TASKS.inc(backend='comfyui', outcome='error')
+            trace_log.record('no_output', [(album_name, light_idx)], 'comfyui', time.monotonic(), time.monotonic(),
+                             label, prompt_id=prompt_id, outcome='error')
+            missing += 1
+            continue
+        output_path = os.path.join(scene_output_dir, f"light{light_idx}.png")
+        with stage('disk_write', [(album_name, light_idx)], 'comfyui') as info:
+            integrity.write_atomic(output_path, image_data)
+            info['bytes'] = len(image_data)
+        integrity.mark_verified(output_path)
+        written[light_idx] = (hashes[light_idx], prompt_text)
+        print(f"  [Worker {label}] Finished {album_name} - light{light_idx}")
+        metrics.TASKS.inc(backend='comfyui', outcome='done')
+
+    manifest.record(scene_output_dir, written)
+    if written:
+        # One jobs.json write for the whole batch
+        with job_queue.transaction():
+            job_queue.mark_many((album_name, light_idx - 1, 'done') for light_idx in written)
+            job_queue.update_job(album_name, 'processing', max(written)) # Rough progress update
+    return missing
+
+def worker_thread(client_url, task_queue, workflow_template, input_cache, batch_size=1, settings=None, router=None,
+                  dispatcher=None, warmup=None):
+    """
+    Worker function to process tasks from the queue using a specific ComfyUI client.
+    With batch_size > 1, consecutive prompts of the same album share one execution.
+    With a dispatcher, the worker waits until its instance is the right place for the next task.
+    With warmup, a (re)connected instance is warmed up before the worker takes tasks.
+
+    The worker survives instance restarts: connection failures trip a circuit breaker,
+    in-flight tasks are re-queued for other instances, and the worker reconnects with
+    exponential backoff. It only gives up after `instance_give_up` seconds of downtime.
+    In hybrid mode the measured per-task time is reported to the router.
+    """
+    settings = settings or {}
+    client = ComfyUIClient(client_url,
+                           ws_timeout=float(settings.get('comfy_ws_timeout', 30)),
+                           task_timeout=float(settings.get('comfy_task_timeout', 900)))
+    breaker = CircuitBreaker(threshold=int(settings.get('breaker_threshold', 3)),
+                             max_delay=float(settings.get('breaker_max_backoff', 120)))
+    give_up_after = float(settings.get('instance_give_up', 900))
+    max_attempts = int(settings.get('max_task_attempts', 3))
+    connected = False
+    down_since = None
+
+    carry = []
+    while True:
+        # 1. Make sure we have a healthy connection before taking work
+        if not connected:
+            if breaker.is_open:
+                wait = breaker.cooldown()
+                if down_since is not None and time.monotonic() - down_since + wait > give_up_after:
+                    print(f"Worker for {client_url} giving up: instance down for {time.monotonic() - down_since:.0f}s")
                     break
-            
-            job_queue.update_task_status(album_name, light_idx - 1, 'done')
-            job_queue.update_job(album_name, 'processing', light_idx) # Rough progress update
+                if task_queue.exhausted():
+                    break
+                time.sleep(min(wait, 2.0))
+                if breaker.cooldown() > 0:
+                    continue
+                if not client.health_check():
+                    breaker.record_failure()
+                    metrics.INSTANCE_UP.set(0, instance=client_url)
+                    continue
+            try:
+                client.reconnect()
+                if warmup:
+                    warmup.ensure_warm(client)
+                connected = True
+                down_since = None
+                breaker.record_success()
+                metrics.INSTANCE_UP.set(1, instance=client_url)
+                if router:
+                    router.local_up(1)
+                if dispatcher:
+                    dispatcher.set_up(client_url, True)
+                print(f"Worker started for {client_url} (batch size {batch_size})")
+            except InstanceError as e:
+                down_since = down_since or time.monotonic()
+                delay = breaker.record_failure()
+                metrics.INSTANCE_UP.set(0, instance=client_url)
+                metrics.ERRORS.inc(backend='comfyui', stage='connect', instance=client_url)
+                if delay:
+                    print(f"Worker for {client_url}: circuit open, retrying in {delay:.0f}s")
+                else:
+                    time.sleep(1.0)
+                continue
 
+        # 2. Take work (batch size follows settings saved mid-run)
+        current_settings = load_settings()
+        batch_size = max(1, int(current_settings.get('comfy_batch_size', batch_size)))
+        steps = generation_params(current_settings)['steps']
+        if dispatcher and not carry and not dispatcher.admit(client_url, task_queue.qsize(), steps * batch_size):
+            if task_queue.exhausted():
+                break
+            time.sleep(0.05)
+            continue
+        batch = next_batch(task_queue, batch_size, carry)
+        if not batch:
+            break
+
+        metrics.INFLIGHT.inc(len(batch), backend='comfyui', instance=client_url)
+        started = dispatcher.task_started(client_url) if dispatcher else time.monotonic()
+        executed_steps = None
+        try:
+            with stage('task', [(t[0], t[1]) for t in batch], 'comfyui', client_url) as info:
+                missing = run_local_batch(client, batch, workflow_template, input_cache, client_url)
+                if missing:
+                    info['outcome'] = 'error' if missing == len(batch) else 'partial'
+            breaker.record_success()
+            executed_steps = steps * len(batch)
+            if router:
+                router.record_local((time.monotonic() - started) / len(batch))
+        except InstanceError as e:
+            # Instance died under us: hand the work back and go reconnect
+            print(f"  [Worker {client_url}] Instance failure on {batch[0][0]}: {e}")
+            metrics.ERRORS.inc(backend='comfyui', stage='instance', instance=client_url)
+            metrics.INSTANCE_UP.set(0, instance=client_url)
+            reclaim_tasks(task_queue, batch, client_url, 'instance')
+            for task in carry:
+                task_queue.push(task)
+                task_queue.task_done()
+            carry.clear()
+            connected = False
+            down_since = time.monotonic()
+            client.close()
+            breaker.record_failure()
+            if router:
+                router.local_up(-1)
+            if dispatcher:
+                dispatcher.set_up(client_url, False)
+            if warmup:
+                # Probably restarted: its models are gone
+                warmup.mark_cold(client_url, started)
+        except EarlyAbort as e:
+            # Hopeless sample: the GPU was freed early; the retry gets a new seed
+            print(f"  [Worker {client_url}] Aborted {batch[0][0]} light{batch[0][1]} early: {e}")
+            record_early_abort(batch[0])
+            metrics.TASKS.inc(backend='comfyui', outcome='aborted')
+            reclaim_tasks(task_queue, batch, client_url, 'early_abort')
         except Exception as e:
-            print(f"  [Worker {client_url}] Error on {album_name} light{light_idx}: {e}")
-            # Optional: Mark as error in queue? For now just log.
-        
+            indices = ", ".join(f"light{t[1]}" for t in batch)
+            print(f"  [Worker {client_url}] Error on {batch[0][0]} {indices}: {e}")
+            metrics.ERRORS.inc(backend='comfyui', stage='task')
+            retry = [t for t in batch if record_attempt(t) < max_attempts]
+            for t in batch:
+                if t not in retry:
+                    job_queue.update_task_status(t[0], t[1] - 1, 'error')
+            metrics.TASKS.inc(len(batch) - len(retry), backend='comfyui', outcome='error')
+            reclaim_tasks(task_queue, retry, client_url, 'error')
         finally:
-            task_queue.task_done()
+            metrics.INFLIGHT.dec(len(batch), backend='comfyui', instance=client_url)
+            if dispatcher:
+                dispatcher.task_finished(client_url, started, executed_steps)
+            for _ in batch:
+                task_queue.task_done()
+
+    if router and connected:
+        router.local_up(-1)
+    if dispatcher:
+        dispatcher.set_up(client_url, False)
+    client.close()
 
-def api_worker_thread(task_queue, api_key):
+def next_api_task(task_queue, router, carry):
     """
-    Worker for Flux API requests
+    Next task for an API slot plus the router's credit reservation for it.
+    Without a router this is plain next_batch; with one, the slot waits for admission
+    and takes from the tail of the queue. Returns (None, 0) when the slot should exit.
     """
-    client = FluxAPIClient(api_key)
-    
+    if router is None:
+        batch = next_batch(task_queue, 1, carry)
+        return (batch[0] if batch else None), 0.0
+
     while True:
+        if not control.wait_while_paused():
+            return None, 0.0
+        decision, reservation = router.admit_api(task_queue.qsize())
+        if decision == 'stop':
+            print("  [API Worker] Credit budget reached, leaving the rest to local instances.")
+            return None, 0.0
+        if decision == 'wait':
+            if task_queue.exhausted():
+                return None, 0.0
+            time.sleep(0.25)
+            continue
         try:
-            task = task_queue.get(timeout=2)
+            task = task_queue.take_last()
         except queue.Empty:
+            router.finish_api(reservation)
+            if task_queue.exhausted():
+                return None, 0.0
+            continue
+        if control.is_cancelled(task[0]):
+            router.finish_api(reservation)
+            metrics.TASKS.inc(backend='control', outcome='cancelled')
+            task_queue.task_done()
+            continue
+        apply_config()
+        return current_task(task), reservation
+
+def api_worker_thread(task_queue, api_key, input_cache, api_url=None, poll_interval=1.0, slot=0, router=None,
+                      workflow_digest=None):
+    """
+    Worker for Flux API requests (one per parallel API slot).
+    workflow_digest is the run's template digest (API outputs are current whichever backend made them).
+    """
+    client = FluxAPIClient(api_key, api_url, poll_interval)
+    
+    carry = []
+    while True:
+        task, reservation = next_api_task(task_queue, router, carry)
+        if task is None:
             break
+        client.last_cost = 0.0
+        api_seconds = None
             
         album_name, light_idx, prompt_text = task
         scene_output_dir = os.path.join(OUTPUT_DIR, album_name)
         save_path = os.path.join(scene_output_dir, f"light{light_idx}.png")
+        settings = load_settings()
+        digest = output_hash(prompt_text, settings, workflow_digest, 'api')
         
         try:
-            # Check existence
-            if os.path.exists(save_path):
-                 job_queue.update_task_status(album_name, light_idx - 1, 'done')
-                 job_queue.update_job(album_name, 'processing', light_idx)
-                 task_queue.task_done()
+            # Check the output is not already current
+            if manifest.is_current(scene_output_dir, light_idx, current_hashes(prompt_text, settings, workflow_digest)):
+                 with job_queue.transaction():
+                     job_queue.update_task_status(album_name, light_idx - 1, 'done')
+                     job_queue.update_job(album_name, 'processing', light_idx)
+                 metrics.TASKS.inc(backend='api', outcome='skipped')
                  continue
             
-            # Find Input
-            light0_file = None
-            for f in os.listdir(scene_output_dir):
-                 if f.startswith("light0."):
-                     light0_file = f
-                     break
+            # Find Input (pre-encoded once per scene)
+            with stage('input_payload', [(album_name, light_idx)], 'api'):
+                payload = input_cache.get(album_name)
             
-            if not light0_file:
+            if payload is None:
                 print(f"  [API Worker] Skipping {album_name}: No light0 found.")
-                task_queue.task_done()
+                metrics.TASKS.inc(backend='api', outcome='skipped')
                 continue
-                
-            image_path_abs = os.path.join(scene_output_dir, light0_file)
-            
-            # Construct Prompt
-            full_prompt = f"{SYSTEM_PROMPT} \n Relight the scene with: {prompt_text}"
             
             print(f"  [API Worker] Processing {album_name} - light{light_idx}")
             job_queue.update_task_status(album_name, light_idx - 1, 'processing')
             
             # Generate
-            client.generate_image(image_path_abs, full_prompt, save_path)
+            metrics.INFLIGHT.inc(backend='api', slot=slot)
+            started = time.monotonic()
+            try:
+                with stage('task', [(album_name, light_idx)], 'api'):
+                    client.generate_image(payload.path, full_prompt(prompt_text), save_path, img_str=payload.b64, task=(album_name, light_idx))
+                api_seconds = time.monotonic() - started
+            finally:
+                metrics.INFLIGHT.dec(backend='api', slot=slot)
             
+            manifest.record(scene_output_dir, {light_idx: (digest, prompt_text)})
             print(f"  [API Worker] Finished {album_name} - light{light_idx}")
-            job_queue.update_task_status(album_name, light_idx - 1, 'done')
-            job_queue.update_job(album_name, 'processing', light_idx)
+            metrics.TASKS.inc(backend='api', outcome='done')
+            with job_queue.transaction():
+                job_queue.update_task_status(album_name, light_idx - 1, 'done')
+                job_queue.update_job(album_name, 'processing', light_idx)
 
         except Exception as e:
             print(f"  [API Worker] Error on {album_name} light{light_idx}: {e}")
+            metrics.ERRORS.inc(backend='api', stage='task')
+            metrics.TASKS.inc(backend='api', outcome='error')
             job_queue.update_task_status(album_name, light_idx - 1, 'error')
         
         finally:
+            if router:
+                router.finish_api(reservation, client.last_cost, api_seconds)
             task_queue.task_done()
 
-def process_dataset(target_file="all"):
+def process_dataset(target_file="all", continuous=False):
     # 1. Setup
     if not os.path.exists(OUTPUT_DIR):
         os.makedirs(OUTPUT_DIR)
 
+    # First processor up: clear a previous drain/cancel and recover tasks a killed run left in 'processing'
+    if not control.live_processors():
+        control.reset()
+        stale = job_queue.reconcile_stale()
+        if stale:
+            print(f"Reconciled {stale} stale 'processing' entries from a previous run.")
+    control.register_processor("continuous" if continuous else target_file)
+    try:
+        _process_dataset(target_file, continuous)
+    finally:
+        control.unregister_processor()
+
+    # A relight announced while this run was finishing: the app only starts a processor of its
+    # own when none is registered, and we unregistered before looking, so exactly one side sees it
+    if (control.pending_scene_events() and control.read_control()["state"] != "draining"
+            and not control.live_processors()):
+        process_dataset(target_file=None)
+
+def prepare_run(target_file="all", albums=None):
+    """
+    Shared setup for local runs and the coordinator: metadata.json, workflow and input cache.
+    Returns (workflow_template, input_cache, scenes, planner), or None if the run cannot start.
+    `scenes` lazily yields a ScenePlan per album (from `albums`, default: a walk of output_dataset);
+    feed it to produce_tasks() or collect_tasks(). planner(albums) plans other albums the same way.
+    """
+    apply_config()
+
+    # Outputs without a manifest entry predate manifests; the metadata.json of that time says
+    # which prompt each position had (snapshotted once, before it is rewritten below)
+    legacy_prompts = manifest.legacy_prompts(OUTPUT_DIR)
+
     # Save Metadata
     metadata = {}
     metadata["light0"] = "Original Image"
@@ -414,116 +1308,467 @@ def process_dataset(target_file="all"):
             workflow_template = json.load(f)
     except FileNotFoundError:
         print(f"Error: {WORKFLOW_FILE} not found.")
-        return
+        return None
 
     # Check for albums
-    if target_file != "all":
+    if target_file not in (None, "all"):
         target_path = os.path.join(OUTPUT_DIR, target_file)
         if not os.path.exists(target_path):
              print(f"Error: Target album {target_file} not found.")
-             return
-        albums = [target_file]
-    else:
-        albums = []
-        if os.path.exists(OUTPUT_DIR):
-            for name in os.listdir(OUTPUT_DIR):
-                path = os.path.join(OUTPUT_DIR, name)
-                if os.path.isdir(path):
-                     has_light0 = any(f.startswith("light0.") for f in os.listdir(path))
-                     if has_light0:
-                         albums.append(name)
-        
-    if not albums:
+             return None
+    elif not os.path.isdir(OUTPUT_DIR):
         print("No albums found in output_dataset.")
+        return None
+
+    target_size = normalizer.target_size_from_workflow(workflow_template)
+    input_cache = normalizer.InputCache(target_size, OUTPUT_DIR)
+    if albums is None:
+        albums = iter_albums(target_file)
+
+    # Truncated/corrupt outputs are removed before planning, so they are planned as missing
+    verify_mode = load_settings().get('verify_outputs', 'crc')
+    verifier = None
+    if verify_mode != 'off':
+        verifier = integrity.OutputVerifier(verify_mode, workers=load_settings().get('verify_workers'))
+
+    def planner(albums):
+        if verifier:
+            albums = verifier.verify_albums(albums, OUTPUT_DIR)
+        return plan_scenes(albums, workflow_template, target_size, legacy_prompts)
+    return workflow_template, input_cache, planner(albums), planner
+
+# (scene name, prompt list, {task_index: 'done'}, [(album_name, light_idx, prompt_text)], number of stale outputs)
+ScenePlan = namedtuple("ScenePlan", ["scene", "prompts", "statuses", "tasks", "outdated"])
+
+def iter_albums(target_file="all"):
+    """Scene folders with a light0, walked lazily so a huge output_dataset is never listed in full."""
+    if target_file is None:
         return
+    if target_file != "all":
+        yield target_file
+        return
+    with os.scandir(OUTPUT_DIR) as entries:
+        for entry in entries:
+            if entry.is_dir() and normalizer.find_light0(entry.path):
+                yield entry.name
+
+def watch_albums(task_queue, walk, resident=False, poll=1.0):
+    """
+    The walk of output_dataset (`walk`) interleaved one for one with newly approved scenes
+    announced through control.emit_scenes() (bulk lane), so fresh curation work does not wait
+    behind the backlog. After the walk a resident run keeps listening until stopped, a batch run
+    until its queue has run dry. Yields None while idle. Relights are served by relight_listener().
+    """
+    seen = set()
+    announced = deque()
+    last_check = None
+    while not task_queue.stopped.is_set():
+        if walk is None or last_check is None or time.monotonic() - last_check >= poll:
+            last_check = time.monotonic()
+            announced.extend(scene for scene, _ in control.take_scene_events(lanes=("bulk",)))
+
+        if announced:
+            scene = announced.popleft()
+            if scene not in seen and normalizer.find_light0(os.path.join(OUTPUT_DIR, scene)):
+                seen.add(scene)
+                print(f"New scene announced: {scene}")
+                yield scene
+
+        if walk is not None:
+            scene = next(walk, None)
+            if scene is None:
+                walk = None
+                if resident:
+                    print("Initial scan done; waiting for new scenes (drain to stop).")
+            elif scene not in seen:
+                seen.add(scene)
+                yield scene
+        elif not announced:
+            if not resident and task_queue.idle() and not control.pending_scene_events():
+                return
+            yield None
+            task_queue.stopped.wait(poll)
 
-    print(f"Found {len(albums)} albums to process.")
+def relight_listener(task_queue, planner, poll=0.5):
+    """
+    Serves relights (interactive events) next to the producer, which may sit blocked on a full
+    bulk window: the scene is promoted, planned and its tasks pushed straight into the
+    interactive lane. Stops taking events once the queue is closed; later ones are left for
+    the next processor.
+    """
+    while not task_queue.stopped.wait(poll):
+        with task_queue.intake:
+            if task_queue.closed.is_set():
+                return
+            for scene, _ in control.take_scene_events(lanes=("interactive",)):
+                if not normalizer.find_light0(os.path.join(OUTPUT_DIR, scene)):
+                    continue
+                moved = task_queue.promote(scene)
+                plan = next(planner([scene]))
+                register_scenes([plan])
+                pushed = sum(task_queue.push(task) for task in plan.tasks)
+                print(f"Relight requested: {scene} ({moved + pushed} task(s) in the interactive lane)")
 
-    # Initialize Queue in UI (V2)
-    print("Initializing status queue...")
+def plan_scenes(albums, workflow_template, target_size, legacy_prompts=None):
+    """
+    Yields a ScenePlan per album: which outputs are missing or stale and the tasks to (re)generate.
+    Outputs are current when their manifest hash matches what their backend consumed: prompt +
+    settings + workflow for ComfyUI, prompt + model for the Flux API.
+    The light0 of a scene with work is normalized right before its tasks are handed out.
+    A None from `albums` (watch_albums: nothing new right now) is passed through.
+    """
+    workflow_digest = manifest.workflow_digest(workflow_template)
+    planned_version = None
     for album_name in albums:
-        job_queue.set_job_tasks(album_name, LIGHTING_PROMPTS)
+        if album_name is None:
+            yield None
+            continue
+        # A resident (continuous) run outlives prompt/settings edits
+        apply_config()
+        if planned_version != _config_version:
+            planned_version = _config_version
+            prompts = list(LIGHTING_PROMPTS)
+            settings = load_settings()
+            expected = {i + 1: (current_hashes(p, settings, workflow_digest), p) for i, p in enumerate(prompts)}
+
+        scene_output_dir = os.path.join(OUTPUT_DIR, album_name)
+        missing, outdated = manifest.stale_outputs(scene_output_dir, expected, legacy_prompts)
+        todo = set(missing) | set(outdated)
+
+        # Flatten the work: (Album, PromptIndex, PromptText)
+        # Working on same album in parallel is fine as long as they write different files (light1, light2...)
+        statuses = {}
+        tasks = []
+        for i, prompt_text in enumerate(prompts):
+            if i + 1 in todo:
+                tasks.append((album_name, i + 1, prompt_text))
+            else:
+                statuses[i] = 'done'
+        if tasks:
+            normalizer.normalize_scenes([album_name], target_size, OUTPUT_DIR)
+        yield ScenePlan(album_name, prompts, statuses, tasks, len(outdated))
+
+def register_scenes(plans):
+    """Initialize Queue in UI (V2): the task lists of these scenes in a single jobs.json write."""
+    job_queue.set_many({p.scene: p.prompts for p in plans}, {p.scene: p.statuses for p in plans})
+
+def report_plan(scene_count, task_count, outdated):
+    if not scene_count:
+        print("No albums found in output_dataset.")
+        return
+    if outdated:
+        print(f"{outdated} existing outputs are stale (prompt, settings or workflow changed) and will be regenerated.")
+    print(f"Queued {task_count} generation tasks from {scene_count} albums.")
+    if not task_count:
+        print("All tasks completed.")
+
+def collect_tasks(scenes):
+    """Walk every scene up front and return the flat task list (the coordinator's task table)."""
+    plans = list(scenes)
+    register_scenes(plans)
+    tasks = [task for plan in plans for task in plan.tasks]
+    report_plan(len(plans), len(tasks), sum(p.outdated for p in plans))
+    return tasks
+
+# =================================================================================
+# TASK STREAM
+# =================================================================================
+
+LANES = ("interactive", "bulk")
+
+class TaskQueue(queue.Queue):
+    """
+    Bounded queue between the scene producer and the workers. A worker may only treat an empty
+    queue as the end of the run once the producer is done (close()); until then an empty queue
+    just means the walk is still catching up.
+
+    Tasks sit in two lanes. Scenes promoted with promote() (relights from the dataset page) go
+    to the interactive lane, everything else to bulk. get() shares dispatches between non-empty
+    lanes by smooth weighted round robin (interactive_weight : 1): a relight waits behind at
+    most a handful of bulk tasks, and bulk gets every dispatch the interactive lane does not use.
+    Interactive tasks never block on the bound.
+    """
+    def __init__(self, maxsize=0, interactive_weight=4):
+        self.weights = {"interactive": max(1, int(interactive_weight)), "bulk": 1}
+        super().__init__(maxsize)
+        self.closed = threading.Event()
+        self.stopped = threading.Event()
+        # Held by relight_listener() while it adds work, so nothing is added after close()
+        self.intake = threading.Lock()
+
+    # queue.Queue storage hooks (called with self.mutex held)
+    def _init(self, maxsize):
+        self.lanes = {lane: deque() for lane in LANES}
+        self.credit = {lane: 0 for lane in LANES}
+        self.interactive_scenes = set()
+        self.interactive_keys = set()
+
+    def _qsize(self):
+        return len(self.lanes["interactive"]) + len(self.lanes["bulk"])
+
+    def _put(self, task):
+        lane = "interactive" if task[0] in self.interactive_scenes else "bulk"
+        if lane == "interactive":
+            self.interactive_keys.add((task[0], task[1]))
+        self.lanes[lane].append((task, time.monotonic()))
+
+    def _get(self):
+        ready = [lane for lane in LANES if self.lanes[lane]]
+        total = 0
+        for lane in ready:
+            self.credit[lane] += self.weights[lane]
+            total += self.weights[lane]
+        lane = max(ready, key=lambda l: self.credit[l])
+        self.credit[lane] -= total
+        return self._pop(lane, last=False)
+
+    def _pop(self, lane, last):
+        task, queued_at = self.lanes[lane].pop() if last else self.lanes[lane].popleft()
+        if lane == "interactive":
+            self.interactive_keys.discard((task[0], task[1]))
+        metrics.STAGE_SECONDS.observe(time.monotonic() - queued_at, stage='queue_wait', lane=lane)
+        return task
+
+    def close(self):
+        with self.intake:
+            self.closed.set()
+
+    def stop(self):
+        """Workers are gone: make a producer blocked on a full queue give up."""
+        self.stopped.set()
+
+    def exhausted(self):
+        return self.closed.is_set() and self.empty()
+
+    def idle(self):
+        """Nothing queued and nothing in flight."""
+        with self.mutex:
+            return self.unfinished_tasks == 0
+
+    def is_interactive(self, scene):
+        with self.mutex:
+            return scene in self.interactive_scenes
+
+    def promote(self, scene):
+        """Move a scene to the interactive lane: its queued tasks now, and any it gets later."""
+        with self.mutex:
+            self.interactive_scenes.add(scene)
+            bulk = self.lanes["bulk"]
+            moved = [item for item in bulk if item[0][0] == scene]
+            if moved:
+                self.lanes["bulk"] = deque(item for item in bulk if item[0][0] != scene)
+                self.lanes["interactive"].extend(moved)
+                self.interactive_keys.update((task[0], task[1]) for task, _ in moved)
+            return len(moved)
+
+    def feed(self, task):
+        """Producer side: blocks while the queue is full. Returns False once the run was stopped."""
+        if self.is_interactive(task[0]):
+            self.push(task)
+            return True
+        while not self.stopped.is_set():
+            try:
+                self.put(task, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def push(self, task):
+        """
+        Add a task ignoring the bound, so a worker re-queueing work never blocks here. An
+        interactive task that is already queued is not added twice (a scene relit again).
+        """
+        with self.not_empty:
+            if task[0] in self.interactive_scenes and (task[0], task[1]) in self.interactive_keys:
+                return False
+            self._put(task)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+            return True
+
+    def take_last(self):
+        """The task local workers would reach last (hybrid API overflow): newest bulk task first."""
+        with self.mutex:
+            for lane in ("bulk", "interactive"):
+                if self.lanes[lane]:
+                    task = self._pop(lane, last=True)
+                    self.not_full.notify()
+                    return task
+            raise queue.Empty
+
+def produce_tasks(task_queue, scenes, chunk_limit=4096, max_delay=1.0):
+    """
+    Producer thread: registers scenes in jobs.json and feeds their tasks into the bounded queue,
+    blocking while it is full. Scenes are registered in chunks (one write each) that start at a
+    single scene, so the first task is queued right away, and double up to chunk_limit scenes.
+    A chunk is also flushed after max_delay seconds, or when the scene source goes idle (None).
+    """
+    started = time.monotonic()
+    scene_count = task_count = outdated = 0
+
+    def flush(chunk):
+        nonlocal task_count
+        register_scenes(chunk)
+        for plan in chunk:
+            for task in plan.tasks:
+                if not task_queue.feed(task):
+                    return False
+                if not task_count:
+                    print(f"First task queued after {(time.monotonic() - started) * 1000:.0f} ms.")
+                task_count += 1
+        return True
+
+    chunk, chunk_size, chunk_started = [], 1, None
+    try:
+        for plan in scenes:
+            if plan is not None:
+                chunk.append(plan)
+                scene_count += 1
+                outdated += plan.outdated
+                chunk_started = chunk_started or time.monotonic()
+            if not chunk:
+                continue
+            if plan is None or len(chunk) >= chunk_size or time.monotonic() - chunk_started >= max_delay:
+                if not flush(chunk):
+                    return
+                chunk, chunk_size, chunk_started = [], min(chunk_size * 2, chunk_limit), None
+        if chunk and not flush(chunk):
+            return
+        report_plan(scene_count, task_count, outdated)
+    finally:
+        task_queue.close()
+
+def _process_dataset(target_file, continuous=False):
+    settings = load_settings()
+
+    # Task Queue: a producer thread walks the scenes and keeps a bounded queue topped up,
+    # so workers start on the first scene while the rest of the dataset is still being scanned.
+    # (In hybrid mode the router sees at most this many tasks of backlog.) A resident run keeps
+    # the window short so announced scenes are not queued behind thousands of backlog tasks.
+    # Relights jump the window through the interactive lane (see TaskQueue).
+    window = int(settings.get('task_queue_size', 64 if continuous else 4096))
+    processing_queue = TaskQueue(maxsize=max(1, window),
+                                 interactive_weight=int(settings.get('interactive_weight', 4)))
+
+    # target_file None: started only for announced scenes (a relight that arrived as a run ended)
+    albums = watch_albums(processing_queue, iter_albums(target_file), resident=continuous)
+    prepared = prepare_run(target_file, albums)
+    if prepared is None:
+        return
+    workflow_template, input_cache, scenes, planner = prepared
 
     # -------------------------------------------------------------------------
     # PROCESSING SETUP
     # -------------------------------------------------------------------------
+
+    mode = settings.get('generation_mode', 'local') # 'local', 'api' or 'hybrid'
+    uses_api = mode in ('api', 'hybrid')
+    uses_local = mode != 'api'
     
-    settings = load_settings()
-    mode = settings.get('generation_mode', 'local') # 'local' or 'api'
-    
-    if mode == 'api':
+    router = None
+    if uses_api:
         api_key = os.environ.get("BFL_API_KEY")
-        if not api_key:
+        if not api_key and mode == 'api':
             print("FATAL: Generation Mode is API but BFL_API_KEY is not set.")
             return
-
-        max_workers = int(settings.get('api_max_parallel', 20))
-        print(f"Starting API Processing with {max_workers} parallel workers...")
+        if not api_key:
+            print("WARNING: Hybrid mode without BFL_API_KEY, running local only.")
+            uses_api = False
+        else:
+            max_workers = int(settings.get('api_max_parallel', 20))
+            budget = settings.get('api_budget')
+            # Plain API mode needs the router only to enforce a budget
+            if mode == 'hybrid' or budget is not None:
+                router = HybridRouter(budget=float(budget) if budget is not None else None,
+                                      api_latency=float(settings.get('api_latency_estimate', 30)),
+                                      cost_estimate=settings.get('api_cost_estimate'))
+            budget_note = f", budget {budget} credits" if budget is not None else ""
+            print(f"Starting API Processing with {max_workers} parallel workers{budget_note}...")
         
-    else:
+    dispatcher = None
+    warmup = None
+    if uses_local:
         # Local Mode
-        # 1. Setup Client
-        active_urls = [f"{BASE_COMFYUI_URL}:{START_PORT}"]
-        print(f"Using ComfyUI instance at: {active_urls[0]}")
-
-    # 2. Build Task Queue
-    # We want to flatten the work: (Album, PromptIndex, PromptText)
-    # This allows multiple workers to work on the SAME album in parallel if needed,
-    # or different albums.
-    # Note: Working on same album is fine as long as they write differnet files (light1, light2...)
-    
-    processing_queue = queue.Queue()
-    
-    total_tasks = 0
-    for album_name in albums:
-        scene_output_dir = os.path.join(OUTPUT_DIR, album_name)
-        
-        # Pre-check for completion to avoid filling queue with done tasks
-        for i, prompt_text in enumerate(LIGHTING_PROMPTS):
-            light_idx = i + 1
-            expected_file = os.path.join(scene_output_dir, f"light{light_idx}.png")
-            
-            if os.path.exists(expected_file):
-                # Ensure UI is updated
-                job_queue.update_task_status(album_name, i, 'done')
-                continue
-            
-            # Add to queue
-            # Item: (album_name, light_idx, prompt_text)
-            processing_queue.put((album_name, light_idx, prompt_text))
-            total_tasks += 1
-            
-    print(f"Queued {total_tasks} generation tasks.")
-    
-    if total_tasks == 0:
-        print("All tasks completed.")
-        return
+        # 1. Setup Client(s)
+        active_urls = settings.get('comfyui_urls') or [f"{BASE_COMFYUI_URL}:{START_PORT}"]
+        batch_size = max(1, int(settings.get('comfy_batch_size', 1)))
+        print(f"Using ComfyUI instance(s) at: {', '.join(active_urls)}")
+        # Several instances: least-loaded dispatch, with a second slot per instance so each
+        # one always has its next prompt queued ("pull" keeps one free-running worker each)
+        if len(active_urls) > 1 and settings.get('comfy_dispatch', 'least_loaded') == 'least_loaded':
+            dispatcher = InstanceDispatcher(active_urls, poll=float(settings.get('dispatch_poll', 2.0))).start()
+        slots = max(1, int(settings.get('comfy_slots', 2 if dispatcher else 1)))
+        if settings.get('comfy_warmup', True):
+            warmup = InstanceWarmup(workflow_template, timeout=float(settings.get('comfy_warmup_timeout', 1800)))
+
+    # 2. Start the producer
+    if continuous:
+        print("Continuous mode: approved scenes are picked up while running.")
+    producer = threading.Thread(target=produce_tasks, args=(processing_queue, scenes), daemon=True)
+    producer.start()
+    listener = threading.Thread(target=relight_listener, args=(processing_queue, planner), daemon=True)
+    listener.start()
 
     # 3. Start Workers
     threads = []
+    stop_exporter = metrics.start_exporter("processor")
     
-    if mode == 'api':
-        for _ in range(max_workers):
-            t = threading.Thread(target=api_worker_thread, args=(processing_queue, api_key))
-            t.start()
-            threads.append(t)
-    else:
-        # Local workers
+    if uses_local:
+        # Local workers (pull from the head of the queue)
         for url in active_urls:
-            t = threading.Thread(target=worker_thread, args=(url, processing_queue, workflow_template))
+            for _ in range(slots):
+                t = threading.Thread(target=worker_thread, args=(url, processing_queue, workflow_template, input_cache, batch_size, settings, router, dispatcher, warmup))
+                t.start()
+                threads.append(t)
+    if uses_api:
+        # API slots (in hybrid mode they only take the overflow from the tail)
+        workflow_digest = manifest.workflow_digest(workflow_template)
+        for slot in range(max_workers):
+            t = threading.Thread(target=api_worker_thread, args=(processing_queue, api_key, input_cache, settings.get('api_url'), float(settings.get('api_poll_interval', 1.0)), slot, router, workflow_digest))
             t.start()
             threads.append(t)
         
     # 4. Wait
     for t in threads:
         t.join()
+    processing_queue.stop()
+    producer.join()
+    listener.join()
 
+    stop_exporter()
+    integrity.save_cache()
     print("\nBatch processing complete.")
+    if router:
+        print(f"API routing: {router.summary()}")
+    if dispatcher:
+        dispatcher.stop()
+        print(f"Instance dispatch (s/step): {dispatcher.summary()}")
+    if warmup:
+        print(f"Instance warm-up (s): {warmup.summary()}")
+    report_run_metrics()
+
+def report_run_metrics():
+    """Print the per-stage/counter summary of this run and keep it in metrics/run_summary.json."""
+    run_summary = metrics.summary()
+    os.makedirs(metrics.METRICS_DIR, exist_ok=True)
+    with open(os.path.join(metrics.METRICS_DIR, "run_summary.json"), 'w') as f:
+        json.dump(run_summary, f, indent=2)
+    print(json.dumps(run_summary, indent=2))
 
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description="ComfyUI Relighting Processor")
     parser.add_argument("--target", type=str, help="Process a specific filename (e.g. image.jpg) or 'all'", default="all")
+    parser.add_argument("--continuous", action="store_true", help="Stay resident and process newly approved scenes until drained.")
+    parser.add_argument("--profile", choices=["cprofile", "sample"], help="Profile the whole run (all threads).")
+    parser.add_argument("--profile-out", type=str, default=None, help="Output path prefix (default: profiles/processor_<timestamp>).")
     args = parser.parse_args()
     
-    process_dataset(target_file=args.target)
+    if args.profile:
+        import profiling
+        out_prefix = args.profile_out or os.path.join(profiling.PROFILE_DIR, f"processor_{time.strftime('%Y%m%d-%H%M%S')}")
+        with profiling.profile_run(args.profile, out_prefix):
+            process_dataset(target_file=args.target, continuous=args.continuous)
+    else:
+        process_dataset(target_file=args.target, continuous=args.continuous)
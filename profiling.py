@@ -0,0 +1,198 @@
+import os
+import sys
+import time
+import pstats
+import cProfile
+import threading
+import itertools
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Opt-in profiling for processor.py (--profile) and app.py (APP_PROFILE env var).
+# Nothing here is imported or installed unless profiling is requested, so the
+# normal code paths pay nothing.
+#
+# Outputs:
+#   *.prof    cProfile stats (snakeviz, flameprof, gprof2dot, `python -m pstats`)
+#   *.folded  collapsed stacks from the sampling profiler (flamegraph.pl, speedscope, inferno)
+
+PROFILE_DIR = "profiles"
+MODES = ("cprofile", "sample")
+# From 3.12 cProfile runs on sys.monitoring: one Profile at a time per process, and it sees
+# every thread. Before that a Profile only sees the thread that enabled it.
+PROCESS_WIDE_CPROFILE = sys.version_info >= (3, 12)
+
+# =================================================================================
+# SAMPLING PROFILER
+# =================================================================================
+
+class SamplingProfiler:
+    """
+    Periodically snapshots the Python stacks of all (or selected) threads and counts
+    identical stacks. Overhead is bounded by the interval, not by call volume.
+    """
+    def __init__(self, interval=0.005, thread_ids=None):
+        self.interval = interval
+        self.thread_ids = thread_ids
+        self.stacks = defaultdict(int)
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _frame_name(self, frame):
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def _sample(self):
+        own = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own or (self.thread_ids is not None and ident not in self.thread_ids):
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            self.stacks[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def write_folded(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+        return path
+
+# =================================================================================
+# WHOLE-RUN PROFILING (processor.py --profile)
+# =================================================================================
+
+@contextmanager
+def profile_run(mode, out_prefix):
+    """
+    Profile everything executed inside the block, including threads started from it.
+    cprofile: every new thread gets its own cProfile.Profile and stats are merged at the end
+              (3.12+: a single profiler already covers all threads).
+    sample:   one sampling thread covers all threads.
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown profile mode: {mode}")
+    os.makedirs(os.path.dirname(out_prefix) or ".", exist_ok=True)
+    start = time.time()
+
+    if mode == "sample":
+        sampler = SamplingProfiler().start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            path = sampler.write_folded(out_prefix + ".folded")
+            print(f"[profile] {sampler.samples} samples in {time.time() - start:.1f}s -> {path}")
+        return
+
+    profiles = []
+    lock = threading.Lock()
+    original_run = threading.Thread.run
+
+    def profiled_run(thread_self):
+        profiler = cProfile.Profile()
+        with lock:
+            profiles.append(profiler)
+        profiler.enable()
+        try:
+            original_run(thread_self)
+        finally:
+            profiler.disable()
+
+    main_profiler = cProfile.Profile()
+    if not PROCESS_WIDE_CPROFILE:
+        threading.Thread.run = profiled_run
+    main_profiler.enable()
+    try:
+        yield
+    finally:
+        main_profiler.disable()
+        threading.Thread.run = original_run
+        stats = pstats.Stats(main_profiler)
+        with lock:
+            for profiler in profiles:
+                try:
+                    stats.add(profiler)
+                except TypeError:
+                    pass  # thread never ran any profiled code
+        path = out_prefix + ".prof"
+        stats.dump_stats(path)
+        with open(out_prefix + ".txt", 'w') as f:
+            pstats.Stats(path, stream=f).sort_stats("cumulative").print_stats(40)
+        threads = "all threads" if PROCESS_WIDE_CPROFILE else f"{len(profiles) + 1} threads"
+        print(f"[profile] {threads} in {time.time() - start:.1f}s -> {path}")
+
+# =================================================================================
+# FLASK MIDDLEWARE (app.py, APP_PROFILE=cprofile|sample)
+# =================================================================================
+
+def install_flask_profiler(app, mode, out_dir=None, paths=None):
+    """
+    Profile each request whose path starts with one of `paths` (all requests if empty)
+    and write one file per request to out_dir. Only call this when profiling is wanted.
+    cprofile requests run one at a time: 3.12+ allows only one active profiler per process
+    (and a request's profile then also includes any unprofiled requests running alongside).
+    """
+    from flask import g, request
+
+    if mode not in MODES:
+        raise ValueError(f"Unknown profile mode: {mode}")
+    out_dir = out_dir or os.path.join(PROFILE_DIR, "app")
+    os.makedirs(out_dir, exist_ok=True)
+    prefixes = tuple(p for p in (paths or []) if p)
+    cprofile_lock = threading.Lock()
+    sequence = itertools.count()
+
+    @app.before_request
+    def _start_profile():
+        if prefixes and not request.path.startswith(prefixes):
+            return
+        g._profile_start = time.perf_counter()
+        if mode == "cprofile":
+            cprofile_lock.acquire()
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                cprofile_lock.release()  # another profiling tool owns the process: serve unprofiled
+                return
+            g._profiler = profiler
+        else:
+            g._profiler = SamplingProfiler(interval=0.001, thread_ids={threading.get_ident()}).start()
+
+    @app.teardown_request
+    def _stop_profile(exc):
+        profiler = g.pop('_profiler', None)
+        if profiler is None:
+            return
+        elapsed_ms = (time.perf_counter() - g.pop('_profile_start')) * 1000
+        name = request.path.strip("/").replace("/", "_") or "index"
+        # Concurrent polls of the same path finish within the same second: keep them apart
+        prefix = os.path.join(out_dir, f"{time.strftime('%Y%m%d-%H%M%S')}_{int(elapsed_ms)}ms_{name}_{next(sequence)}")
+        if mode == "cprofile":
+            profiler.disable()
+            cprofile_lock.release()
+            profiler.dump_stats(prefix + ".prof")
+        else:
+            profiler.stop()
+            profiler.write_folded(prefix + ".folded")
@@ -0,0 +1,307 @@
+import io
+import os
+import re
+import json
+import time
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+import normalizer
+
+# Cheap NumPy image checks for relit outputs against their light0.
+# Images are compared as small grayscale arrays in [0, 1]. Structure is SSIM's contrast-structure
+# term on block windows: it ignores the global brightness change a relight is supposed to make,
+# and drops when the scene geometry is lost (noise, or a flat/black image).
+#
+#   PreviewMonitor  - early abort from sampler previews (processor.py, "early_abort")
+#   score_scene     - consistency scores of every lightN.png, kept in <scene>/scores.json
+#   python quality.py --score [--workers N] [--force]   (all scenes, on a process pool)
+
+CHECK_SIZE = (64, 64)
+BLOCK = 8
+# SSIM's C2 for a [0, 1] dynamic range: keeps near-flat windows from dividing by ~0
+C2 = 0.03 ** 2
+# Windows whose reference std is below this carry no structure to compare
+MIN_BLOCK_STD = 0.02
+
+def to_gray(image, size=CHECK_SIZE):
+    """Path, bytes or PIL image -> float32 grayscale array of `size` in [0, 1]."""
+    if isinstance(image, (bytes, bytearray)):
+        image = Image.open(io.BytesIO(image))
+    elif not isinstance(image, Image.Image):
+        image = Image.open(image)
+    image.draft("L", (size[0] * 2, size[1] * 2))  # JPEG: decode at reduced scale
+    gray = image.convert("L").resize(size, Image.BILINEAR)
+    return np.asarray(gray, dtype=np.float32) / 255.0
+
+def _blocks(a, block=BLOCK):
+    h, w = a.shape[0] - a.shape[0] % block, a.shape[1] - a.shape[1] % block
+    return a[:h, :w].reshape(h // block, block, w // block, block).swapaxes(1, 2).reshape(-1, block * block)
+
+def structure_similarity(reference, image, block=BLOCK):
+    """
+    Mean |contrast-structure| SSIM term between two same-sized gray arrays over the reference's
+    textured windows. The absolute value keeps shading that flips side under new lighting from
+    counting against the image. 1.0 when the reference has no structure to compare.
+    """
+    a, b = _blocks(reference, block), _blocks(image, block)
+    a = a - a.mean(axis=1, keepdims=True)
+    b = b - b.mean(axis=1, keepdims=True)
+    var_a = (a * a).mean(axis=1)
+    var_b = (b * b).mean(axis=1)
+    textured = np.sqrt(var_a) > MIN_BLOCK_STD
+    if not textured.any():
+        return 1.0
+    cs = (2 * (a * b).mean(axis=1) + C2) / (var_a + var_b + C2)
+    return float(np.abs(cs[textured]).mean())
+
+def luminance_problem(image, dark=0.03, bright=0.97, min_contrast=0.01):
+    """'black', 'white' or 'flat' for a hopeless image, None if its luminance looks sane."""
+    mean = float(image.mean())
+    if mean < dark:
+        return "black"
+    if mean > bright:
+        return "white"
+    if float(image.std()) < min_contrast:
+        return "flat"
+    return None
+
+class PreviewMonitor:
+    """
+    Early-abort check for one generation, fed the sampler previews as they arrive. Past
+    `after` of the steps, a preview fails when its luminance is hopeless or its structure
+    similarity to light0 is below `min_structure`; `patience` failing previews in a row mean
+    the generation is failing. Earlier previews are still mostly noise and are ignored.
+    """
+    def __init__(self, reference, min_structure=0.2, after=0.4, patience=2):
+        self.reference = reference
+        self.min_structure = min_structure
+        self.after = after
+        self.patience = patience
+        self.strikes = 0
+        self.last = None
+
+    def __call__(self, image_bytes, step, total):
+        """Returns the reason to abort, or None to keep going."""
+        if not total or step / total < self.after:
+            return None
+        try:
+            preview = to_gray(image_bytes, self.reference.shape[::-1])
+        except Exception:
+            return None  # undecodable preview: no verdict
+        reason = luminance_problem(preview)
+        if reason is None:
+            score = structure_similarity(self.reference, preview)
+            if score < self.min_structure:
+                reason = f"structure {score:.2f} < {self.min_structure}"
+        self.strikes = self.strikes + 1 if reason else 0
+        self.last = reason
+        if self.strikes >= self.patience:
+            return f"{reason} at step {step}/{total}"
+        return None
+
+# =================================================================================
+# OUTPUT SCORING
+# =================================================================================
+
+SCORES_NAME = "scores.json"
+SCORE_SIZE = (192, 128)       # the workflow's 3:2 at a size where edges survive
+EDGE_KEEP = 0.15              # strongest 15% of gradients form the edge map...
+EDGE_FLOOR = 0.02             # ...if they are edges at all (flat images have none)
+REJECTED_DIR = "rejected"     # requeued outputs are moved here (<scene>/lightN.png), not deleted
+OUTPUT_RE = re.compile(r"^light(\d+)\.png$")
+SCORES_LOCK = threading.Lock()
+
+def sobel(stack):
+    """(N, H, W) -> gradient (gx, gy), each (N, H-2, W-2), normalized to [-1, 1]."""
+    p = stack
+    gx = (p[:, :-2, 2:] + 2 * p[:, 1:-1, 2:] + p[:, 2:, 2:] - p[:, :-2, :-2] - 2 * p[:, 1:-1, :-2] - p[:, 2:, :-2]) / 4
+    gy = (p[:, 2:, :-2] + 2 * p[:, 2:, 1:-1] + p[:, 2:, 2:] - p[:, :-2, :-2] - 2 * p[:, :-2, 1:-1] - p[:, :-2, 2:]) / 4
+    return gx, gy
+
+def edge_maps(magnitude):
+    """Boolean edge maps: per image, gradients in the top EDGE_KEEP fraction and above EDGE_FLOOR."""
+    cutoff = np.quantile(magnitude.reshape(len(magnitude), -1), 1 - EDGE_KEEP, axis=1)
+    return magnitude > np.maximum(cutoff, EDGE_FLOOR)[:, None, None]
+
+def dilate(edges):
+    """3x3 binary dilation of (N, H, W) maps: one pixel of localization slack."""
+    padded = np.pad(edges, ((0, 0), (1, 1), (1, 1)))
+    h, w = edges.shape[1:]
+    out = np.zeros_like(edges)
+    for dy in range(3):
+        for dx in range(3):
+            out |= padded[:, dy:dy + h, dx:dx + w]
+    return out
+
+def score_stack(reference, outputs):
+    """
+    reference: (H, W) light0; outputs: (N, H, W) relit images, gray in [0, 1].
+    Returns a dict of (N,) arrays:
+      edge        F1 of the outputs' edge maps against light0's (1 px tolerance)
+      gradient    agreement of the gradient fields, sum|g0 . g| / (|g0| |g|), ignoring polarity
+      luma_shift  mean luminance change against light0 (the relight itself)
+      contrast    luminance std ratio against light0
+      score       (edge + gradient) / 2, 0 for black/white/flat outputs
+    """
+    stack = np.concatenate([reference[None], outputs]).astype(np.float32)
+    gx, gy = sobel(stack)
+    magnitude = np.hypot(gx, gy)
+    edges = edge_maps(magnitude)
+    ref_edges, out_edges = edges[:1], edges[1:]
+
+    hits_out = (out_edges & dilate(ref_edges)).sum(axis=(1, 2))
+    hits_ref = (ref_edges & dilate(out_edges)).sum(axis=(1, 2))
+    precision = hits_out / np.maximum(out_edges.sum(axis=(1, 2)), 1)
+    recall = hits_ref / max(int(ref_edges.sum()), 1)
+    edge = np.where(ref_edges.any(), 2 * precision * recall / np.maximum(precision + recall, 1e-9), 1.0)
+
+    dot = np.abs(gx[:1] * gx[1:] + gy[:1] * gy[1:]).sum(axis=(1, 2))
+    norms = np.sqrt((magnitude[:1] ** 2).sum()) * np.sqrt((magnitude[1:] ** 2).sum(axis=(1, 2)))
+    gradient = dot / (norms + 1e-6)
+
+    means = outputs.mean(axis=(1, 2))
+    stds = outputs.std(axis=(1, 2))
+    hopeless = (means < 0.03) | (means > 0.97) | (stds < 0.01)
+    return {
+        'edge': edge,
+        'gradient': gradient,
+        'luma_shift': means - reference.mean(),
+        'contrast': stds / max(float(reference.std()), 1e-6),
+        'score': np.where(hopeless, 0.0, (edge + gradient) / 2),
+    }
+
+def load_scores(scene_dir):
+    try:
+        with open(os.path.join(scene_dir, SCORES_NAME), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_scores(scene_dir, data):
+    path = os.path.join(scene_dir, SCORES_NAME)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def _stamp(path):
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size]
+
+def reference_image(scene_dir):
+    """The normalized light0 the outputs were generated from (the original if it cannot be built)."""
+    scene_dir = os.path.abspath(scene_dir)
+    try:
+        path = normalizer.ensure_normalized(os.path.basename(scene_dir), None, os.path.dirname(scene_dir))
+    except Exception as e:
+        print(f"Normalization failed for {os.path.basename(scene_dir)}: {e}")
+        path = None
+    return path or normalizer.find_light0(scene_dir)
+
+def score_scene(scene_dir, force=False):
+    """
+    Score every lightN.png of a scene against the normalized light0 it was generated from, in
+    one vectorized pass, and update scores.json. Outputs whose (mtime, size) and reference are
+    unchanged keep their stored score. Returns the number of outputs (re)scored.
+    """
+    light0 = reference_image(scene_dir)
+    if light0 is None:
+        return 0
+    names = sorted((n for n in os.listdir(scene_dir) if OUTPUT_RE.match(n)), key=lambda n: int(OUTPUT_RE.match(n).group(1)))
+    with SCORES_LOCK:
+        data = load_scores(scene_dir)
+    ref_stamp = _stamp(light0)
+    stamps = {name: _stamp(os.path.join(scene_dir, name)) for name in names}
+    todo = [name for name in names if force or data.get(name, {}).get('stamp') != stamps[name]
+            or data.get(name, {}).get('light0') != ref_stamp]
+    if todo or set(data) - set(names):
+        outputs = []
+        for name in list(todo):
+            try:
+                outputs.append(to_gray(os.path.join(scene_dir, name), SCORE_SIZE))
+            except OSError:
+                todo.remove(name)  # unreadable (half-written?): scored on the next pass
+        if todo:
+            metrics = score_stack(to_gray(light0, SCORE_SIZE), np.stack(outputs))
+            for k, name in enumerate(todo):
+                entry = {key: round(float(values[k]), 4) for key, values in metrics.items()}
+                data[name] = dict(entry, stamp=stamps[name], light0=ref_stamp, scored=round(time.time(), 1))
+        data = {name: entry for name, entry in data.items() if name in stamps}
+        with SCORES_LOCK:
+            _save_scores(scene_dir, data)
+    return len(todo)
+
+def _score_scene_task(args):
+    scene_dir, force = args
+    try:
+        return os.path.basename(scene_dir), score_scene(scene_dir, force), None
+    except Exception as e:
+        return os.path.basename(scene_dir), 0, str(e)
+
+def score_all(output_dir=normalizer.OUTPUT_DIR, workers=None, force=False):
+    """Score every scene on a process pool. Returns (scenes, outputs scored)."""
+    with os.scandir(output_dir) as entries:
+        scene_dirs = [e.path for e in entries if e.is_dir()]
+    started = time.monotonic()
+    scored = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for scene, count, error in pool.map(_score_scene_task, [(d, force) for d in scene_dirs], chunksize=16):
+            if error:
+                print(f"Scoring failed for {scene}: {error}")
+            scored += count
+    print(f"Scored {scored} outputs in {len(scene_dirs)} scenes ({time.monotonic() - started:.1f}s).")
+    return len(scene_dirs), scored
+
+def all_scores(output_dir=normalizer.OUTPUT_DIR):
+    """[(scene, name, entry)] for every scored output."""
+    rows = []
+    with os.scandir(output_dir) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                rows.extend((entry.name, name, e) for name, e in load_scores(entry.path).items())
+    return rows
+
+def worst(output_dir=normalizer.OUTPUT_DIR, n=50):
+    return sorted(all_scores(output_dir), key=lambda row: row[2]['score'])[:n]
+
+def requeue_below(threshold, output_dir=normalizer.OUTPUT_DIR, rejected_dir=REJECTED_DIR):
+    """
+    Move outputs scoring below threshold to rejected/<scene>/ so the next processor run
+    regenerates them (a missing output is always planned). Returns {scene: [light_idx, ...]}.
+    """
+    requeued = {}
+    for scene, name, entry in all_scores(output_dir):
+        if entry['score'] >= threshold:
+            continue
+        scene_dir = os.path.join(output_dir, scene)
+        src = os.path.join(scene_dir, name)
+        if not os.path.exists(src):
+            continue
+        dst_dir = os.path.join(rejected_dir, scene)
+        os.makedirs(dst_dir, exist_ok=True)
+        shutil.move(src, os.path.join(dst_dir, name))
+        requeued.setdefault(scene, []).append(int(OUTPUT_RE.match(name).group(1)))
+    for scene in requeued:
+        scene_dir = os.path.join(output_dir, scene)
+        with SCORES_LOCK:
+            data = load_scores(scene_dir)
+            _save_scores(scene_dir, {n: e for n, e in data.items() if os.path.exists(os.path.join(scene_dir, n))})
+    return requeued
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Structural-consistency scoring of relit outputs")
+    parser.add_argument("--score", action="store_true", help="Score all scenes in output_dataset.")
+    parser.add_argument("--workers", type=int, default=None, help="Scoring processes (default: CPU count).")
+    parser.add_argument("--force", action="store_true", help="Rescore outputs that did not change.")
+    parser.add_argument("--worst", type=int, default=0, help="Print the N lowest-scoring outputs.")
+    args = parser.parse_args()
+
+    if args.score:
+        score_all(workers=args.workers, force=args.force)
+    for scene, name, entry in worst(n=args.worst) if args.worst else []:
+        print(f"{entry['score']:.3f}  {scene}/{name}  edge {entry['edge']:.2f}  gradient {entry['gradient']:.2f}  "
+              f"luma {entry['luma_shift']:+.2f}  contrast x{entry['contrast']:.2f}")
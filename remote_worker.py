@@ -0,0 +1,251 @@
+import os
+import re
+import time
+import socket
+import threading
+import requests
+import processor
+import metrics
+import manifest
+from processor import ComfyUIClient, CircuitBreaker, InstanceError, EarlyAbort
+
+# Remote worker for multi-node mode (see coordinator.py). Runs on a GPU box next to its
+# ComfyUI instance: leases tasks from the coordinator, generates them locally and uploads
+# each PNG with its metadata. Inputs are cached locally by the content digest the coordinator
+# sends with each lease, so a replaced or re-normalized light0 is fetched again.
+#
+#   python remote_worker.py --coordinator http://<head>:5100 --comfyui http://127.0.0.1:8188
+#   python remote_worker.py --coordinator http://127.0.0.1:5100 --mock fast   (local testing)
+
+WORK_DIR = "remote_work"
+
+class CoordinatorClient:
+    def __init__(self, url, worker_id, timeout=30):
+        self.url = url.rstrip('/')
+        self.worker_id = worker_id
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def config(self):
+        response = self.session.get(f"{self.url}/api/config", timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def lease(self, max_tasks):
+        """Returns a lease dict, None if nothing is available right now, or False when the run is over."""
+        response = self.session.post(f"{self.url}/api/lease", json={'worker': self.worker_id, 'max_tasks': max_tasks},
+                                     timeout=self.timeout)
+        if response.status_code == 410:
+            return False
+        if response.status_code == 204:
+            return None
+        response.raise_for_status()
+        return response.json()
+
+    def heartbeat(self, lease_id):
+        response = self.session.post(f"{self.url}/api/heartbeat/{lease_id}", timeout=self.timeout)
+        return response.status_code == 200
+
+    def fetch_input(self, scene, input_dir):
+        """Download the scene's input into input_dir as <scene>.<digest>.jpg (older copies removed). Returns the path."""
+        with self.session.get(f"{self.url}/api/input/{scene}", stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            digest = response.headers.get('X-Input-Digest')
+            tmp_path = os.path.join(input_dir, f"{scene}.{os.getpid()}.part")
+            with open(tmp_path, 'wb') as f:
+                for chunk in response.iter_content(256 * 1024):
+                    f.write(chunk)
+        if not digest:
+            # Coordinator without digests: never reused, fetched again for every lease
+            dest_path = os.path.join(input_dir, f"{scene}.jpg")
+        else:
+            dest_path = input_path(input_dir, scene, digest)
+            stale = re.compile(re.escape(scene) + r"\.[0-9a-f]{16}\.jpg$")
+            for name in os.listdir(input_dir):
+                if stale.match(name) and name != os.path.basename(dest_path):
+                    os.remove(os.path.join(input_dir, name))
+        os.replace(tmp_path, dest_path)
+        return dest_path
+
+    def upload(self, lease_id, scene, light_idx, image_data, prompt_id, output_hash):
+        headers = {'Content-Type': 'image/png', 'X-Worker': self.worker_id, 'X-Prompt-Id': prompt_id or '',
+                   'X-Output-Hash': output_hash}
+        response = self.session.put(f"{self.url}/api/result/{lease_id}/{scene}/{light_idx}",
+                                    data=image_data, headers=headers, timeout=self.timeout)
+        response.raise_for_status()
+
+    def fail(self, lease_id, scene, light_indices, error, retryable):
+        try:
+            self.session.post(f"{self.url}/api/fail/{lease_id}", timeout=self.timeout, json={
+                'worker': self.worker_id, 'scene': scene, 'light_indices': light_indices,
+                'error': str(error)[:300], 'retryable': retryable,
+            })
+        except requests.RequestException as e:
+            # The lease will expire on the coordinator and the tasks come back anyway
+            print(f"  [Remote {self.worker_id}] Could not report failure: {e}")
+
+def input_path(input_dir, scene, digest):
+    return os.path.join(input_dir, f"{scene}.{digest}.jpg")
+
+class Heartbeat:
+    """Renews a lease in the background while a batch is generating."""
+    def __init__(self, coordinator, lease_id, interval):
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(coordinator, lease_id, interval), daemon=True)
+
+    def _run(self, coordinator, lease_id, interval):
+        while not self.stop_event.wait(interval):
+            try:
+                if not coordinator.heartbeat(lease_id):
+                    return
+            except requests.RequestException:
+                pass
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop_event.set()
+
+def run_worker(coordinator_url, comfyui_url, batch_size=1, worker_id=None, work_dir=WORK_DIR, poll=2.0, give_up=300.0):
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    coordinator = CoordinatorClient(coordinator_url, worker_id)
+    config = coordinator.config()
+    workflow_template = config['workflow']
+    workflow_digest = manifest.workflow_digest(workflow_template)
+    settings = config['settings']
+    # Prompts and settings come from the coordinator, not from files on this box
+    processor.CONFIG.pin(settings=settings, system_prompt=config['system_prompt'])
+    processor.apply_config()
+    heartbeat_interval = max(1.0, float(config['lease_ttl']) / 3)
+
+    input_dir = os.path.abspath(os.path.join(work_dir, "inputs"))
+    os.makedirs(input_dir, exist_ok=True)
+
+    client = ComfyUIClient(comfyui_url,
+                           ws_timeout=float(settings.get('comfy_ws_timeout', 30)),
+                           task_timeout=float(settings.get('comfy_task_timeout', 900)))
+    warmup = None
+    if settings.get('comfy_warmup', True):
+        warmup = processor.InstanceWarmup(workflow_template, timeout=float(settings.get('comfy_warmup_timeout', 1800)))
+    breaker = CircuitBreaker(threshold=int(settings.get('breaker_threshold', 3)),
+                             max_delay=float(settings.get('breaker_max_backoff', 120)))
+    connected = False
+    unreachable_since = None
+    print(f"Remote worker {worker_id}: coordinator {coordinator_url}, ComfyUI {comfyui_url} (batch size {batch_size})")
+
+    while True:
+        if not connected:
+            try:
+                client.reconnect()
+                if warmup:
+                    warmup.ensure_warm(client)
+                connected = True
+                breaker.record_success()
+            except InstanceError:
+                delay = breaker.record_failure() or 1.0
+                print(f"  [Remote {worker_id}] ComfyUI unavailable, retrying in {delay:.0f}s")
+                time.sleep(delay)
+                continue
+
+        try:
+            lease = coordinator.lease(batch_size)
+            unreachable_since = None
+        except requests.RequestException as e:
+            unreachable_since = unreachable_since or time.monotonic()
+            if time.monotonic() - unreachable_since > give_up:
+                print(f"  [Remote {worker_id}] Coordinator gone for {give_up:.0f}s, stopping")
+                break
+            print(f"  [Remote {worker_id}] Coordinator unreachable: {e}")
+            time.sleep(poll)
+            continue
+        if lease is False:
+            break
+        if lease is None:
+            time.sleep(poll)
+            continue
+
+        if lease.get('config_version') != config['version']:
+            # Settings or prompts changed on the coordinator: pick them up before this batch
+            config = coordinator.config()
+            settings = config['settings']
+            processor.CONFIG.pin(settings=settings, system_prompt=config['system_prompt'])
+            processor.apply_config()
+
+        lease_id = lease['lease_id']
+        tasks = lease['tasks']
+        scene = tasks[0]['scene']
+        indices = [t['light_idx'] for t in tasks]
+        keys = [(scene, i) for i in indices]
+        uploaded = set()
+        started = time.monotonic()
+        try:
+            with Heartbeat(coordinator, lease_id, heartbeat_interval):
+                digest = lease.get('input_digest')
+                image_path = input_path(input_dir, scene, digest) if digest else None
+                if image_path is None or not os.path.exists(image_path):
+                    with processor.stage('input_fetch', keys, 'remote', coordinator_url):
+                        image_path = coordinator.fetch_input(scene, input_dir)
+
+                monitor = None
+                if len(tasks) == 1:
+                    monitor = processor.preview_monitor((scene, indices[0]), image_path, settings)
+                prompt_id, images = processor.generate_batch(client, workflow_template, image_path,
+                                                             [t['prompt'] for t in tasks], settings, keys, comfyui_url,
+                                                             monitor)
+                for task, image_data in zip(tasks, images):
+                    if image_data is None:
+                        continue
+                    light_idx = task['light_idx']
+                    output_hash = processor.output_hash(task['prompt'], settings, workflow_digest)
+                    with processor.stage('upload', [(scene, light_idx)], 'remote', coordinator_url) as info:
+                        coordinator.upload(lease_id, scene, light_idx, image_data, prompt_id, output_hash)
+                        info.update(prompt_id=prompt_id, bytes=len(image_data))
+                    uploaded.add(light_idx)
+                    metrics.TASKS.inc(backend='remote', outcome='done')
+            missing = [i for i in indices if i not in uploaded]
+            if missing:
+                coordinator.fail(lease_id, scene, missing, "no image returned", retryable=False)
+            print(f"  [Remote {worker_id}] Finished {scene} - " + ", ".join(f"light{i}" for i in sorted(uploaded)))
+            breaker.record_success()
+        except EarlyAbort as e:
+            # Interrupted a hopeless sample; the coordinator hands it out again (new seed)
+            print(f"  [Remote {worker_id}] Aborted {scene} light{indices[0]} early: {e}")
+            processor.record_early_abort((scene, indices[0]))
+            coordinator.fail(lease_id, scene, indices, e, retryable=True)
+            metrics.TASKS.inc(backend='remote', outcome='aborted')
+        except InstanceError as e:
+            print(f"  [Remote {worker_id}] ComfyUI failure on {scene}: {e}")
+            coordinator.fail(lease_id, scene, [i for i in indices if i not in uploaded], e, retryable=True)
+            metrics.ERRORS.inc(backend='remote', stage='instance')
+            client.close()
+            connected = False
+            if warmup:
+                warmup.mark_cold(client.url, started)
+        except Exception as e:
+            print(f"  [Remote {worker_id}] Error on {scene}: {e}")
+            coordinator.fail(lease_id, scene, [i for i in indices if i not in uploaded], e, retryable=False)
+            metrics.ERRORS.inc(backend='remote', stage='task')
+
+    client.close()
+    print(f"Remote worker {worker_id}: run finished")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Pull relighting tasks from a coordinator and run them on local ComfyUI")
+    parser.add_argument("--coordinator", type=str, required=True, help="Coordinator URL, e.g. http://gpu-head:5100")
+    parser.add_argument("--comfyui", type=str, default=f"{processor.BASE_COMFYUI_URL}:{processor.START_PORT}")
+    parser.add_argument("--batch-size", type=int, default=1, help="Prompts per lease / ComfyUI execution.")
+    parser.add_argument("--worker-id", type=str, default=None)
+    parser.add_argument("--work-dir", type=str, default=WORK_DIR)
+    parser.add_argument("--give-up", type=float, default=300.0, help="Exit after the coordinator is unreachable this long.")
+    parser.add_argument("--mock", type=str, default=None, help="Start an in-process mock ComfyUI with this profile instead of --comfyui.")
+    args = parser.parse_args()
+
+    comfyui_url = args.comfyui
+    if args.mock:
+        import mock_comfyui
+        mock = mock_comfyui.MockComfyUI.from_profile(args.mock)
+        comfyui_url = mock.start()
+    run_worker(args.coordinator, comfyui_url, args.batch_size, args.worker_id, args.work_dir, give_up=args.give_up)
@@ -1,10 +1,222 @@
 import os
+import sys
+import json
+import struct
 import shutil
 import random
+import hashlib
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
 
-def sample_images(source_dir, buffer_dir, n, min_size):
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.webp')
+
+# Per-source cache of (relative path -> [width, height, mtime, size]).
+# Lives next to this script so read-only source datasets still get an index.
+INDEX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".sample_index")
+
+# Linux ioctl for copy-on-write clones (btrfs, xfs with reflink=1, ...)
+FICLONE = 0x40049409
+
+# =================================================================================
+# HEADER-ONLY SIZE PROBING
+# =================================================================================
+
+def _probe_png(f):
+    head = f.read(24)
+    if len(head) < 24 or head[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>II', head[16:24])
+
+def _probe_jpeg(f):
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        code = marker[1]
+        # Fill bytes / standalone markers without a length field
+        if code == 0xFF:
+            f.seek(-1, os.SEEK_CUR)
+            continue
+        if code == 0xD8 or 0xD0 <= code <= 0xD7 or code == 0x01:
+            continue
+        length_bytes = f.read(2)
+        if len(length_bytes) < 2:
+            return None
+        length = struct.unpack('>H', length_bytes)[0]
+        # SOF0..SOF15 except DHT (C4), JPG (C8) and DAC (CC)
+        if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+            sof = f.read(5)
+            if len(sof) < 5:
+                return None
+            height, width = struct.unpack('>HH', sof[1:5])
+            return width, height
+        f.seek(length - 2, os.SEEK_CUR)
+
+def _probe_webp(f):
+    head = f.read(30)
+    if len(head) < 30 or head[8:12] != b'WEBP':
+        return None
+    chunk = head[12:16]
+    if chunk == b'VP8 ':
+        width, height = struct.unpack('<HH', head[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b'VP8L':
+        b = head[21:25]
+        width = 1 + (((b[1] & 0x3F) << 8) | b[0])
+        height = 1 + (((b[3] & 0x0F) << 10) | (b[2] << 2) | ((b[1] & 0xC0) >> 6))
+        return width, height
+    if chunk == b'VP8X':
+        width = 1 + int.from_bytes(head[24:27], 'little')
+        height = 1 + int.from_bytes(head[27:30], 'little')
+        return width, height
+    return None
+
+def probe_size(path):
+    """
+    Returns (width, height) reading only the image header.
+    Falls back to PIL (which is also lazy) for anything the fast paths don't recognize.
+    """
+    try:
+        with open(path, 'rb') as f:
+            magic = f.read(12)
+            f.seek(0)
+            size = None
+            if magic.startswith(b'\x89PNG'):
+                size = _probe_png(f)
+            elif magic.startswith(b'\xff\xd8'):
+                size = _probe_jpeg(f)
+            elif magic[:4] == b'RIFF' and magic[8:12] == b'WEBP':
+                size = _probe_webp(f)
+            if size:
+                return size
+    except (OSError, struct.error):
+        pass
+
+    with Image.open(path) as img:
+        return img.size
+
+# =================================================================================
+# SOURCE INDEX
+# =================================================================================
+
+def index_path_for(source_dir):
+    digest = hashlib.sha1(os.path.abspath(source_dir).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(INDEX_DIR, f"{digest}.json")
+
+def load_index(source_dir):
+    path = index_path_for(source_dir)
+    if os.path.exists(path):
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if data.get('source') == os.path.abspath(source_dir):
+                return data.get('entries', {})
+        except:
+            pass
+    return {}
+
+def save_index(source_dir, entries):
+    path = index_path_for(source_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({'source': os.path.abspath(source_dir), 'entries': entries}, f)
+    os.replace(tmp_path, path)
+
+# =================================================================================
+# FILE PLACEMENT
+# =================================================================================
+
+def _reflink(src, dst):
+    import fcntl
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+def place_file(src, dst, mode="auto"):
+    """
+    Puts src at dst without copying bytes when possible.
+    mode: 'auto' / 'reflink' (reflink -> copy), 'link' (hard link -> reflink -> copy) or 'copy'.
+    A hard link is the source file itself: approving moves it into output_dataset/, and anything
+    that later writes to that light0 in place also changes the source dataset. Reflinks and
+    copies are independent files, so 'link' is opt-in.
+    Returns the method that was actually used.
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    if mode != "copy":
+        same_fs = os.stat(src).st_dev == os.stat(os.path.dirname(dst) or ".").st_dev
+        if same_fs and mode == "link":
+            try:
+                os.link(src, dst)
+                return "link"
+            except OSError:
+                pass
+        if same_fs and sys.platform.startswith("linux"):
+            try:
+                _reflink(src, dst)
+                return "reflink"
+            except OSError:
+                if os.path.exists(dst):
+                    os.remove(dst)
+
+    shutil.copy2(src, dst)
+    return "copy"
+
+# =================================================================================
+# SAMPLING
+# =================================================================================
+
+def _sample_class(job):
+    """
+    Process pool entry point: refreshes the index for one class directory,
+    then samples and places up to n images. Returns (class_name, entries, sampled).
+    """
+    source_dir, class_name, cached, buffer_dir, n, min_size, mode, seed = job
+    class_path = os.path.join(source_dir, class_name)
+
+    entries = {}
+    with os.scandir(class_path) as it:
+        for entry in it:
+            if not entry.is_file() or not entry.name.lower().endswith(IMAGE_EXTS):
+                continue
+            rel = f"{class_name}/{entry.name}"
+            st = entry.stat()
+            hit = cached.get(rel)
+            if hit and hit[2] == st.st_mtime and hit[3] == st.st_size:
+                entries[rel] = hit
+                continue
+            try:
+                width, height = probe_size(entry.path)
+            except Exception as e:
+                print(f"Error processing {entry.path}: {e}")
+                continue
+            entries[rel] = [width, height, st.st_mtime, st.st_size]
+
+    candidates = sorted(rel for rel, (w, h, _, _) in entries.items() if w >= min_size and h >= min_size)
+    random.Random(seed).shuffle(candidates)
+
+    sampled = []
+    for rel in candidates:
+        if len(sampled) >= n:
+            break
+        img_name = rel.split("/", 1)[1]
+        # Naming convention: {class name}_{idx}
+        # idx is 1-based index (1 to N)
+        ext = os.path.splitext(img_name)[1]
+        new_name = f"{class_name}_{len(sampled) + 1}{ext}"
+        try:
+            method = place_file(os.path.join(class_path, img_name), os.path.join(buffer_dir, new_name), mode)
+        except Exception as e:
+            print(f"Error processing {rel}: {e}")
+            continue
+        sampled.append((new_name, img_name, method))
+
+    return class_name, entries, sampled
+
+def sample_images(source_dir, buffer_dir, n, min_size, workers=None, mode="auto", seed=None):
     if not os.path.exists(source_dir):
         print(f"Error: Source directory '{source_dir}' does not exist.")
         return
@@ -19,47 +231,27 @@ def sample_images(source_dir, buffer_dir, n, min_size):
 
     print(f"Found {len(classes)} classes in {source_dir}")
 
+    index = load_index(source_dir)
+    by_class = {}
+    for rel, value in index.items():
+        by_class.setdefault(rel.split("/", 1)[0], {})[rel] = value
+
+    rng = random.Random(seed)
+    jobs = [
+        (source_dir, c, by_class.get(c, {}), buffer_dir, n, min_size, mode, rng.random())
+        for c in classes
+    ]
+
     total_sampled = 0
+    new_index = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for class_name, entries, sampled in pool.map(_sample_class, jobs, chunksize=4):
+            new_index.update(entries)
+            for new_name, img_name, method in sampled:
+                print(f"Sampled: {new_name} (from {img_name}, {method})")
+            total_sampled += len(sampled)
 
-    for class_name in classes:
-        class_path = os.path.join(source_dir, class_name)
-        images = [f for f in os.listdir(class_path) if f.lower().endswith(('.jpg', '.jpeg', '.png', '.webp'))]
-        
-        # Shuffle to random sample
-        random.shuffle(images)
-        
-        sampled_count = 0
-        
-        for img_name in images:
-            if sampled_count >= n:
-                break
-                
-            img_path = os.path.join(class_path, img_name)
-            
-            try:
-                with Image.open(img_path) as img:
-                    width, height = img.size
-                    
-                if width < min_size or height < min_size:
-                    # Skip if too small
-                    continue
-                    
-                # Valid image, process it
-                ext = os.path.splitext(img_name)[1]
-                # Naming convention: {class name}_{idx}
-                # idx is 1-based index (1 to N)
-                new_name = f"{class_name}_{sampled_count + 1}{ext}"
-                dest_path = os.path.join(buffer_dir, new_name)
-                
-                shutil.copy2(img_path, dest_path)
-                print(f"Sampled: {new_name} (from {img_name})")
-                
-                sampled_count += 1
-                total_sampled += 1
-                
-            except Exception as e:
-                print(f"Error processing {img_path}: {e}")
-                
+    save_index(source_dir, new_index)
     print(f"\nDone! Total images sampled: {total_sampled}")
 
 if __name__ == "__main__":
@@ -68,16 +260,24 @@ if __name__ == "__main__":
     parser.add_argument("--buffer", type=str, default="buffer", help="Path to buffer directory.")
     parser.add_argument("--n", type=int, default=1, help="Number of images to sample per class.")
     parser.add_argument("--min_size", type=int, default=300, help="Minimum width/height for images.")
-    
+    parser.add_argument("--workers", type=int, default=None, help="Process pool size (default: CPU count).")
+    parser.add_argument("--mode", choices=["auto", "reflink", "link", "copy"], default="auto",
+                        help="auto/reflink: reflink, then copy. link: hard link first (shares the file with the "
+                             "source dataset, edits to it show up there). copy: always copy.")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for reproducible samples.")
+
     args = parser.parse_args()
-    
+
     # Resolve absolute paths
     source = os.path.abspath(args.source)
     buffer = os.path.abspath(args.buffer)
-    
+
     print(f"Source: {source}")
     print(f"Buffer: {buffer}")
     print(f"N per class: {args.n}")
     print(f"Min Size: {args.min_size}")
-    
-    sample_images(source, buffer, args.n, args.min_size)
+    print(f"Placement: {args.mode}")
+    if args.mode == "link":
+        print("Warning: hard-linked samples are the source files; anything that modifies them in place modifies the source dataset.")
+
+    sample_images(source, buffer, args.n, args.min_size, workers=args.workers, mode=args.mode, seed=args.seed)
@@ -0,0 +1,260 @@
+import os
+import io
+import re
+import json
+import time
+import fcntl
+import tarfile
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import config
+import integrity
+import manifest
+import normalizer
+
+# Training export: complete scenes packed into tar shards of about --shard-size bytes,
+# WebDataset-style (one sample per scene, its members next to each other):
+#   export/shard-000000.tar      <key>.light0.jpg, <key>.light1.png, ..., <key>.json
+#   export/shard-000000.idx      {scene: {"light0.jpg": [offset, size], ..., "json": [offset, size]}}
+#   export/index.json            {"shards": [...], "scenes": {scene: {"shard", "key", "stamp"}}}
+# The .idx sidecar holds the data offset of every member, so a reader can seek (or mmap) straight
+# to one image (see shard_reader.py). <key>.json carries the prompt of every light (manifest,
+# falling back to metadata.json) and quality scores when the scene has been scored.
+#
+# Exports are incremental: shards are never rewritten. Scenes that are new or were regenerated
+# since the last export go into new shards and the index points at their latest copy
+# (--rebuild repacks everything). Shards are built in parallel, one thread each.
+# The older copy of a regenerated scene stays in its shard: streaming the tars directly
+# (plain WebDataset) yields it too, with stale images. ShardReader (index lookups and
+# samples()) only ever returns the latest copy; --rebuild drops the old ones.
+# One export at a time: export/.lock is held (flock) for the whole run and a second export
+# started meanwhile does nothing.
+#
+#   python shard_export.py [--shard-size 1G] [--workers 4] [--rebuild]
+
+EXPORT_DIR = "export"
+INDEX_NAME = "index.json"
+LOCK_NAME = ".lock"
+SHARD_RE = re.compile(r"^shard-(\d{6})\.tar$")
+DEFAULT_SHARD_SIZE = 1 << 30
+
+def parse_size(text):
+    """'512M', '1G', '1048576' -> bytes."""
+    text = str(text).strip().upper()
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def sample_key(scene):
+    # WebDataset splits member names at the first dot: the key itself cannot have one.
+    # Percent-escaped (not '.' -> '_') so two scenes never share a key.
+    return scene.replace("%", "%25").replace(".", "%2E")
+
+def _lock(export_dir):
+    """The export lock as an open file, or None if another export holds it."""
+    f = open(os.path.join(export_dir, LOCK_NAME), 'a')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return None
+    return f
+
+def export_running(export_dir=EXPORT_DIR):
+    if not os.path.isdir(export_dir):
+        return False
+    lock = _lock(export_dir)
+    if lock is None:
+        return True
+    lock.close()
+    return False
+
+def load_index(export_dir=EXPORT_DIR):
+    try:
+        with open(os.path.join(export_dir, INDEX_NAME), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"version": 1, "shards": [], "scenes": {}}
+
+def _write_json_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def scene_members(scene_dir, prompt_count):
+    """Files of a complete scene (light0 + light1..N, all intact), or None if it is not complete yet."""
+    light0 = normalizer.find_light0(scene_dir)
+    if light0 is None:
+        return None
+    files = [light0]
+    for light_idx in range(1, prompt_count + 1):
+        path = os.path.join(scene_dir, manifest.output_name(light_idx))
+        if not integrity.output_complete(path):
+            return None
+        files.append(path)
+    return files
+
+def scene_stamp(files):
+    blob = json.dumps([(os.path.basename(p), os.path.getsize(p), os.stat(p).st_mtime_ns) for p in files])
+    return hashlib.sha1(blob.encode()).hexdigest()[:16]
+
+def sample_metadata(scene, scene_dir, files, global_prompts):
+    """<key>.json: prompt (and quality score, if scored) per light."""
+    recorded = manifest.load(scene_dir)
+    scores = {}
+    try:
+        with open(os.path.join(scene_dir, "scores.json"), 'r') as f:
+            scores = json.load(f)
+    except (OSError, ValueError):
+        pass
+    lights = {}
+    for path in files[1:]:
+        name = os.path.basename(path)
+        stem = name.rsplit('.', 1)[0]
+        entry = {"file": name, "prompt": recorded.get(name, {}).get('prompt') or global_prompts.get(stem)}
+        if name in scores:
+            entry["score"] = scores[name].get("score")
+        lights[stem[5:]] = entry
+    return {"scene": scene, "light0": os.path.basename(files[0]), "lights": lights}
+
+def _add(tar, name, data=None, path=None):
+    info = tarfile.TarInfo(name)
+    info.mode = 0o444
+    if path is not None:
+        st = os.stat(path)
+        info.size, info.mtime = st.st_size, int(st.st_mtime)
+        with open(path, 'rb') as f:
+            tar.addfile(info, f)
+    else:
+        info.size, info.mtime = len(data), int(time.time())
+        tar.addfile(info, io.BytesIO(data))
+
+def build_shard(shard_path, samples):
+    """
+    samples: [(scene, files, metadata)]. Writes the tar (via a .part file) and its .idx sidecar.
+    Returns {scene: {member: [offset, size]}}.
+    """
+    tmp_path = f"{shard_path}.{os.getpid()}.part"
+    with tarfile.open(tmp_path, "w") as tar:
+        for scene, files, metadata in samples:
+            key = sample_key(scene)
+            for path in files:
+                _add(tar, f"{key}.{os.path.basename(path)}", path=path)
+            _add(tar, f"{key}.json", data=json.dumps(metadata, sort_keys=True).encode())
+
+    # Offsets come from reading the headers back (tar pads each member to 512 bytes)
+    index = {}
+    by_key = {sample_key(scene): scene for scene, _, _ in samples}
+    with tarfile.open(tmp_path, 'r') as tar:
+        for member in tar:
+            key, member_name = member.name.split(".", 1)
+            index.setdefault(by_key[key], {})[member_name] = [member.offset_data, member.size]
+    os.replace(tmp_path, shard_path)
+    _write_json_atomic(shard_path[:-len(".tar")] + ".idx", index)
+    return index
+
+def _next_shard_number(export_dir):
+    numbers = [int(m.group(1)) for m in map(SHARD_RE.match, os.listdir(export_dir)) if m]
+    return max(numbers) + 1 if numbers else 0
+
+def export_shards(output_dir=normalizer.OUTPUT_DIR, export_dir=EXPORT_DIR, shard_size=DEFAULT_SHARD_SIZE,
+                  workers=4, rebuild=False):
+    """Pack complete scenes that are not exported yet (or changed since) into new shards."""
+    os.makedirs(export_dir, exist_ok=True)
+    lock = _lock(export_dir)
+    if lock is None:
+        print(f"Another export into {export_dir}/ is running, not starting a second one.")
+        return load_index(export_dir)
+    try:
+        return _export(output_dir, export_dir, shard_size, workers, rebuild)
+    finally:
+        lock.close()
+
+def _export(output_dir, export_dir, shard_size, workers, rebuild):
+    started = time.monotonic()
+    prompt_count = len(config.CONFIG.lighting_prompts())
+    if not prompt_count:
+        # Every scene would look complete with light0 alone (and be stamped that way)
+        print("No lighting prompts configured (lighting_prompts.txt missing or empty?): nothing exported.")
+        return load_index(export_dir)
+    for name in os.listdir(export_dir):
+        if name.endswith(".part"):
+            os.remove(os.path.join(export_dir, name))  # left by an export that was killed
+    if rebuild:
+        for name in os.listdir(export_dir):
+            if SHARD_RE.match(name) or name.endswith(".idx") or name == INDEX_NAME:
+                os.remove(os.path.join(export_dir, name))
+    index = load_index(export_dir)
+    try:
+        with open(os.path.join(output_dir, "metadata.json"), 'r') as f:
+            global_prompts = json.load(f)
+    except (OSError, ValueError):
+        global_prompts = {}
+
+    # Walk once: which complete scenes are new or changed, grouped into shards by size
+    groups, group, group_bytes = [], [], 0
+    incomplete = unchanged = 0
+    with os.scandir(output_dir) as entries:
+        scene_dirs = sorted((e.name, e.path) for e in entries if e.is_dir())
+    for scene, scene_dir in scene_dirs:
+        files = scene_members(scene_dir, prompt_count)
+        if files is None:
+            incomplete += 1
+            continue
+        stamp = scene_stamp(files)
+        if index["scenes"].get(scene, {}).get("stamp") == stamp:
+            unchanged += 1
+            continue
+        group.append((scene, files, sample_metadata(scene, scene_dir, files, global_prompts), stamp))
+        group_bytes += sum(os.path.getsize(p) for p in files)
+        if group_bytes >= shard_size:
+            groups.append(group)
+            group, group_bytes = [], 0
+    if group:
+        groups.append(group)
+    if not groups:
+        print(f"Nothing new to export ({unchanged} scenes exported, {incomplete} not complete).")
+        return index
+
+    first = _next_shard_number(export_dir)
+    jobs = [(os.path.join(export_dir, f"shard-{first + i:06d}.tar"), g) for i, g in enumerate(groups)]
+    lock = threading.Lock()
+
+    def build(job):
+        shard_path, samples = job
+        build_shard(shard_path, [(scene, files, metadata) for scene, files, metadata, _ in samples])
+        shard = {"name": os.path.basename(shard_path), "scenes": len(samples), "bytes": os.path.getsize(shard_path)}
+        with lock:
+            print(f"  Wrote {shard['name']}: {shard['scenes']} scenes, {shard['bytes'] / (1 << 20):.1f} MB")
+        return shard, samples
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for shard, samples in pool.map(build, jobs):
+            index["shards"].append(shard)
+            for scene, _, _, stamp in samples:
+                index["scenes"][scene] = {"shard": shard["name"], "key": sample_key(scene), "stamp": stamp}
+    index["updated"] = time.time()
+    # The index only ever names finished shards
+    _write_json_atomic(os.path.join(export_dir, INDEX_NAME), index)
+    exported = sum(len(g) for g in groups)
+    print(f"Exported {exported} scenes into {len(groups)} new shard(s) in {time.monotonic() - started:.1f}s "
+          f"({unchanged} unchanged, {incomplete} not complete).")
+    superseded = sum(s["scenes"] for s in index["shards"]) - len(index["scenes"])
+    if superseded:
+        print(f"Note: older shards still hold {superseded} superseded sample(s). Read through "
+              f"shard_reader.ShardReader to skip them, or --rebuild to drop them.")
+    return index
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Pack complete scenes into tar shards for training")
+    parser.add_argument("--export-dir", type=str, default=EXPORT_DIR)
+    parser.add_argument("--shard-size", type=str, default="1G", help="Target shard size, e.g. 512M or 1G.")
+    parser.add_argument("--workers", type=int, default=4, help="Shards built in parallel.")
+    parser.add_argument("--rebuild", action="store_true", help="Delete existing shards and repack everything.")
+    args = parser.parse_args()
+    export_shards(export_dir=args.export_dir, shard_size=parse_size(args.shard_size), workers=args.workers,
+                  rebuild=args.rebuild)
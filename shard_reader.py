@@ -0,0 +1,250 @@
+import io
+import os
+import json
+import mmap
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import manifest
+
+# Random access to the training shards written by shard_export.py.
+# Shards are memory-mapped; index.json + the .idx sidecars give every (scene, light_idx) its
+# byte range, so a lookup is one dict access and the encoded image comes back as a memoryview
+# into the map (no read, no copy). Decoding to NumPy is optional and can run on threads
+# (Pillow releases the GIL while decoding).
+#
+#   reader = ShardReader("export")
+#   png = reader.get_bytes("beach_12", 7)                     # memoryview
+#   for light0, light, prompts in reader.batches(reader.pairs(), batch_size=32, workers=4): ...
+#   for scene, members in reader.samples(): ...                # sequential, latest copies only
+#
+#   python shard_reader.py --benchmark [--samples 2000] [--workers 4]   (vs output_dataset)
+
+EXPORT_DIR = "export"
+
+class ShardReader:
+    def __init__(self, export_dir=EXPORT_DIR):
+        self.export_dir = export_dir
+        with open(os.path.join(export_dir, "index.json"), 'r') as f:
+            index = json.load(f)
+        self.shards = [s["name"] for s in index["shards"]]
+        self.locations = {}   # (scene, light_idx) -> (shard, offset, size); light_idx None = <key>.json
+        self.maps = {}
+        self.files = {}
+        self._metadata = {}
+        self.lock = threading.Lock()
+        sidecars = {}
+        for scene, entry in index["scenes"].items():
+            shard = entry["shard"]
+            if shard not in sidecars:
+                with open(os.path.join(export_dir, shard[:-len(".tar")] + ".idx"), 'r') as f:
+                    sidecars[shard] = json.load(f)
+            # A regenerated scene also sits in an older shard; index.json names the latest one
+            for member, (offset, size) in sidecars[shard][scene].items():
+                light_idx = None if member == "json" else int(member.split(".", 1)[0][5:])
+                self.locations[(scene, light_idx)] = (shard, offset, size)
+        self.scenes = sorted(index["scenes"])
+
+    def _map(self, shard):
+        mapped = self.maps.get(shard)
+        if mapped is None:
+            with self.lock:
+                mapped = self.maps.get(shard)
+                if mapped is None:
+                    f = self.files[shard] = open(os.path.join(self.export_dir, shard), 'rb')
+                    mapped = self.maps[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return mapped
+
+    def get_bytes(self, scene, light_idx):
+        """Encoded image (light0 is the original jpg/png) as a memoryview into the shard. KeyError if absent."""
+        shard, offset, size = self.locations[(scene, light_idx)]
+        return memoryview(self._map(shard))[offset:offset + size]
+
+    def metadata(self, scene):
+        """The scene's <key>.json (prompt per light, quality scores)."""
+        data = self._metadata.get(scene)
+        if data is None:
+            data = self._metadata[scene] = json.loads(bytes(self.get_bytes(scene, None)))
+        return data
+
+    def prompt(self, scene, light_idx):
+        return self.metadata(scene)["lights"][str(light_idx)]["prompt"]
+
+    def pairs(self, shuffle=False, seed=None):
+        """Every (scene, light_idx) with light_idx >= 1."""
+        keys = [k for k in self.locations if k[1]]
+        keys.sort()
+        if shuffle:
+            random.Random(seed).shuffle(keys)
+        return keys
+
+    def samples(self, shards=None):
+        """
+        Streams whole samples shard by shard, in shard order: (scene, {member: memoryview}).
+        Superseded copies (a scene regenerated into a later shard) are skipped, which reading
+        the tars directly, WebDataset-style, would not do.
+        """
+        by_shard = {}
+        lights = {}
+        for (scene, light_idx), (shard, offset, _) in self.locations.items():
+            if light_idx is None:
+                by_shard.setdefault(shard, []).append((offset, scene))
+            else:
+                lights.setdefault(scene, []).append(light_idx)
+        for shard in shards or self.shards:
+            for _, scene in sorted(by_shard.get(shard, ())):
+                members = {}
+                for light_idx in sorted(lights.get(scene, ())) + [None]:
+                    name = "json" if light_idx is None else f"light{light_idx}"
+                    members[name] = self.get_bytes(scene, light_idx)
+                yield scene, members
+
+    def decode(self, scene, light_idx, size=None):
+        return decode_image(self.get_bytes(scene, light_idx), size)
+
+    def _triple(self, key, size):
+        scene, light_idx = key
+        return self.decode(scene, 0, size), self.decode(scene, light_idx, size), self.prompt(scene, light_idx)
+
+    def batches(self, pairs, batch_size=32, workers=0, size=None):
+        """
+        Yields (light0, lightN, prompts) per batch of `pairs`. Images are uint8 HxWx3 arrays,
+        stacked into one (B, H, W, 3) array when they share a shape (pass `size` to make sure).
+        workers > 0 decodes on that many threads.
+        """
+        import numpy as np
+        pool = ThreadPoolExecutor(max_workers=workers) if workers else None
+        try:
+            for start in range(0, len(pairs), batch_size):
+                chunk = pairs[start:start + batch_size]
+                if pool:
+                    triples = list(pool.map(lambda key: self._triple(key, size), chunk))
+                else:
+                    triples = [self._triple(key, size) for key in chunk]
+                light0, light, prompts = (list(column) for column in zip(*triples))
+                if len({a.shape for a in light0 + light}) == 1:
+                    light0, light = np.stack(light0), np.stack(light)
+                yield light0, light, prompts
+        finally:
+            if pool:
+                pool.shutdown()
+
+    def close(self):
+        """Unmap the shards (memoryviews from get_bytes() must be released first)."""
+        for mapped in self.maps.values():
+            mapped.close()
+        for f in self.files.values():
+            f.close()
+        self.maps.clear()
+        self.files.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def decode_image(data, size=None):
+    """Encoded bytes (or memoryview) -> uint8 RGB array, optionally resized to size=(w, h)."""
+    import numpy as np
+    from PIL import Image
+    with Image.open(io.BytesIO(data)) as image:
+        if size is not None and image.size != tuple(size):
+            image.draft("RGB", tuple(size))
+            image = image.convert("RGB").resize(tuple(size), Image.BILINEAR)
+        else:
+            image = image.convert("RGB")
+        return np.asarray(image)
+
+# =================================================================================
+# BENCHMARK
+# =================================================================================
+
+def _tree_reader(output_dir):
+    """The same lookups answered from output_dataset/<scene>/ (what training did before shards)."""
+    light0_names = {}
+    prompts = {}
+    try:
+        with open(os.path.join(output_dir, "metadata.json"), 'r') as f:
+            global_prompts = json.load(f)
+    except (OSError, ValueError):
+        global_prompts = {}
+
+    def light0(scene):
+        name = light0_names.get(scene)
+        if name is None:
+            scene_dir = os.path.join(output_dir, scene)
+            name = next(n for n in sorted(os.listdir(scene_dir)) if n.startswith("light0."))
+            light0_names[scene] = name
+        return os.path.join(output_dir, scene, name)
+
+    def get_bytes(scene, light_idx):
+        path = light0(scene) if light_idx == 0 else os.path.join(output_dir, scene, f"light{light_idx}.png")
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def prompt(scene, light_idx):
+        # Same lookup as shard_export.sample_metadata: manifest, else metadata.json (pre-manifest scenes)
+        if scene not in prompts:
+            prompts[scene] = manifest.load(os.path.join(output_dir, scene))
+        return prompts[scene].get(f"light{light_idx}.png", {}).get("prompt") or global_prompts.get(f"light{light_idx}")
+
+    return get_bytes, prompt
+
+def run_benchmark(export_dir=EXPORT_DIR, output_dir="output_dataset", samples=2000, workers=4, decode_samples=200,
+                  seed=0):
+    """samples/sec for random (light0, lightN, prompt) triples: shards vs the directory tree."""
+    reader = ShardReader(export_dir)
+    keys = reader.pairs(shuffle=True, seed=seed)
+    keys = (keys * (samples // max(1, len(keys)) + 1))[:samples]
+    tree_bytes, tree_prompt = _tree_reader(output_dir)
+    results = {}
+
+    def touch(data):
+        # One byte per page, so mapped pages are really faulted in (a memoryview alone reads nothing)
+        return len(data) + len(memoryview(data)[::4096].tobytes())
+
+    def raw(get_bytes, prompt):
+        started = time.perf_counter()
+        total = 0
+        for scene, light_idx in keys:
+            total += touch(get_bytes(scene, 0)) + touch(get_bytes(scene, light_idx))
+            prompt(scene, light_idx)
+        return len(keys) / (time.perf_counter() - started), total
+
+    for name, (get_bytes, prompt) in (("tree", (tree_bytes, tree_prompt)), ("shards", (reader.get_bytes, reader.prompt))):
+        raw(get_bytes, prompt)  # warm the page cache: both sides are measured from memory
+        rate, total = raw(get_bytes, prompt)
+        results[f"raw_{name}"] = round(rate, 1)
+        results["raw_mb_per_pair"] = round(total / len(keys) / (1 << 20), 3)
+
+    decode_keys = keys[:decode_samples]
+    started = time.perf_counter()
+    for scene, light_idx in decode_keys:
+        decode_image(tree_bytes(scene, 0)), decode_image(tree_bytes(scene, light_idx)), tree_prompt(scene, light_idx)
+    results["decode_tree"] = round(len(decode_keys) / (time.perf_counter() - started), 1)
+    for n in sorted({0, workers}):
+        started = time.perf_counter()
+        for _ in reader.batches(decode_keys, batch_size=32, workers=n):
+            pass
+        results[f"decode_shards_{n}w"] = round(len(decode_keys) / (time.perf_counter() - started), 1)
+    reader.close()
+    return results
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Random access to exported training shards")
+    parser.add_argument("--export-dir", type=str, default=EXPORT_DIR)
+    parser.add_argument("--benchmark", action="store_true", help="samples/sec against reading output_dataset directly.")
+    parser.add_argument("--samples", type=int, default=2000)
+    parser.add_argument("--decode-samples", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=4, help="Decode threads in the benchmark.")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        print(json.dumps(run_benchmark(args.export_dir, samples=args.samples, workers=args.workers,
+                                       decode_samples=args.decode_samples), indent=2))
+    else:
+        with ShardReader(args.export_dir) as reader:
+            print(f"{len(reader.scenes)} scenes, {len(reader.pairs())} pairs in {args.export_dir}/")
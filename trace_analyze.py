@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import argparse
+from collections import defaultdict
+import trace_log
+
+# Offline analysis of the JSONL task trace written by processor.py (see trace_log.py).
+# Prints per-run totals, throughput over time, instance utilization and the slowest scenes/prompts.
+
+def load_records(directory, run=None):
+    records = []
+    for path in trace_log.files(directory):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue  # torn last line of a killed run
+
+    if run == "all" or not records:
+        return records
+    if run in (None, "latest"):
+        run = max(records, key=lambda r: r["ts"])["run"]
+    return [r for r in records if r["run"] == run]
+
+def merged_busy_time(intervals):
+    """Total length of the union of (start, end) intervals."""
+    busy = 0.0
+    cur_start = cur_end = None
+    for start, end in sorted(intervals):
+        if cur_end is None or start > cur_end:
+            if cur_end is not None:
+                busy += cur_end - cur_start
+            cur_start, cur_end = start, end
+        else:
+            cur_end = max(cur_end, end)
+    if cur_end is not None:
+        busy += cur_end - cur_start
+    return busy
+
+def print_runs(records):
+    runs = defaultdict(lambda: {"first": None, "last": None, "ok": 0, "error": 0})
+    for r in records:
+        run = runs[r["run"]]
+        run["first"] = r["ts"] if run["first"] is None else min(run["first"], r["ts"])
+        run["last"] = r["ts"] if run["last"] is None else max(run["last"], r["ts"])
+        if r["stage"] == "task":
+            run["ok" if r["outcome"] == "ok" else "error"] += 1
+
+    print("=== Runs ===")
+    for run_id, run in sorted(runs.items(), key=lambda kv: kv[1]["first"]):
+        started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(run["first"]))
+        print(f"{run_id}  started {started}  {run['last'] - run['first']:8.1f}s  tasks ok {run['ok']}  error {run['error']}")
+
+def print_throughput(records, bucket):
+    done = [r["ts"] for r in records if r["stage"] == "task" and r["outcome"] == "ok"]
+    print(f"\n=== Throughput ({bucket:.0f}s buckets, completed tasks) ===")
+    if not done:
+        print("(no completed tasks)")
+        return
+    origin = min(r["ts"] - r["dur"] for r in records)
+    counts = defaultdict(int)
+    for ts in done:
+        counts[int((ts - origin) // bucket)] += 1
+    peak = max(counts.values())
+    for i in range(max(counts) + 1):
+        n = counts.get(i, 0)
+        bar = "#" * int(round(40 * n / peak)) if peak else ""
+        print(f"+{i * bucket:>7.0f}s  {n:>5}  {n * 60.0 / bucket:>7.1f}/min  {bar}")
+
+def print_utilization(records):
+    print("\n=== Instance utilization (gpu_wait busy time / run wall time) ===")
+    by_run = defaultdict(list)
+    for r in records:
+        by_run[r["run"]].append(r)
+
+    for run_id, rows in by_run.items():
+        span = max(r["end"] for r in rows) - min(r["start"] for r in rows)
+        intervals = defaultdict(dict)
+        for r in rows:
+            if r["stage"] != "gpu_wait":
+                continue
+            # Batched executions repeat the same interval once per task; key by prompt id
+            instance = r["instance"] or f"{r['backend']}"
+            key = r["prompt_id"] or (r["scene"], r["light"], r["start"])
+            intervals[instance][key] = (r["start"], r["end"])
+        for instance, spans in sorted(intervals.items()):
+            busy = merged_busy_time(spans.values())
+            total = sum(end - start for start, end in spans.values())
+            print(f"{run_id}  {instance:<32} busy {busy:8.1f}s / {span:8.1f}s = {100.0 * busy / span if span else 0:5.1f}%"
+                  f"  executions {len(spans):>5}  avg concurrency {total / span if span else 0:5.2f}")
+
+def print_slowest(records, top):
+    tasks = [r for r in records if r["stage"] == "task"]
+    by_scene = defaultdict(list)
+    by_light = defaultdict(list)
+    for r in tasks:
+        # A batched execution is shared; attribute an equal share to each task
+        share = r["dur"] / max(1, r.get("batch") or 1)
+        by_scene[r["scene"]].append(share)
+        by_light[r["light"]].append(r["dur"])
+
+    print(f"\n=== Slowest scenes (top {top}, by total task time) ===")
+    for scene, durs in sorted(by_scene.items(), key=lambda kv: -sum(kv[1]))[:top]:
+        print(f"{scene:<32} total {sum(durs):8.1f}s  tasks {len(durs):>3}  max {max(durs):7.2f}s")
+
+    print(f"\n=== Slowest prompts (top {top}, by mean task latency) ===")
+    for light, durs in sorted(by_light.items(), key=lambda kv: -sum(kv[1]) / len(kv[1]))[:top]:
+        print(f"light{light:<4} mean {sum(durs) / len(durs):7.2f}s  max {max(durs):7.2f}s  n {len(durs):>4}")
+
+    errors = [r for r in records if r["outcome"] != "ok"]
+    if errors:
+        print(f"\n=== Errors ({len(errors)}) ===")
+        by_stage = defaultdict(int)
+        for r in errors:
+            by_stage[(r["stage"], r.get("instance") or r["backend"])] += 1
+        for (stage_name, where), n in sorted(by_stage.items(), key=lambda kv: -kv[1]):
+            print(f"{stage_name:<16} {where:<32} {n}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyze processor task traces")
+    parser.add_argument("--dir", type=str, default=trace_log.TRACE_DIR)
+    parser.add_argument("--run", type=str, default="latest", help="Run id, 'latest' or 'all'.")
+    parser.add_argument("--bucket", type=float, default=60.0, help="Throughput bucket size in seconds.")
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.dir):
+        print(f"No trace directory at {args.dir}")
+        return
+
+    records = load_records(args.dir, args.run)
+    if not records:
+        print("No trace records found.")
+        return
+
+    print_runs(records)
+    print_throughput(records, args.bucket)
+    print_utilization(records)
+    print_slowest(records, args.top)
+
+if __name__ == "__main__":
+    main()
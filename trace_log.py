@@ -0,0 +1,108 @@
+import os
+import json
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+
+# Append-only JSONL trace: one record per task per stage.
+#   {"ts": wall clock end, "start": monotonic start, "end": monotonic end, "dur": seconds,
+#    "run": run id, "pid": ..., "scene": ..., "light": N, "stage": ..., "backend": ...,
+#    "instance": url|null, "prompt_id": ...|null, "bytes": N|null, "batch": N, "outcome": "ok"|"error", "error": ...}
+# Files rotate by size: trace.jsonl -> trace.jsonl.1 -> ... -> trace.jsonl.<BACKUP_COUNT>.
+# Use trace_analyze.py to summarize.
+
+TRACE_DIR = "traces"
+TRACE_FILE = "trace.jsonl"
+MAX_BYTES = 50 * 1024 * 1024
+BACKUP_COUNT = 5
+
+RUN_ID = uuid.uuid4().hex[:12]
+
+class TraceLog:
+    def __init__(self, directory=TRACE_DIR, filename=TRACE_FILE, max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT):
+        self.path = os.path.join(directory, filename)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.lock = threading.Lock()
+        self.file = None
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def _rotate(self):
+        self.file.close()
+        self.file = None
+        for i in range(self.backup_count - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def write(self, records):
+        lines = "".join(json.dumps(r, separators=(',', ':')) + "\n" for r in records)
+        with self.lock:
+            try:
+                if self.file is None:
+                    self._open()
+                if self.file.tell() + len(lines) > self.max_bytes and self.file.tell() > 0:
+                    self._rotate()
+                    self._open()
+                self.file.write(lines)
+                self.file.flush()
+            except OSError as e:
+                print(f"Trace write failed: {e}")
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+TRACE = TraceLog()
+
+def files(directory=TRACE_DIR, filename=TRACE_FILE):
+    """Trace files oldest first (rotated backups, then the live file)."""
+    base = os.path.join(directory, filename)
+    paths = []
+    for i in range(BACKUP_COUNT + 20, 0, -1):
+        if os.path.exists(f"{base}.{i}"):
+            paths.append(f"{base}.{i}")
+    if os.path.exists(base):
+        paths.append(base)
+    return paths
+
+def record(stage, tasks, backend, start, end, instance=None, prompt_id=None, nbytes=None,
+           outcome="ok", error=None, trace=None):
+    """Write one record per (scene, light_idx) in tasks for a stage that ran from start to end (monotonic)."""
+    if not tasks:
+        return
+    base = {
+        "ts": round(time.time(), 4), "start": round(start, 6), "end": round(end, 6), "dur": round(end - start, 6),
+        "run": RUN_ID, "pid": os.getpid(), "stage": stage, "backend": backend, "instance": instance,
+        "prompt_id": prompt_id, "bytes": nbytes, "batch": len(tasks), "outcome": outcome, "error": error,
+    }
+    (trace or TRACE).write([dict(base, scene=scene, light=light_idx) for scene, light_idx in tasks])
+
+@contextmanager
+def span(stage, tasks, backend, instance=None, trace=None):
+    """
+    Time the block and record it for every (scene, light_idx) in tasks.
+    The yielded dict can be filled with prompt_id / bytes / outcome while the stage runs.
+    """
+    info = {}
+    start = time.monotonic()
+    outcome, error = "ok", None
+    try:
+        yield info
+    except Exception as e:
+        outcome, error = "error", str(e)[:300]
+        raise
+    finally:
+        record(stage, tasks, backend, start, time.monotonic(), instance,
+               prompt_id=info.get("prompt_id"), nbytes=info.get("bytes"),
+               outcome=info.get("outcome", outcome), error=info.get("error", error), trace=trace)